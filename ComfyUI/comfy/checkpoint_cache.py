@@ -0,0 +1,155 @@
+import os
+import json
+import uuid
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import safetensors
+
+import comfy.utils
+import comfy.supported_models
+from comfy.cli_args import args
+
+# Changed when the format of the cached files changes
+CACHE_VERSION = 1
+
+# Tensors of the checkpoint with at most this many elements that the saved model components don't
+# include are copied to the cached file, those are markers read by model detection like v_pred
+MAX_MARKER_SIZE = 16
+
+write_executor = None
+
+def get_cache_path(ckpt_path, options):
+    """Returns the path of the cached copy of a checkpoint loaded with options, or None if the cache is disabled."""
+    if args.checkpoint_cache_dir is None:
+        return None
+    stat = os.stat(ckpt_path)
+    key = json.dumps([CACHE_VERSION, os.path.abspath(ckpt_path), stat.st_size, stat.st_mtime_ns, options], default=str)
+    name = os.path.splitext(os.path.basename(ckpt_path))[0]
+    return os.path.join(args.checkpoint_cache_dir, "{}.{}.safetensors".format(name, hashlib.sha256(key.encode()).hexdigest()[:16]))
+
+def encode_config(value):
+    if isinstance(value, torch.dtype):
+        return {"dtype": str(value).split(".")[-1]}
+    if isinstance(value, dict):
+        return {"dict": {k: encode_config(v) for k, v in value.items()}}
+    if isinstance(value, (list, tuple)):
+        return [encode_config(v) for v in value]
+    if isinstance(value, (int, float, str, bool, type(None))):
+        return value
+    raise TypeError("Can't store {} in the checkpoint cache".format(type(value)))
+
+def decode_config(value):
+    if isinstance(value, list):
+        return [decode_config(v) for v in value]
+    if isinstance(value, dict):
+        if "dtype" in value:
+            return getattr(torch, value["dtype"])
+        return {k: decode_config(v) for k, v in value["dict"].items()}
+    return value
+
+def load(cache_path):
+    """
+    Returns the state dict of a cached checkpoint and the model config detected when it was
+    cached, or None if there is no cached copy.
+    """
+    if cache_path is None or not os.path.exists(cache_path):
+        return None
+    try:
+        with safetensors.safe_open(cache_path, framework="pt") as f:
+            metadata = f.metadata()
+        config = json.loads(metadata["comfy_model_config"])
+        model_config = getattr(comfy.supported_models, config["class"])(decode_config(config["unet_config"]))
+        model_config.scaled_fp8 = decode_config(config["scaled_fp8"])
+        sd = comfy.utils.load_torch_file(cache_path)
+    except Exception as e:
+        logging.warning("Could not read cached checkpoint {}: {}".format(cache_path, e))
+        return None
+    try:
+        # The modification time orders the files for eviction, least recently used first
+        os.utime(cache_path)
+    except OSError:
+        pass
+
+    logging.info("Loading cached checkpoint {}".format(cache_path))
+    return sd, model_config
+
+def get_markers(sd):
+    return {k: t for k, t in sd.items() if t.nelement() <= MAX_MARKER_SIZE}
+
+def save(cache_path, model_patcher, clip, vae, markers):
+    """Writes the loaded weights with the keys and dtypes they were loaded with, on a background thread."""
+    global write_executor
+    model = model_patcher.model
+    model_config = model.model_config
+    if getattr(comfy.supported_models, type(model_config).__name__, None) is not type(model_config):
+        return
+    try:
+        config = json.dumps({
+            "class": type(model_config).__name__,
+            "unet_config": encode_config(model_config.unet_config),
+            "scaled_fp8": encode_config(model_config.scaled_fp8),
+        })
+    except TypeError as e:
+        logging.debug("Not caching checkpoint: {}".format(e))
+        return
+
+    sd = model.state_dict_for_saving(clip.get_sd() if clip is not None else None, vae.get_sd() if vae is not None else None)
+    for k, t in markers.items():
+        sd.setdefault(k, t)
+
+    if write_executor is None:
+        write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint_cache")
+    write_executor.submit(write, cache_path, sd, {"comfy_model_config": config})
+
+def list_files(directory):
+    files = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(".safetensors"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    files.append((entry.path, stat.st_size, stat.st_mtime))
+    except FileNotFoundError:
+        pass
+    return files
+
+def evict(directory, max_size):
+    """Removes the least recently used cached checkpoints until the directory holds at most max_size bytes."""
+    # Rescanned every time since other workers may be writing to the same directory
+    files = sorted(list_files(directory), key=lambda f: f[2])
+    size = sum(f[1] for f in files)
+    for path, file_size, mtime in files:
+        if size <= max_size:
+            break
+        try:
+            os.remove(path)
+            logging.info("Removed cached checkpoint {}".format(path))
+        except FileNotFoundError:
+            pass
+        size -= file_size
+
+def write(cache_path, sd, metadata):
+    sd = {k: t.contiguous() for k, t in sd.items()}
+    max_size = int(args.checkpoint_cache_size * 1024 * 1024 * 1024)
+    size = sum(t.nelement() * t.element_size() for t in sd.values())
+    if size > max_size:
+        logging.info("Not caching checkpoint {}, {} bytes don't fit in the checkpoint cache".format(cache_path, size))
+        return
+    evict(os.path.dirname(cache_path), max_size - size)
+    temp_path = "{}.{}.tmp".format(cache_path, uuid.uuid4().hex)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        comfy.utils.save_torch_file(sd, temp_path, metadata=metadata)
+        # Atomic so other workers sharing the directory never read a partially written file
+        os.replace(temp_path, cache_path)
+        logging.info("Cached checkpoint {}".format(cache_path))
+    except Exception as e:
+        logging.warning("Could not write cached checkpoint {}: {}".format(cache_path, e))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
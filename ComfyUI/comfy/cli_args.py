@@ -100,6 +100,11 @@ parser.add_argument("--preview-size", type=int, default=512, help="Sets the maxi
 cache_group = parser.add_mutually_exclusive_group()
 cache_group.add_argument("--cache-classic", action="store_true", help="Use the old style (aggressive) caching.")
 cache_group.add_argument("--cache-lru", type=int, default=0, help="Use LRU caching with a maximum of N node results cached. May use more RAM/VRAM.")
+parser.add_argument("--cache-lru-max-memory", type=float, default=None, help="Use LRU caching and drop the least recently used node results once they hold more than this many GB of RAM and VRAM. Can be combined with --cache-lru.")
+parser.add_argument("--prefetch-models", action="store_true", help="Read the model files of queued prompts from disk in the background while the current prompt runs.")
+parser.add_argument("--cache-persistent-dir", type=str, default=None, help="Also store node outputs (CONDITIONING, LATENT, IMAGE, MASK) in this directory so later runs and other processes can reuse them. Use a directory under /dev/shm to keep them in shared memory.")
+parser.add_argument("--cache-persistent-size", type=float, default=10.0, help="Maximum size in GB of the --cache-persistent-dir directory.")
+parser.add_argument("--warm-state", type=str, default=None, metavar="PATH", help="Record the models, LoRAs and text encodings used by executed prompts in this JSON file, and restore them when starting before running any prompt. /ready reports when they are restored.")
 
 attn_group = parser.add_mutually_exclusive_group()
 attn_group.add_argument("--use-split-cross-attention", action="store_true", help="Use the split cross attention optimization. Ignored when xformers is used.")
@@ -123,6 +128,13 @@ vram_group.add_argument("--novram", action="store_true", help="When lowvram isn'
 vram_group.add_argument("--cpu", action="store_true", help="To use the CPU for everything (slow).")
 
 parser.add_argument("--reserve-vram", type=float, default=None, help="Set the amount of vram in GB you want to reserve for use by your OS/other software. By default some amount is reserved depending on your OS.")
+parser.add_argument("--conditioning-cache-size", type=float, default=256.0, metavar="MB", help="Keep up to this many MB of text encodings, keyed by the text encoder, its LoRAs and the tokens, so encoding the same text again doesn't load the text encoder. 0 disables it.")
+parser.add_argument("--patched-weight-cache-size", type=float, default=0.0, metavar="MB", help="Keep up to this many MB of weights with their LoRAs merged in offload memory, keyed by the model, the weight and the patches, so loading a model with LoRAs it was loaded with before doesn't merge them again. Disabled by default: every merged weight not found in it is copied to offload memory.")
+parser.add_argument("--lora-mode", type=str, default="auto", choices=["auto", "merge", "runtime"], help="How LoRAs are applied to the weights of loaded models: merge them into the weights, or runtime to keep the weights as they are and add the LoRAs to the outputs of the layers, which makes switching LoRAs instant but each step a little slower. auto uses runtime for models that are loaded with a different set of LoRAs most of the time.")
+parser.add_argument("--checkpoint-cache-dir", type=str, default=None, help="Keep a copy of loaded checkpoints in this directory with the detected model type and the weights in the dtype they were loaded with, so loading them again skips model detection and dtype conversion.")
+parser.add_argument("--checkpoint-cache-size", type=float, default=50.0, metavar="GB", help="Maximum size in GB of the --checkpoint-cache-dir directory, the least recently used checkpoints are removed to make room.")
+parser.add_argument("--pinned-memory", type=float, default=0, metavar="GB", help="Keep the weights of models offloaded to RAM in this many GB of pinned memory so loading them back to the GPU is faster. Weights that don't fit stay in regular memory.")
+parser.add_argument("--lowvram-stream-window", type=int, default=0, metavar="MODULES", help="When a model is partially loaded, copy the weights of this many of the next offloaded layers to the GPU while the current one computes. 0 copies each layer's weights when it is used.")
 
 
 parser.add_argument("--default-hashing-function", type=str, choices=['md5', 'sha1', 'sha256', 'sha512'], default='sha256', help="Allows you to choose the hash function to use for duplicate filename / contents comparison. Default is sha256.")
@@ -51,7 +51,7 @@ class ClipVisionModel():
         self.patcher = comfy.model_patcher.ModelPatcher(self.model, load_device=self.load_device, offload_device=offload_device)
 
     def load_sd(self, sd):
-        return self.model.load_state_dict(sd, strict=False)
+        return comfy.utils.load_state_dict(self.model, sd)
 
     def get_sd(self):
         return self.model.state_dict()
@@ -0,0 +1,116 @@
+import uuid
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+
+import torch
+
+import comfy.model_management
+import comfy.weight_cache
+from comfy.cli_args import args
+
+# Identifies the weights of a text encoder, keyed by the torch module so clones of a CLIP share it
+model_ids = weakref.WeakKeyDictionary()
+
+class Unhashable(Exception):
+    pass
+
+def freeze(value):
+    if torch.is_tensor(value):
+        # Embeddings are passed as tensors in place of token ids
+        value = value.detach().to("cpu").contiguous()
+        return ("tensor", str(value.dtype), tuple(value.shape), hashlib.sha256(value.reshape(-1).view(torch.uint8).numpy().tobytes()).hexdigest())
+    if isinstance(value, (int, float, str, bool, type(None))):
+        return value
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    raise Unhashable()
+
+def get_key(clip, tokens, return_pooled):
+    """
+    Returns the key of the encoding of tokens by clip: its weights, the content and strengths of
+    its LoRA patches, so LoRAs loaded again share their encodings, the layer it outputs and the
+    tokens with their weights. Returns None when the encoding can't be cached, with hooks or
+    object patches on the model or when the cache is disabled.
+    """
+    patcher = clip.patcher
+    if cache.max_bytes <= 0 or clip.apply_hooks_to_conds is not None or patcher.forced_hooks is not None:
+        return None
+    if len(patcher.hook_patches) > 0 or len(patcher.object_patches) > 0:
+        return None
+    model_id = model_ids.get(clip.cond_stage_model, None)
+    if model_id is None:
+        model_id = uuid.uuid4()
+        model_ids[clip.cond_stage_model] = model_id
+    try:
+        return (model_id, comfy.weight_cache.get_patch_set_key(patcher), clip.layer_idx, str(return_pooled), freeze(tokens))
+    except Unhashable:
+        return None
+
+def get_size(value):
+    """Returns the bytes the tensors of an encoding hold on each device."""
+    device_bytes = {}
+    for v in value.values():
+        if torch.is_tensor(v):
+            device_bytes[str(v.device)] = device_bytes.get(str(v.device), 0) + v.nelement() * v.element_size()
+    return device_bytes
+
+class ConditioningCache:
+    """
+    Text encodings by the content they were encoded from, shared by every prompt, so encoding a
+    text again returns the stored tensors without loading the text encoder on the device. The
+    least recently used encodings are dropped above max_bytes and, like cached node outputs,
+    when free_memory needs room on the device they are stored on.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        comfy.model_management.register_output_cache(self)
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return dict(entry[0])
+
+    def put(self, key, value):
+        if key is None:
+            return
+        device_bytes = get_size(value)
+        size = sum(device_bytes.values())
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (dict(value), device_bytes)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def free_memory(self, memory_required, device):
+        with self.lock:
+            for key in [key for key, (value, device_bytes) in self.entries.items() if device_bytes.get(str(device), 0) > 0]:
+                if comfy.model_management.get_free_memory(device) > memory_required:
+                    break
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= sum(entry[1].values())
+
+cache = ConditioningCache(int(args.conditioning_cache_size * 1024 * 1024))
@@ -455,8 +455,39 @@ def pad_tensor_to_shape(tensor: torch.Tensor, new_shape: list[int]) -> torch.Ten
 
     return padded_tensor
 
-def calculate_weight(patches, weight, key, intermediate_dtype=torch.float32, original_weights=None):
-    for p in patches:
+def calculate_lora_diffs(patches, device, intermediate_dtype=torch.float32):
+    """
+    Computes the up @ down products of the lora/locon patches of several weights, the products
+    of equal shapes with a single batched matmul. patches maps weight keys to their patch lists
+    and the result maps them to {patch index: flattened product} for calculate_weight. Patches
+    with mid weights are left out, calculate_weight computes them.
+    """
+    groups = {}
+    for key, key_patches in patches.items():
+        for i, p in enumerate(key_patches):
+            v = p[1]
+            if isinstance(v, list) or len(v) != 2 or v[0] != "lora" or v[1][3] is not None:
+                continue
+            mat1 = v[1][0].flatten(start_dim=1)
+            mat2 = v[1][1].flatten(start_dim=1)
+            groups.setdefault((tuple(mat1.shape), tuple(mat2.shape)), []).append((key, i, mat1, mat2))
+
+    diffs = {}
+    for group in groups.values():
+        if len(group) == 1:
+            key, i, mat1, mat2 = group[0]
+            lora_diffs = [torch.mm(comfy.model_management.cast_to_device(mat1, device, intermediate_dtype),
+                                   comfy.model_management.cast_to_device(mat2, device, intermediate_dtype))]
+        else:
+            mat1 = comfy.model_management.cast_to_device(torch.stack([g[2] for g in group]), device, intermediate_dtype)
+            mat2 = comfy.model_management.cast_to_device(torch.stack([g[3] for g in group]), device, intermediate_dtype)
+            lora_diffs = torch.bmm(mat1, mat2).unbind(0)
+        for (key, i, _, _), lora_diff in zip(group, lora_diffs):
+            diffs.setdefault(key, {})[i] = lora_diff
+    return diffs
+
+def calculate_weight(patches, weight, key, intermediate_dtype=torch.float32, original_weights=None, lora_diffs=None):
+    for i, p in enumerate(patches):
         strength = p[0]
         v = p[1]
         strength_model = p[2]
@@ -503,8 +534,6 @@ def calculate_weight(patches, weight, key, intermediate_dtype=torch.float32, ori
                           comfy.model_management.cast_to_device(original_weights[key][0][0], weight.device, intermediate_dtype)
             weight += function(strength * comfy.model_management.cast_to_device(diff_weight, weight.device, weight.dtype))
         elif patch_type == "lora": #lora/locon
-            mat1 = comfy.model_management.cast_to_device(v[0], weight.device, intermediate_dtype)
-            mat2 = comfy.model_management.cast_to_device(v[1], weight.device, intermediate_dtype)
             dora_scale = v[4]
             reshape = v[5]
 
@@ -512,17 +541,25 @@ def calculate_weight(patches, weight, key, intermediate_dtype=torch.float32, ori
                 weight = pad_tensor_to_shape(weight, reshape)
 
             if v[2] is not None:
-                alpha = v[2] / mat2.shape[0]
+                alpha = v[2] / v[1].shape[0]
             else:
                 alpha = 1.0
 
-            if v[3] is not None:
-                #locon mid weights, hopefully the math is fine because I didn't properly test it
-                mat3 = comfy.model_management.cast_to_device(v[3], weight.device, intermediate_dtype)
-                final_shape = [mat2.shape[1], mat2.shape[0], mat3.shape[2], mat3.shape[3]]
-                mat2 = torch.mm(mat2.transpose(0, 1).flatten(start_dim=1), mat3.transpose(0, 1).flatten(start_dim=1)).reshape(final_shape).transpose(0, 1)
+            lora_diff = None
+            if lora_diffs is not None:
+                lora_diff = lora_diffs.get(i, None)
+            if lora_diff is None:
+                mat1 = comfy.model_management.cast_to_device(v[0], weight.device, intermediate_dtype)
+                mat2 = comfy.model_management.cast_to_device(v[1], weight.device, intermediate_dtype)
+                if v[3] is not None:
+                    #locon mid weights, hopefully the math is fine because I didn't properly test it
+                    mat3 = comfy.model_management.cast_to_device(v[3], weight.device, intermediate_dtype)
+                    final_shape = [mat2.shape[1], mat2.shape[0], mat3.shape[2], mat3.shape[3]]
+                    mat2 = torch.mm(mat2.transpose(0, 1).flatten(start_dim=1), mat3.transpose(0, 1).flatten(start_dim=1)).reshape(final_shape).transpose(0, 1)
             try:
-                lora_diff = torch.mm(mat1.flatten(start_dim=1), mat2.flatten(start_dim=1)).reshape(weight.shape)
+                if lora_diff is None:
+                    lora_diff = torch.mm(mat1.flatten(start_dim=1), mat2.flatten(start_dim=1))
+                lora_diff = lora_diff.reshape(weight.shape)
                 if dora_scale is not None:
                     weight = weight_decompose(dora_scale, weight, lora_diff, alpha, strength, intermediate_dtype, function)
                 else:
@@ -37,6 +37,7 @@ import comfy.ldm.cosmos.model
 
 import comfy.model_management
 import comfy.patcher_extension
+import comfy.utils
 import comfy.conds
 import comfy.ops
 from enum import Enum
@@ -248,7 +249,7 @@ class BaseModel(torch.nn.Module):
                 to_load[k[len(unet_prefix):]] = sd.pop(k)
 
         to_load = self.model_config.process_unet_state_dict(to_load)
-        m, u = self.diffusion_model.load_state_dict(to_load, strict=False)
+        m, u = comfy.utils.load_state_dict(self.diffusion_model, to_load)
         if len(m) > 0:
             logging.warning("unet missing: {}".format(m))
 
@@ -20,10 +20,12 @@ import psutil
 import logging
 from enum import Enum
 from comfy.cli_args import args
+import comfy.pinned_memory
 import torch
 import sys
 import platform
 import weakref
+import time
 import gc
 
 class VRAMState(Enum):
@@ -308,6 +310,114 @@ except:
 
 current_loaded_models = []
 
+# Caches of node outputs, free_memory asks them to drop tensors before unloading models
+output_caches = weakref.WeakSet()
+
+def register_output_cache(cache):
+    output_caches.add(cache)
+
+class ModelStats:
+    def __init__(self):
+        self.load_rate = None #seconds per byte moved to the device by the last load
+        self.last_used = 0.0
+        self.use_count = 0
+        self.sources = set() #files the model was loaded from
+
+# Keyed by the torch module so clones of a ModelPatcher share their statistics
+model_stats = weakref.WeakKeyDictionary()
+
+def get_model_stats(model):
+    stats = model_stats.get(model.model, None)
+    if stats is None:
+        stats = ModelStats()
+        model_stats[model.model] = stats
+    return stats
+
+def set_model_source(model, path):
+    """Records the file a model was loaded from, so models used by queued prompts are kept loaded."""
+    model = getattr(model, "patcher", model)
+    if model is not None and getattr(model, "model", None) is not None:
+        get_model_stats(model).sources.add(path)
+
+# Function returning how many queued prompts use each model file, registered with the PromptQueue running prompts at startup
+queued_model_files = None
+
+def register_queued_model_files(function):
+    global queued_model_files
+    queued_model_files = function
+
+# Used for models that were never loaded to a device, e.g. with --gpu-only
+DEFAULT_LOAD_BANDWIDTH = 2 * 1024 * 1024 * 1024
+
+class EvictionPolicy:
+    """Orders the models free_memory unloads, the ones with the lowest key are unloaded first."""
+    def key(self, loaded_model, stats, demand, now):
+        raise NotImplementedError
+
+class LoadOrderEvictionPolicy(EvictionPolicy):
+    """Unloads partially offloaded models first, then models with fewer references and smaller models."""
+    def key(self, loaded_model, stats, demand, now):
+        return (-loaded_model.model_offloaded_memory(), sys.getrefcount(loaded_model.model), loaded_model.model_memory())
+
+class ReloadCostEvictionPolicy(EvictionPolicy):
+    """
+    Unloads the models that are cheapest to load back per byte freed, weighted by how soon they are
+    expected to be used again: every queued prompt using the model counts queued_weight uses, past
+    uses count half as much every half_life seconds. Since models are unloaded per byte freed, a hot
+    model is only partially unloaded when freeing part of it makes enough room.
+    """
+    def __init__(self, half_life=600.0, queued_weight=4.0):
+        self.half_life = half_life
+        self.queued_weight = queued_weight
+
+    def key(self, loaded_model, stats, demand, now):
+        load_rate = stats.load_rate
+        if load_rate is None:
+            load_rate = 1.0 / DEFAULT_LOAD_BANDWIDTH
+        queued = sum(demand.get(source, 0) for source in stats.sources)
+        expected_uses = self.queued_weight * queued + stats.use_count * 0.5 ** (max(0.0, now - stats.last_used) / self.half_life)
+        return (load_rate * expected_uses, stats.last_used)
+
+eviction_policy = ReloadCostEvictionPolicy()
+
+pinned_arena = None
+
+def get_pinned_arena():
+    global pinned_arena
+    if pinned_arena is None and args.pinned_memory > 0 and is_nvidia():
+        try:
+            pinned_arena = comfy.pinned_memory.PinnedArena(int(args.pinned_memory * 1024 * 1024 * 1024))
+            logging.info("Pinned memory for offloaded weights: {:0.0f} MB".format(pinned_arena.size / (1024 * 1024)))
+        except Exception as e:
+            logging.warning("Could not allocate pinned memory, offloaded weights will be kept in pageable memory: {}".format(e))
+            args.pinned_memory = 0
+    return pinned_arena
+
+def pin_module_weights(module, device, synchronize=True):
+    """
+    Moves the weights of a module being offloaded to device into pinned memory, if device is the CPU and the arena has room.
+    Callers pinning many modules in a row synchronize once and pass synchronize=False for the others.
+    """
+    if not is_device_cpu(device):
+        return 0
+    arena = get_pinned_arena()
+    if arena is None:
+        return 0
+    # Non blocking loads may still be reading ranges of the arena freed since
+    if synchronize:
+        torch.cuda.synchronize()
+    return arena.pin_module(module)
+
+def pinned_memory_used():
+    if pinned_arena is None:
+        return 0
+    return pinned_arena.used
+
+def pinned_memory_total():
+    if pinned_arena is None:
+        return 0
+    return pinned_arena.size
+
 def module_size(module):
     module_mem = 0
     sd = module.state_dict()
@@ -437,15 +547,22 @@ def minimum_inference_memory():
 
 def free_memory(memory_required, device, keep_loaded=[]):
     cleanup_models_gc()
+    for cache in list(output_caches):
+        if not DISABLE_SMART_MEMORY and get_free_memory(device) > memory_required:
+            break
+        cache.free_memory(memory_required, device)
+
     unloaded_model = []
     can_unload = []
     unloaded_models = []
+    demand = queued_model_files() if queued_model_files is not None else {}
+    now = time.time()
 
     for i in range(len(current_loaded_models) -1, -1, -1):
         shift_model = current_loaded_models[i]
         if shift_model.device == device:
             if shift_model not in keep_loaded and not shift_model.is_dead():
-                can_unload.append((-shift_model.model_offloaded_memory(), sys.getrefcount(shift_model.model), shift_model.model_memory(), i))
+                can_unload.append((eviction_policy.key(shift_model, get_model_stats(shift_model.model), demand, now), i))
                 shift_model.currently_used = False
 
     for x in sorted(can_unload):
@@ -528,6 +645,9 @@ def load_models_gpu(models, memory_required=0, force_patch_weights=False, minimu
 
     for loaded_model in models_to_load:
         model = loaded_model.model
+        stats = get_model_stats(model)
+        stats.last_used = time.time()
+        stats.use_count += 1
         torch_dev = model.load_device
         if is_device_cpu(torch_dev):
             vram_set_state = VRAMState.DISABLED
@@ -547,7 +667,12 @@ def load_models_gpu(models, memory_required=0, force_patch_weights=False, minimu
         if vram_set_state == VRAMState.NO_VRAM:
             lowvram_model_memory = 0.1
 
+        loaded_memory = loaded_model.model_loaded_memory()
+        load_start = time.perf_counter()
         loaded_model.model_load(lowvram_model_memory, force_patch_weights=force_patch_weights)
+        moved_memory = loaded_model.model_loaded_memory() - loaded_memory
+        if moved_memory > 0 and not is_device_cpu(torch_dev):
+            stats.load_rate = (time.perf_counter() - load_start) / moved_memory
         current_loaded_models.insert(0, loaded_model)
     return
 
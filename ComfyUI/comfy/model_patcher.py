@@ -27,13 +27,24 @@ import collections
 import math
 
 import comfy.utils
+import comfy.ops
 import comfy.float
 import comfy.model_management
 import comfy.lora
+import comfy.weight_streaming
+import comfy.weight_cache
 import comfy.hooks
 import comfy.patcher_extension
 from comfy.patcher_extension import CallbacksMP, WrappersMP, PatcherInjection
 from comfy.comfy_types import UnetWrapperFunction
+from comfy.cli_args import args
+
+# Bytes of LoRA products computed together by one batched matmul when loading weights
+LORA_MERGE_BATCH_BYTES = 256 * 1024 * 1024
+
+# With --lora-mode auto, LoRAs are applied at runtime to models loaded with this many different patch sets in their last loads
+RUNTIME_LORA_LOADS = 4
+RUNTIME_LORA_PATCH_SETS = 3
 
 def string_to_seed(data):
     crc = 0xFFFFFFFF
@@ -98,6 +109,7 @@ def wipe_lowvram_weight(m):
         del m.prev_comfy_cast_weights
     m.weight_function = None
     m.bias_function = None
+    m.comfy_weight_streamer = None
 
 class LowVramPatch:
     def __init__(self, key, patches):
@@ -230,6 +242,9 @@ class ModelPatcher:
         if not hasattr(self.model, 'current_weight_patches_uuid'):
             self.model.current_weight_patches_uuid = None
 
+        if not hasattr(self.model, 'recent_patch_sets'):
+            self.model.recent_patch_sets = collections.deque(maxlen=RUNTIME_LORA_LOADS)
+
     def model_size(self):
         if self.size > 0:
             return self.size
@@ -506,7 +521,42 @@ class ModelPatcher:
                         sd.pop(k)
             return sd
 
-    def patch_weight_to_device(self, key, device_to=None, inplace_update=False):
+    def get_weight_cache_key(self, key):
+        weight, set_func, convert_func = get_key_weight(self.model, key)
+        # Weights set by their op are stored in its own format
+        if set_func is not None:
+            return None
+        return comfy.weight_cache.get_key(self, key, weight)
+
+    def patch_weights_to_device(self, keys, device_to=None):
+        """
+        Patches the weights of keys. The weights merged before with the same patches are copied
+        from the patched weight cache, the LoRA products of the others are computed in batches.
+        """
+        keys = [k for k in keys if k in self.patches]
+        cache_keys = {k: self.get_weight_cache_key(k) for k in keys}
+        missing = []
+        for k in keys:
+            cached_weight = comfy.weight_cache.cache.get(cache_keys[k])
+            if cached_weight is None:
+                missing.append(k)
+            else:
+                self.patch_weight_to_device(k, device_to=device_to, cache_key=cache_keys[k], cached_weight=cached_weight)
+
+        batch = []
+        batch_bytes = 0
+        for i, key in enumerate(missing):
+            batch.append(key)
+            batch_bytes += comfy.utils.get_attr(self.model, key).nelement() * 4
+            if batch_bytes >= LORA_MERGE_BATCH_BYTES or i == len(missing) - 1:
+                device = device_to if device_to is not None else comfy.utils.get_attr(self.model, key).device
+                lora_diffs = comfy.lora.calculate_lora_diffs({k: self.patches[k] for k in batch}, device)
+                for k in batch:
+                    self.patch_weight_to_device(k, device_to=device_to, lora_diffs=lora_diffs.get(k, None), cache_key=cache_keys[k])
+                batch = []
+                batch_bytes = 0
+
+    def patch_weight_to_device(self, key, device_to=None, inplace_update=False, lora_diffs=None, cache_key=None, cached_weight=None):
         if key not in self.patches:
             return
 
@@ -516,6 +566,17 @@ class ModelPatcher:
         if key not in self.backup:
             self.backup[key] = collections.namedtuple('Dimension', ['weight', 'inplace_update'])(weight.to(device=self.offload_device, copy=inplace_update), inplace_update)
 
+        # Callers passing cache_key have already looked it up and pass the hit as cached_weight
+        if cache_key is None:
+            cache_key = self.get_weight_cache_key(key)
+            cached_weight = comfy.weight_cache.cache.get(cache_key)
+        if cached_weight is not None:
+            if inplace_update:
+                comfy.utils.copy_to_param(self.model, key, cached_weight)
+            else:
+                comfy.utils.set_attr_param(self.model, key, cached_weight.to(device=device_to if device_to is not None else weight.device, copy=True))
+            return
+
         if device_to is not None:
             temp_weight = comfy.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
         else:
@@ -523,9 +584,11 @@ class ModelPatcher:
         if convert_func is not None:
             temp_weight = convert_func(temp_weight, inplace=True)
 
-        out_weight = comfy.lora.calculate_weight(self.patches[key], temp_weight, key)
+        out_weight = comfy.lora.calculate_weight(self.patches[key], temp_weight, key, lora_diffs=lora_diffs)
         if set_func is None:
             out_weight = comfy.float.stochastic_rounding(out_weight, weight.dtype, seed=string_to_seed(key))
+            if cache_key is not None:
+                comfy.weight_cache.cache.put(cache_key, out_weight.to(device=self.offload_device, copy=True))
             if inplace_update:
                 comfy.utils.copy_to_param(self.model, key, out_weight)
             else:
@@ -533,6 +596,51 @@ class ModelPatcher:
         else:
             set_func(out_weight, inplace_update=inplace_update, seed=string_to_seed(key))
 
+    def use_runtime_loras(self, force_patch_weights=False):
+        """
+        Returns whether the LoRAs are applied by the layers at runtime instead of merged into the
+        weights: with --lora-mode auto, when the model was loaded with RUNTIME_LORA_PATCH_SETS
+        different patch sets in its last RUNTIME_LORA_LOADS loads, so a new set isn't merged again.
+        Weights are always merged when force_patch_weights is set, e.g. to save the model.
+        """
+        if force_patch_weights or args.lora_mode == "merge" or len(self.hook_patches) > 0 or self.forced_hooks is not None:
+            return False
+        if args.lora_mode == "runtime":
+            return True
+        return len(set(self.model.recent_patch_sets)) >= RUNTIME_LORA_PATCH_SETS
+
+    def get_runtime_loras(self, key, module, device_to=None):
+        """
+        Returns the (up, down, scale) of the LoRA patches of key for comfy.ops.apply_runtime_loras,
+        or None when the weight has patches that have to be merged.
+        """
+        if not isinstance(module, comfy.ops.CastWeightBiasOp) or not isinstance(module, (torch.nn.Linear, torch.nn.Conv2d)):
+            return None
+        if isinstance(module, torch.nn.Conv2d) and (module.groups != 1 or module.padding_mode != "zeros"):
+            return None
+
+        weight = module.weight
+        loras = []
+        for strength, v, strength_model, offset, function in self.patches[key]:
+            if isinstance(v, list) or len(v) != 2 or v[0] != "lora":
+                return None
+            up, down, alpha, mid, dora_scale, reshape = v[1]
+            if strength_model != 1.0 or offset is not None or function is not None or mid is not None or dora_scale is not None or reshape is not None:
+                return None
+            rank = down.shape[0]
+            if up.nelement() != weight.shape[0] * rank or down.nelement() != rank * weight[0].nelement():
+                return None
+
+            if alpha is not None:
+                strength = strength * alpha / rank
+            up = up.reshape(weight.shape[0], rank, *[1] * (weight.ndim - 2))
+            down = down.reshape(rank, *weight.shape[1:])
+            if device_to is not None:
+                up = comfy.model_management.cast_to_device(up, device_to, None)
+                down = comfy.model_management.cast_to_device(down, device_to, None)
+            loras.append((up, down, strength))
+        return loras
+
     def _load_list(self):
         loading = []
         for n, m in self.model.named_modules():
@@ -555,6 +663,12 @@ class ModelPatcher:
             patch_counter = 0
             lowvram_counter = 0
             loading = self._load_list()
+            weight_streamer = comfy.weight_streaming.create_weight_streamer(device_to)
+            self.model.weight_streamer = weight_streamer
+
+            if args.lora_mode == "auto":
+                self.model.recent_patch_sets.append(comfy.weight_cache.get_patch_set_id(self))
+            runtime_loras = self.use_runtime_loras(force_patch_weights=force_patch_weights)
 
             load_completely = []
             loading.sort(reverse=True)
@@ -570,6 +684,7 @@ class ModelPatcher:
                     if mem_counter + module_mem >= lowvram_model_memory:
                         lowvram_weight = True
                         lowvram_counter += 1
+                        m.comfy_weight_streamer = weight_streamer
                         if hasattr(m, "prev_comfy_cast_weights"): #Already lowvramed
                             continue
 
@@ -577,6 +692,7 @@ class ModelPatcher:
                 bias_key = "{}.bias".format(n)
 
                 if lowvram_weight:
+                    m.runtime_loras = None
                     if weight_key in self.patches:
                         if force_patch_weights:
                             self.patch_weight_to_device(weight_key)
@@ -602,6 +718,7 @@ class ModelPatcher:
                         load_completely.append((module_mem, n, m, params))
 
             load_completely.sort(reverse=True)
+            patch_keys = []
             for x in load_completely:
                 n = x[1]
                 m = x[2]
@@ -611,13 +728,21 @@ class ModelPatcher:
                         continue
 
                 for param in params:
-                    self.patch_weight_to_device("{}.{}".format(n, param), device_to=device_to)
-
+                    key = "{}.{}".format(n, param)
+                    if runtime_loras and param == "weight" and key in self.patches:
+                        m.runtime_loras = self.get_runtime_loras(key, m, device_to=device_to)
+                        if m.runtime_loras is not None:
+                            continue
+                    patch_keys.append(key)
                 logging.debug("lowvram: loaded module regularly {} {}".format(n, m))
                 m.comfy_patched_weights = True
 
+            self.patch_weights_to_device(patch_keys, device_to=device_to)
+
+            # Pinned weights are copied asynchronously, the copies are queued before the computations using them
+            non_blocking = comfy.model_management.get_pinned_arena() is not None and not comfy.model_management.is_device_cpu(device_to)
             for x in load_completely:
-                x[2].to(device_to)
+                x[2].to(device_to, non_blocking=non_blocking)
 
             if lowvram_counter > 0:
                 logging.info("loaded partially {} {} {}".format(lowvram_model_memory / (1024 * 1024), mem_counter / (1024 * 1024), patch_counter))
@@ -626,7 +751,7 @@ class ModelPatcher:
                 logging.info("loaded completely {} {} {}".format(lowvram_model_memory / (1024 * 1024), mem_counter / (1024 * 1024), full_load))
                 self.model.model_lowvram = False
                 if full_load:
-                    self.model.to(device_to)
+                    self.model.to(device_to, non_blocking=non_blocking)
                     mem_counter = self.model_size()
 
             self.model.lowvram_patch_counter += patch_counter
@@ -680,6 +805,7 @@ class ModelPatcher:
             self.backup.clear()
 
             if device_to is not None:
+                comfy.model_management.pin_module_weights(self.model, device_to)
                 self.model.to(device_to)
                 self.model.device = device_to
             self.model.model_loaded_weight_memory = 0
@@ -687,6 +813,8 @@ class ModelPatcher:
             for m in self.model.modules():
                 if hasattr(m, "comfy_patched_weights"):
                     del m.comfy_patched_weights
+                if getattr(m, "runtime_loras", None) is not None:
+                    m.runtime_loras = None
 
         keys = list(self.object_patches_backup.keys())
         for k in keys:
@@ -700,6 +828,11 @@ class ModelPatcher:
             patch_counter = 0
             unload_list = self._load_list()
             unload_list.sort()
+            weight_streamer = getattr(self.model, "weight_streamer", None)
+            if weight_streamer is not None:
+                weight_streamer.reset()
+            # The device is synchronized once, before the first module is pinned
+            synchronize_pinning = True
             for unload in unload_list:
                 if memory_to_free < memory_freed:
                     break
@@ -728,6 +861,10 @@ class ModelPatcher:
                     weight_key = "{}.weight".format(n)
                     bias_key = "{}.bias".format(n)
                     if move_weight:
+                        if lowvram_possible:
+                            m.runtime_loras = None
+                        comfy.model_management.pin_module_weights(m, device_to, synchronize=synchronize_pinning)
+                        synchronize_pinning = False
                         m.to(device_to)
                         if lowvram_possible:
                             if weight_key in self.patches:
@@ -739,6 +876,7 @@ class ModelPatcher:
 
                             m.prev_comfy_cast_weights = m.comfy_cast_weights
                             m.comfy_cast_weights = True
+                            m.comfy_weight_streamer = weight_streamer
                         m.comfy_patched_weights = False
                         memory_freed += module_mem
                         logging.debug("freed {}".format(n))
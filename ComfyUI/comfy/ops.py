@@ -35,6 +35,15 @@ def cast_bias_weight(s, input=None, dtype=None, device=None, bias_dtype=None):
         if device is None:
             device = input.device
 
+    weight_streamer = getattr(s, "comfy_weight_streamer", None)
+    if weight_streamer is not None and weight_streamer.device == device:
+        weight, bias = weight_streamer.get(s, dtype, bias_dtype)
+        if s.bias_function is not None:
+            bias = s.bias_function(bias)
+        if s.weight_function is not None:
+            weight = s.weight_function(weight)
+        return weight, bias
+
     bias = None
     non_blocking = comfy.model_management.device_supports_non_blocking(device)
     if s.bias is not None:
@@ -49,10 +58,27 @@ def cast_bias_weight(s, input=None, dtype=None, device=None, bias_dtype=None):
         weight = s.weight_function(weight)
     return weight, bias
 
+def apply_runtime_loras(s, input, output):
+    """
+    Adds the LoRAs set on s by the model patcher to its output, (input @ down) @ up * scale for
+    each of them, instead of merging up @ down into the weight.
+    """
+    for up, down, scale in s.runtime_loras:
+        up = cast_to_input(up, input, copy=False)
+        down = cast_to_input(down, input, copy=False)
+        if isinstance(s, torch.nn.Conv2d):
+            hidden = torch.nn.functional.conv2d(input, down, None, s.stride, s.padding, s.dilation)
+            output = output + torch.nn.functional.conv2d(hidden, up) * scale
+        else:
+            output = output + torch.nn.functional.linear(torch.nn.functional.linear(input, down), up) * scale
+    return output
+
 class CastWeightBiasOp:
     comfy_cast_weights = False
     weight_function = None
     bias_function = None
+    comfy_weight_streamer = None
+    runtime_loras = None
 
 class disable_weight_init:
     class Linear(torch.nn.Linear, CastWeightBiasOp):
@@ -65,9 +91,12 @@ class disable_weight_init:
 
         def forward(self, *args, **kwargs):
             if self.comfy_cast_weights:
-                return self.forward_comfy_cast_weights(*args, **kwargs)
+                output = self.forward_comfy_cast_weights(*args, **kwargs)
             else:
-                return super().forward(*args, **kwargs)
+                output = super().forward(*args, **kwargs)
+            if self.runtime_loras is not None:
+                output = apply_runtime_loras(self, args[0], output)
+            return output
 
     class Conv1d(torch.nn.Conv1d, CastWeightBiasOp):
         def reset_parameters(self):
@@ -93,9 +122,12 @@ class disable_weight_init:
 
         def forward(self, *args, **kwargs):
             if self.comfy_cast_weights:
-                return self.forward_comfy_cast_weights(*args, **kwargs)
+                output = self.forward_comfy_cast_weights(*args, **kwargs)
             else:
-                return super().forward(*args, **kwargs)
+                output = super().forward(*args, **kwargs)
+            if self.runtime_loras is not None:
+                output = apply_runtime_loras(self, args[0], output)
+            return output
 
     class Conv3d(torch.nn.Conv3d, CastWeightBiasOp):
         def reset_parameters(self):
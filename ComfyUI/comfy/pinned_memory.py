@@ -0,0 +1,92 @@
+import bisect
+import logging
+import threading
+import weakref
+
+import torch
+
+# Allocations are aligned to this many bytes
+ALIGNMENT = 64
+
+class PinnedArena:
+    """
+    Pre-allocated page-locked host memory that offloaded weights are copied into, so loading them
+    back to the GPU is a DMA transfer instead of a copy through a pageable staging buffer.
+
+    Allocations are tensors viewing a range of the arena through their own buffer object: the
+    range is returned to the arena once the last tensor using it is freed, however the tensor was
+    shared in between. When the arena is full allocate returns None and callers keep the weights
+    in pageable memory.
+    """
+    def __init__(self, size, pin=True):
+        self.size = size - size % ALIGNMENT
+        self.buffer = torch.empty(self.size, dtype=torch.uint8)
+        self.pinned = False
+        if pin:
+            torch.cuda.check_error(torch.cuda.cudart().cudaHostRegister(self.buffer.data_ptr(), self.size, 0))
+            self.pinned = True
+        self.memory = memoryview(self.buffer.numpy())
+        self.free_ranges = [(0, self.size)] #(offset, size) sorted by offset
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def __del__(self):
+        if self.pinned:
+            torch.cuda.cudart().cudaHostUnregister(self.buffer.data_ptr())
+
+    def allocate(self, size):
+        size = max(ALIGNMENT, -(-size // ALIGNMENT) * ALIGNMENT)
+        with self.lock:
+            for i, (offset, free_size) in enumerate(self.free_ranges):
+                if free_size >= size:
+                    if free_size == size:
+                        self.free_ranges.pop(i)
+                    else:
+                        self.free_ranges[i] = (offset + size, free_size - size)
+                    self.used += size
+                    break
+            else:
+                return None
+
+        memory = self.memory[offset:offset + size]
+        weakref.finalize(memory, self.free, offset, size)
+        return torch.frombuffer(memory, dtype=torch.uint8)
+
+    def free(self, offset, size):
+        with self.lock:
+            self.used -= size
+            i = bisect.bisect(self.free_ranges, (offset, size))
+            if i < len(self.free_ranges) and self.free_ranges[i][0] == offset + size:
+                size += self.free_ranges.pop(i)[1]
+            if i > 0 and sum(self.free_ranges[i - 1]) == offset:
+                offset, prev_size = self.free_ranges.pop(i - 1)
+                size += prev_size
+                i -= 1
+            self.free_ranges.insert(i, (offset, size))
+
+    def empty_like(self, tensor):
+        """Returns an uninitialized tensor in the arena with the dtype and shape of tensor, or None if the arena is full."""
+        memory = self.allocate(tensor.nelement() * tensor.element_size())
+        if memory is None:
+            return None
+        return memory[:tensor.nelement() * tensor.element_size()].view(tensor.dtype).view(tensor.shape)
+
+    def pin_module(self, module):
+        """
+        Moves the parameters and buffers of module that are not pinned yet into the arena, stops when
+        it is full. Returns the number of bytes moved.
+        """
+        pinned = 0
+        for m in module.modules():
+            for tensors in (m._parameters, m._buffers):
+                for name, t in tensors.items():
+                    if t is None or t.device.type not in ("cpu", "cuda") or (t.device.type == "cpu" and t.is_pinned()):
+                        continue
+                    p = self.empty_like(t)
+                    if p is None:
+                        logging.debug("Pinned memory arena full, {} MB used".format(self.used / (1024 * 1024)))
+                        return pinned
+                    p.copy_(t)
+                    t.data = p
+                    pinned += p.nelement() * p.element_size()
+        return pinned
@@ -16,6 +16,8 @@ import yaml
 import math
 
 import comfy.utils
+import comfy.checkpoint_cache
+import comfy.conditioning_cache
 
 from . import clip_vision
 from . import gligen
@@ -198,28 +200,48 @@ class CLIP:
         return all_cond_pooled
 
     def encode_from_tokens(self, tokens, return_pooled=False, return_dict=False):
-        self.cond_stage_model.reset_clip_options()
-
-        if self.layer_idx is not None:
-            self.cond_stage_model.set_clip_options({"layer": self.layer_idx})
-
-        if return_pooled == "unprojected":
-            self.cond_stage_model.set_clip_options({"projected_pooled": False})
-
-        self.load_model()
-        o = self.cond_stage_model.encode_token_weights(tokens)
-        cond, pooled = o[:2]
+        out = self.encode_from_tokens_batch([tokens], return_pooled=return_pooled)[0]
         if return_dict:
-            out = {"cond": cond, "pooled_output": pooled}
-            if len(o) > 2:
-                for k in o[2]:
-                    out[k] = o[2][k]
-            self.add_hooks_to_dict(out)
             return out
 
         if return_pooled:
-            return cond, pooled
-        return cond
+            return out["cond"], out["pooled_output"]
+        return out["cond"]
+
+    def encode_from_tokens_batch(self, tokens_list, return_pooled=True):
+        """
+        Returns the output of encode_from_tokens with return_dict for each tokens of the list. Those
+        that aren't cached are encoded in one forward pass when the text encoder supports it.
+        """
+        cache_keys = [comfy.conditioning_cache.get_key(self, tokens, return_pooled) for tokens in tokens_list]
+        outs = [comfy.conditioning_cache.cache.get(key) for key in cache_keys]
+        missing = [i for i, out in enumerate(outs) if out is None]
+        if len(missing) > 0:
+            self.cond_stage_model.reset_clip_options()
+
+            if self.layer_idx is not None:
+                self.cond_stage_model.set_clip_options({"layer": self.layer_idx})
+
+            if return_pooled == "unprojected":
+                self.cond_stage_model.set_clip_options({"projected_pooled": False})
+
+            self.load_model()
+            if len(missing) > 1 and hasattr(self.cond_stage_model, "encode_token_weights_batch"):
+                results = self.cond_stage_model.encode_token_weights_batch([tokens_list[i] for i in missing])
+            else:
+                results = [self.cond_stage_model.encode_token_weights(tokens_list[i]) for i in missing]
+
+            for i, o in zip(missing, results):
+                out = {"cond": o[0], "pooled_output": o[1]}
+                if len(o) > 2:
+                    for k in o[2]:
+                        out[k] = o[2][k]
+                comfy.conditioning_cache.cache.put(cache_keys[i], out)
+                outs[i] = out
+
+        for out in outs:
+            self.add_hooks_to_dict(out)
+        return outs
 
     def encode(self, text):
         tokens = self.tokenize(text)
@@ -227,7 +249,7 @@ class CLIP:
 
     def load_sd(self, sd, full_model=False):
         if full_model:
-            return self.cond_stage_model.load_state_dict(sd, strict=False)
+            return comfy.utils.load_state_dict(self.cond_stage_model, sd)
         else:
             return self.cond_stage_model.load_sd(sd)
 
@@ -399,7 +421,7 @@ class VAE:
             self.first_stage_model = AutoencoderKL(**(config['params']))
         self.first_stage_model = self.first_stage_model.eval()
 
-        m, u = self.first_stage_model.load_state_dict(sd, strict=False)
+        m, u = comfy.utils.load_state_dict(self.first_stage_model, sd)
         if len(m) > 0:
             logging.warning("Missing VAE keys {}".format(m))
 
@@ -663,7 +685,10 @@ def load_clip(ckpt_paths, embedding_directory=None, clip_type=CLIPType.STABLE_DI
     clip_data = []
     for p in ckpt_paths:
         clip_data.append(comfy.utils.load_torch_file(p, safe_load=True))
-    return load_text_encoder_state_dicts(clip_data, embedding_directory=embedding_directory, clip_type=clip_type, model_options=model_options)
+    clip = load_text_encoder_state_dicts(clip_data, embedding_directory=embedding_directory, clip_type=clip_type, model_options=model_options)
+    for p in ckpt_paths:
+        model_management.set_model_source(clip, p)
+    return clip
 
 
 class TEModel(Enum):
@@ -845,13 +870,26 @@ def load_checkpoint(config_path=None, ckpt_path=None, output_vae=True, output_cl
     return (model, clip, vae)
 
 def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, output_clipvision=False, embedding_directory=None, output_model=True, model_options={}, te_model_options={}):
-    sd = comfy.utils.load_torch_file(ckpt_path)
-    out = load_state_dict_guess_config(sd, output_vae, output_clip, output_clipvision, embedding_directory, output_model, model_options, te_model_options=te_model_options)
+    cache_path = None
+    if output_model and not output_clipvision:
+        cache_path = comfy.checkpoint_cache.get_cache_path(ckpt_path, [output_vae, output_clip, model_options, te_model_options])
+    cached = comfy.checkpoint_cache.load(cache_path)
+    if cached is not None:
+        sd, model_config = cached
+        out = load_state_dict_guess_config(sd, output_vae, output_clip, output_clipvision, embedding_directory, output_model, model_options, te_model_options=te_model_options, model_config=model_config)
+    else:
+        sd = comfy.utils.load_torch_file(ckpt_path)
+        markers = comfy.checkpoint_cache.get_markers(sd) if cache_path is not None else None
+        out = load_state_dict_guess_config(sd, output_vae, output_clip, output_clipvision, embedding_directory, output_model, model_options, te_model_options=te_model_options)
+        if out is not None and cache_path is not None:
+            comfy.checkpoint_cache.save(cache_path, out[0], out[1], out[2], markers)
     if out is None:
         raise RuntimeError("ERROR: Could not detect model type of: {}".format(ckpt_path))
+    for m in out:
+        model_management.set_model_source(m, ckpt_path)
     return out
 
-def load_state_dict_guess_config(sd, output_vae=True, output_clip=True, output_clipvision=False, embedding_directory=None, output_model=True, model_options={}, te_model_options={}):
+def load_state_dict_guess_config(sd, output_vae=True, output_clip=True, output_clipvision=False, embedding_directory=None, output_model=True, model_options={}, te_model_options={}, model_config=None):
     clip = None
     clipvision = None
     vae = None
@@ -863,9 +901,12 @@ def load_state_dict_guess_config(sd, output_vae=True, output_clip=True, output_c
     weight_dtype = comfy.utils.weight_dtype(sd, diffusion_model_prefix)
     load_device = model_management.get_torch_device()
 
-    model_config = model_detection.model_config_from_unet(sd, diffusion_model_prefix)
     if model_config is None:
-        return None
+        model_config = model_detection.model_config_from_unet(sd, diffusion_model_prefix)
+        if model_config is None:
+            return None
+    else:
+        sd.pop("{}scaled_fp8".format(diffusion_model_prefix), None)
 
     unet_weight_dtype = list(model_config.supported_inference_dtypes)
     if weight_dtype is not None and model_config.scaled_fp8 is None:
@@ -995,6 +1036,7 @@ def load_diffusion_model(unet_path, model_options={}):
     if model is None:
         logging.error("ERROR UNSUPPORTED UNET {}".format(unet_path))
         raise RuntimeError("ERROR: Could not detect model type of: {}".format(unet_path))
+    model_management.set_model_source(model, unet_path)
     return model
 
 def load_unet(unet_path, dtype=None):
@@ -7,10 +7,13 @@ import traceback
 import zipfile
 from . import model_management
 import comfy.clip_model
+import comfy.utils
 import json
 import logging
 import numbers
 import re
+import threading
+from collections import OrderedDict
 
 def gen_empty_tokens(special_tokens, length):
     start_token = special_tokens.get("start", None)
@@ -26,14 +29,29 @@ def gen_empty_tokens(special_tokens, length):
 
 class ClipTokenWeightEncoder:
     def encode_token_weights(self, token_weight_pairs):
+        return self.encode_token_weights_batch([token_weight_pairs])[0]
+
+    def encode_token_weights_batch(self, token_weight_pairs_list):
+        """
+        Encodes the sections of several prompts in one forward pass and returns the output of
+        encode_token_weights for each of them. Prompts whose sections differ in length, or
+        without sections, are encoded one by one.
+        """
+        if type(self).encode_token_weights is not ClipTokenWeightEncoder.encode_token_weights:
+            return [self.encode_token_weights(token_weight_pairs) for token_weight_pairs in token_weight_pairs_list]
+
+        section_lengths = set(len(x) for token_weight_pairs in token_weight_pairs_list for x in token_weight_pairs)
+        if len(token_weight_pairs_list) > 1 and (len(section_lengths) > 1 or any(len(token_weight_pairs) == 0 for token_weight_pairs in token_weight_pairs_list)):
+            return [r for token_weight_pairs in token_weight_pairs_list for r in self.encode_token_weights_batch([token_weight_pairs])]
+
         to_encode = list()
-        max_token_len = 0
+        max_token_len = max(section_lengths, default=0)
         has_weights = False
-        for x in token_weight_pairs:
-            tokens = list(map(lambda a: a[0], x))
-            max_token_len = max(len(tokens), max_token_len)
-            has_weights = has_weights or not all(map(lambda a: a[1] == 1.0, x))
-            to_encode.append(tokens)
+        for token_weight_pairs in token_weight_pairs_list:
+            for x in token_weight_pairs:
+                tokens = list(map(lambda a: a[0], x))
+                has_weights = has_weights or not all(map(lambda a: a[1] == 1.0, x))
+                to_encode.append(tokens)
 
         sections = len(to_encode)
         if has_weights or sections == 0:
@@ -45,38 +63,44 @@ class ClipTokenWeightEncoder:
         o = self.encode(to_encode)
         out, pooled = o[:2]
 
-        if pooled is not None:
-            first_pooled = pooled[0:1].to(model_management.intermediate_device())
-        else:
-            first_pooled = pooled
-
-        output = []
-        for k in range(0, sections):
-            z = out[k:k+1]
-            if has_weights:
-                z_empty = out[-1]
-                for i in range(len(z)):
-                    for j in range(len(z[i])):
-                        weight = token_weight_pairs[k][j][1]
-                        if weight != 1.0:
-                            z[i][j] = (z[i][j] - z_empty[j]) * weight + z_empty[j]
-            output.append(z)
-
-        if (len(output) == 0):
-            r = (out[-1:].to(model_management.intermediate_device()), first_pooled)
-        else:
-            r = (torch.cat(output, dim=-2).to(model_management.intermediate_device()), first_pooled)
+        results = []
+        start = 0
+        for token_weight_pairs in token_weight_pairs_list:
+            end = start + len(token_weight_pairs)
+            if pooled is not None:
+                first_pooled = pooled[start:start + 1].to(model_management.intermediate_device())
+            else:
+                first_pooled = pooled
+
+            output = []
+            for k in range(start, end):
+                z = out[k:k+1]
+                if has_weights:
+                    z_empty = out[-1]
+                    for i in range(len(z)):
+                        for j in range(len(z[i])):
+                            weight = token_weight_pairs[k - start][j][1]
+                            if weight != 1.0:
+                                z[i][j] = (z[i][j] - z_empty[j]) * weight + z_empty[j]
+                output.append(z)
+
+            if (len(output) == 0):
+                r = (out[-1:].to(model_management.intermediate_device()), first_pooled)
+            else:
+                r = (torch.cat(output, dim=-2).to(model_management.intermediate_device()), first_pooled)
 
-        if len(o) > 2:
-            extra = {}
-            for k in o[2]:
-                v = o[2][k]
-                if k == "attention_mask":
-                    v = v[:sections].flatten().unsqueeze(dim=0).to(model_management.intermediate_device())
-                extra[k] = v
+            if len(o) > 2:
+                extra = {}
+                for k in o[2]:
+                    v = o[2][k]
+                    if k == "attention_mask":
+                        v = v[start:end].flatten().unsqueeze(dim=0).to(model_management.intermediate_device())
+                    extra[k] = v
 
-            r = r + (extra,)
-        return r
+                r = r + (extra,)
+            results.append(r)
+            start = end
+        return results
 
 class SDClipModel(torch.nn.Module, ClipTokenWeightEncoder):
     LAYERS = [
@@ -252,7 +276,7 @@ class SDClipModel(torch.nn.Module, ClipTokenWeightEncoder):
         return self(tokens)
 
     def load_sd(self, sd):
-        return self.transformer.load_state_dict(sd, strict=False)
+        return comfy.utils.load_state_dict(self.transformer, sd)
 
 def parse_parentheses(string):
     result = []
@@ -331,14 +355,6 @@ def safe_load_embed_zip(embed_path):
                 del embed
                 return out
 
-def expand_directory_list(directories):
-    dirs = set()
-    for x in directories:
-        dirs.add(x)
-        for root, subdir, file in os.walk(x, followlinks=True):
-            dirs.add(root)
-    return list(dirs)
-
 def bundled_embed(embed, prefix, suffix): #bundled embedding in lora format
     out_list = []
     for k in embed:
@@ -349,14 +365,82 @@ def bundled_embed(embed, prefix, suffix): #bundled embedding in lora format
 
     return torch.cat(out_list, dim=0)
 
-def load_embed(embedding_name, embedding_directory, embedding_size, embed_key=None):
+class BoundedMemo:
+    """Values of a function by key, the least recently used are dropped above max_size."""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, function):
+        with self.lock:
+            if key in self.values:
+                self.values.move_to_end(key)
+                return self.values[key]
+        value = function()
+        with self.lock:
+            self.values[key] = value
+            while len(self.values) > self.max_size:
+                self.values.popitem(last=False)
+        return value
+
+class EmbeddingIndex:
+    """
+    The files in embedding directories and their subdirectories, so looking up an embedding
+    doesn't walk the directories. They are listed again when one of the directories changes.
+    """
+    def __init__(self, directories):
+        self.directories = directories
+        self.mtimes = None
+        self.expanded_directories = []
+        self.files = set()
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def get_mtimes(self, directories):
+        mtimes = []
+        for x in directories:
+            try:
+                mtimes.append(os.stat(x).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def refresh(self):
+        """Lists the files again if a directory changed, returns the version of the listing."""
+        with self.lock:
+            if self.mtimes is not None and self.get_mtimes(self.directories + self.expanded_directories) == self.mtimes:
+                return self.version
+            directories = set()
+            files = set()
+            for x in self.directories:
+                directories.add(x)
+                for root, subdir, file in os.walk(x, followlinks=True):
+                    directories.add(root)
+                    files.update(os.path.abspath(os.path.join(root, f)) for f in file)
+            self.expanded_directories = list(directories)
+            self.files = files
+            self.mtimes = self.get_mtimes(self.directories + self.expanded_directories)
+            self.version += 1
+            return self.version
+
+embedding_indexes = {}
+
+def get_embedding_index(embedding_directory):
     if isinstance(embedding_directory, str):
         embedding_directory = [embedding_directory]
+    key = tuple(embedding_directory)
+    index = embedding_indexes.get(key, None)
+    if index is None:
+        index = embedding_indexes.setdefault(key, EmbeddingIndex(list(embedding_directory)))
+    return index
 
-    embedding_directory = expand_directory_list(embedding_directory)
+def load_embed(embedding_name, embedding_directory, embedding_size, embed_key=None):
+    index = get_embedding_index(embedding_directory)
+    index.refresh()
 
     valid_file = None
-    for embed_dir in embedding_directory:
+    for embed_dir in index.expanded_directories:
         embed_path = os.path.abspath(os.path.join(embed_dir, embedding_name))
         embed_dir = os.path.abspath(embed_dir)
         try:
@@ -364,11 +448,11 @@ def load_embed(embedding_name, embedding_directory, embedding_size, embed_key=No
                 continue
         except:
             continue
-        if not os.path.isfile(embed_path):
+        if embed_path not in index.files:
             extensions = ['.safetensors', '.pt', '.bin']
             for x in extensions:
                 t = embed_path + x
-                if os.path.isfile(t):
+                if t in index.files:
                     valid_file = t
                     break
         else:
@@ -420,6 +504,10 @@ def load_embed(embedding_name, embedding_directory, embedding_size, embed_key=No
                 embed_out = next(iter(values))
     return embed_out
 
+# Number of words and prompts whose tokens each SDTokenizer keeps
+WORD_MEMO_SIZE = 16384
+PROMPT_MEMO_SIZE = 1024
+
 class SDTokenizer:
     def __init__(self, tokenizer_path=None, max_length=77, pad_with_end=True, embedding_directory=None, embedding_size=768, embedding_key='clip_l', tokenizer_class=CLIPTokenizer, has_start_token=True, has_end_token=True, pad_to_max_length=True, min_length=None, pad_token=None, end_token=None, tokenizer_data={}):
         if tokenizer_path is None:
@@ -464,6 +552,8 @@ class SDTokenizer:
         self.embedding_identifier = "embedding:"
         self.embedding_size = embedding_size
         self.embedding_key = embedding_key
+        self.word_memo = BoundedMemo(WORD_MEMO_SIZE)
+        self.prompt_memo = BoundedMemo(PROMPT_MEMO_SIZE)
 
     def _try_get_embedding(self, embedding_name:str):
         '''
@@ -482,6 +572,12 @@ class SDTokenizer:
         return (embed, leftover)
 
 
+    def tokenize_word(self, word):
+        end = 999999999999
+        if self.tokenizer_adds_end_token:
+            end = -1
+        return self.word_memo.get(word, lambda: tuple(self.tokenizer(word)["input_ids"][self.tokens_start:end]))
+
     def tokenize_with_weights(self, text:str, return_word_ids=False):
         '''
         Takes a prompt and converts it to a list of (token, weight, word id) elements.
@@ -489,7 +585,14 @@ class SDTokenizer:
         Word id values are unique per word and embedding, where the id 0 is reserved for non word tokens.
         Returned list has the dimensions NxM where M is the input size of CLIP
         '''
-
+        # Prompts naming embeddings are tokenized again when the embedding files change
+        embeddings_version = None
+        if self.embedding_directory is not None and self.embedding_identifier in text:
+            embeddings_version = get_embedding_index(self.embedding_directory).refresh()
+        batched_tokens = self.prompt_memo.get((text, return_word_ids, embeddings_version), lambda: self._tokenize_with_weights(text, return_word_ids))
+        return [list(x) for x in batched_tokens]
+
+    def _tokenize_with_weights(self, text, return_word_ids):
         text = escape_important(text)
         parsed_weights = token_weights(text, 1.0)
 
@@ -520,11 +623,8 @@ class SDTokenizer:
                         word = leftover
                     else:
                         continue
-                end = 999999999999
-                if self.tokenizer_adds_end_token:
-                    end = -1
                 #parse word
-                tokens.append([(t, weight) for t in self.tokenizer(word)["input_ids"][self.tokens_start:end]])
+                tokens.append([(t, weight) for t in self.tokenize_word(word)])
 
         #reshape token array to CLIP input size
         batched_tokens = []
@@ -635,5 +735,8 @@ class SD1ClipModel(torch.nn.Module):
         out = getattr(self, self.clip).encode_token_weights(token_weight_pairs)
         return out
 
+    def encode_token_weights_batch(self, token_weight_pairs_list):
+        return getattr(self, self.clip).encode_token_weights_batch([t[self.clip_name] for t in token_weight_pairs_list])
+
     def load_sd(self, sd):
         return getattr(self, self.clip).load_sd(sd)
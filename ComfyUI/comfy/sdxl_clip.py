@@ -62,6 +62,19 @@ class SDXLClipModel(torch.nn.Module):
         cut_to = min(l_out.shape[1], g_out.shape[1])
         return torch.cat([l_out[:,:cut_to], g_out[:,:cut_to]], dim=-1), g_pooled
 
+    def encode_token_weights_batch(self, token_weight_pairs_list):
+        g_results = self.clip_g.encode_token_weights_batch([t["g"] for t in token_weight_pairs_list])
+        l_results = self.clip_l.encode_token_weights_batch([t["l"] for t in token_weight_pairs_list])
+        results = []
+        for g_res, l_res in zip(g_results, l_results):
+            # Same output as encode_token_weights: SDXL is conditioned on the pooled output of
+            # clip_g only, and the extra outputs of the encoders aren't used by either model
+            g_out, g_pooled, *_ = g_res
+            l_out = l_res[0]
+            cut_to = min(l_out.shape[1], g_out.shape[1])
+            results.append((torch.cat([l_out[:,:cut_to], g_out[:,:cut_to]], dim=-1), g_pooled))
+        return results
+
     def load_sd(self, sd):
         if "text_model.encoder.layers.30.mlp.fc1.weight" in sd:
             return self.clip_g.load_sd(sd)
@@ -70,6 +70,31 @@ def load_torch_file(ckpt, safe_load=False, device=None):
                 sd = pl_sd
     return sd
 
+def load_state_dict(module, sd, strict=False):
+    """
+    module.load_state_dict that makes the parameters and buffers the module keeps on the CPU use
+    the tensors of sd when they already have the right dtype and shape, instead of copying them.
+    Tensors loaded from safetensors files are memory mapped, so the weights are then read from the
+    page cache when first used instead of being copied into newly allocated memory at load time.
+    """
+    assigned = set()
+    for k, v in module.state_dict(keep_vars=True).items():
+        t = sd.get(k, None)
+        if t is None or t is v or not torch.is_tensor(t):
+            continue
+        if v.device.type == "cpu" and t.device.type == "cpu" and v.dtype == t.dtype and v.shape == t.shape and t.is_contiguous():
+            # Set through .data so parameters shared by several modules stay shared
+            v.data = t
+            assigned.add(k)
+
+    if len(assigned) > 0:
+        sd = {k: t for k, t in sd.items() if k not in assigned}
+    result = module.load_state_dict(sd, strict=False)
+    result.missing_keys[:] = [k for k in result.missing_keys if k not in assigned]
+    if strict and (len(result.missing_keys) > 0 or len(result.unexpected_keys) > 0):
+        raise RuntimeError("Error(s) in loading state_dict for {}: missing keys {}, unexpected keys {}".format(module.__class__.__name__, result.missing_keys, result.unexpected_keys))
+    return result
+
 def save_torch_file(sd, ckpt, metadata=None):
     if metadata is not None:
         safetensors.torch.save_file(sd, ckpt, metadata=metadata)
@@ -0,0 +1,151 @@
+import uuid
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+
+import torch
+
+import comfy.model_management
+from comfy.cli_args import args
+
+# Identifies the weights of a model, keyed by the torch module so clones of a ModelPatcher share it
+model_ids = weakref.WeakKeyDictionary()
+
+# Digests of the patch tensors by id(), dropped when the tensor is freed
+tensor_digests = {}
+tensor_digests_lock = threading.Lock()
+
+# Larger patch tensors, e.g. the weights of a merged model, are identified by the tensor object instead of hashed
+MAX_HASHED_TENSOR_BYTES = 64 * 1024 * 1024
+
+class Uncacheable(Exception):
+    pass
+
+def get_tensor_digest(tensor):
+    """
+    Returns the sha256 of the content of a tensor, computed once for each tensor object, or a
+    random id for tensors above MAX_HASHED_TENSOR_BYTES.
+    """
+    digest = tensor_digests.get(id(tensor), None)
+    if digest is not None:
+        return digest
+    if tensor.nelement() * tensor.element_size() > MAX_HASHED_TENSOR_BYTES:
+        digest = (str(tensor.dtype), tuple(tensor.shape), uuid.uuid4().hex)
+    else:
+        value = tensor.detach().to("cpu").contiguous()
+        digest = (str(value.dtype), tuple(value.shape), hashlib.sha256(memoryview(value.reshape(-1).view(torch.uint8).numpy())).hexdigest())
+    with tensor_digests_lock:
+        tensor_digests[id(tensor)] = digest
+    weakref.finalize(tensor, tensor_digests.pop, id(tensor), None)
+    return digest
+
+def freeze_patch(value, tensor_key=get_tensor_digest):
+    if torch.is_tensor(value):
+        return tensor_key(value)
+    if isinstance(value, (int, float, str, bool, type(None))):
+        return value
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze_patch(v, tensor_key) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze_patch(v, tensor_key)) for k, v in value.items()))
+    # Functions, e.g. the convert functions of model patches, can't be compared
+    raise Uncacheable()
+
+def freeze_patches(patches, tensor_key=get_tensor_digest):
+    return tuple((p[0], freeze_patch(p[1], tensor_key), p[2], freeze_patch(p[3], tensor_key), freeze_patch(p[4], tensor_key)) for p in patches)
+
+def get_patch_set_key(patcher):
+    """
+    Returns a key identifying the content and strengths of all the patches of patcher, or its
+    patches_uuid when they can't be compared.
+    """
+    try:
+        return hash(tuple((k, freeze_patches(patcher.patches[k])) for k in sorted(patcher.patches)))
+    except Uncacheable:
+        return patcher.patches_uuid
+
+def get_patch_set_id(patcher):
+    """
+    Returns a key identifying the patches of patcher by their tensor objects and strengths, or its
+    patches_uuid when they can't be compared. Unlike get_patch_set_key nothing is hashed, so a
+    LoRA loaded again from its file gets a new id.
+    """
+    try:
+        return hash(tuple((k, freeze_patches(patcher.patches[k], tensor_key=id)) for k in sorted(patcher.patches)))
+    except Uncacheable:
+        return patcher.patches_uuid
+
+def get_key(patcher, key, weight):
+    """
+    Returns the key of the weight of key in the model of patcher with its patches merged: the
+    model, the name and dtype of the weight and the content and strengths of its patches. Returns
+    None when the patches can't be compared or the cache is disabled.
+    """
+    if cache.max_bytes <= 0:
+        return None
+    model_id = model_ids.get(patcher.model, None)
+    if model_id is None:
+        model_id = uuid.uuid4()
+        model_ids[patcher.model] = model_id
+    try:
+        patches = freeze_patches(patcher.patches[key])
+    except Uncacheable:
+        return None
+    return (model_id, key, tuple(weight.shape), str(weight.dtype), patches)
+
+class PatchedWeightCache:
+    """
+    Weights with their LoRAs and other patches merged, stored in offload memory, so loading a model
+    with a set of patches it was loaded with before copies the merged weights instead of merging
+    them again. The least recently used weights are dropped above max_bytes and, like cached node
+    outputs, when free_memory needs room on the device they are stored on.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        comfy.model_management.register_output_cache(self)
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self.lock:
+            weight = self.entries.get(key, None)
+            if weight is None:
+                return None
+            self.entries.move_to_end(key)
+            return weight
+
+    def put(self, key, weight):
+        if key is None:
+            return
+        size = weight.nelement() * weight.element_size()
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = weight
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def free_memory(self, memory_required, device):
+        with self.lock:
+            for key in [key for key, weight in self.entries.items() if weight.device == device]:
+                if comfy.model_management.get_free_memory(device) > memory_required:
+                    break
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def _remove(self, key):
+        weight = self.entries.pop(key, None)
+        if weight is not None:
+            self.total_bytes -= weight.nelement() * weight.element_size()
+
+cache = PatchedWeightCache(int(args.patched_weight_cache_size * 1024 * 1024))
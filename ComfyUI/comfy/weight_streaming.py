@@ -0,0 +1,162 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+import comfy.model_management
+from comfy.cli_args import args
+
+# Offsets of the tensors packed in a staging buffer are aligned to this many bytes
+STAGING_ALIGNMENT = 64
+
+copy_executor = None
+copy_streams = {}
+lock = threading.Lock()
+
+def get_copy_executor():
+    global copy_executor
+    with lock:
+        if copy_executor is None:
+            copy_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="weight_stream")
+        return copy_executor
+
+def get_copy_stream(device):
+    with lock:
+        stream = copy_streams.get(device, None)
+        if stream is None:
+            stream = torch.cuda.Stream(device)
+            copy_streams[device] = stream
+        return stream
+
+def create_weight_streamer(device):
+    """Returns a WeightStreamer for the lowvram modules of a model loaded to device, or None if streaming is disabled."""
+    if args.lowvram_stream_window <= 0 or device is None:
+        return None
+    if not comfy.model_management.is_device_cuda(device):
+        return None
+    return WeightStreamer(device, window=args.lowvram_stream_window)
+
+class StagingBuffer:
+    """Pinned host memory the weights of a module are copied through, reused once its last copy to the device finished."""
+    def __init__(self):
+        self.buffer = None
+        self.event = None
+
+    def stage(self, tensors):
+        if self.event is not None:
+            self.event.synchronize()
+            self.event = None
+
+        sizes = []
+        total = 0
+        for t in tensors:
+            sizes.append((total, t.nelement() * t.element_size()))
+            total += -(-sizes[-1][1] // STAGING_ALIGNMENT) * STAGING_ALIGNMENT
+        if self.buffer is None or self.buffer.nelement() < total:
+            self.buffer = None
+            self.buffer = torch.empty(total, dtype=torch.uint8, pin_memory=True)
+
+        staged = []
+        for t, (offset, size) in zip(tensors, sizes):
+            s = self.buffer[offset:offset + size].view(t.dtype).view(t.shape)
+            s.copy_(t)
+            staged.append(s)
+        return staged
+
+class WeightStreamer:
+    """
+    Copies the weights of lowvram modules to the device ahead of their use, so the copies overlap
+    with the computation of the modules before them instead of stalling it.
+
+    The order the modules are used in is recorded during the first pass through the model, until
+    the first module is used again. On later passes, each module that casts its weights queues the
+    copies of the next window modules in that order on a background thread. On CUDA the weights go
+    through pinned staging buffers and are copied on a side stream the compute stream waits on.
+    """
+    def __init__(self, device, window=2):
+        self.device = device
+        self.window = window
+        self.order = []
+        self.positions = {}
+        self.recording = True
+        self.pending = {}
+        self.staging = [StagingBuffer() for _ in range(window + 1)]
+        self.next_staging = 0
+
+    def reset(self):
+        """Forgets the recorded order, for when the set of lowvram modules changed."""
+        self.order = []
+        self.positions = {}
+        self.recording = True
+        self.pending = {}
+
+    def copy(self, module, dtype, bias_dtype, staging=None):
+        """Copies the weight and bias of a module to the device, returns them with the event to wait for before using them."""
+        tensors = [module.weight]
+        dtypes = [dtype]
+        if module.bias is not None:
+            tensors.append(module.bias)
+            dtypes.append(bias_dtype)
+
+        event = None
+        if comfy.model_management.is_device_cuda(self.device) and all(t.device.type == "cpu" for t in tensors):
+            stream = get_copy_stream(self.device)
+            if staging is not None and not all(t.is_pinned() for t in tensors):
+                tensors = staging.stage(tensors)
+            with torch.cuda.stream(stream):
+                out = [comfy.model_management.cast_to(t, d, self.device, non_blocking=True, copy=True) for t, d in zip(tensors, dtypes)]
+                event = torch.cuda.Event()
+                event.record(stream)
+            if staging is not None:
+                staging.event = event
+        else:
+            out = [comfy.model_management.cast_to(t, d, self.device, copy=True) for t, d in zip(tensors, dtypes)]
+
+        if module.bias is None:
+            out.append(None)
+        return out[0], out[1], event
+
+    def prefetch(self, position, dtype, bias_dtype):
+        for module in self.order[position + 1:position + 1 + self.window]:
+            key = id(module)
+            if key in self.pending:
+                continue
+            staging = self.staging[self.next_staging]
+            self.next_staging = (self.next_staging + 1) % len(self.staging)
+            self.pending[key] = (dtype, bias_dtype, get_copy_executor().submit(self.copy, module, dtype, bias_dtype, staging))
+
+    def get(self, module, dtype, bias_dtype):
+        """Returns copies of the weight and bias of module on the device, usable on the current stream."""
+        key = id(module)
+        position = self.positions.get(key, None)
+        if self.recording:
+            if position is None:
+                self.positions[key] = len(self.order)
+                self.order.append(module)
+            elif position == 0:
+                self.recording = False
+
+        result = None
+        pending = self.pending.pop(key, None)
+        if pending is not None and pending[0] == dtype and pending[1] == bias_dtype:
+            result = pending[2].result()
+
+        if not self.recording and position is not None:
+            # Copies queued for modules that were skipped on this pass would hold device memory until the next one
+            window = set(id(m) for m in self.order[position + 1:position + 1 + self.window])
+            for k in [k for k in self.pending if k not in window]:
+                self.pending.pop(k)
+            self.prefetch(position, dtype, bias_dtype)
+
+        if result is None:
+            result = self.copy(module, dtype, bias_dtype)
+
+        weight, bias, event = result
+        if event is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(event)
+            # Allocated on the copy stream, the allocator must not reuse them before the compute stream is done with them
+            weight.record_stream(stream)
+            if bias is not None:
+                bias.record_stream(stream)
+        return weight, bias
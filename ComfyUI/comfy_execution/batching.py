@@ -0,0 +1,118 @@
+import hashlib
+import json
+
+from comfy_execution.graph_utils import is_link
+
+# Inputs that may differ between prompts run as a single batch
+BATCH_INPUTS = {
+    "CLIPTextEncode": ("text",),
+    "KSampler": ("seed",),
+    "LoadImage": ("image",),
+    "LoadImageMask": ("image",),
+    "LoadImageBase64": ("image",),
+    "LoadImageMaskBase64": ("image",),
+    "LoadImageFromMemory": ("key",),
+    "LoadImageMaskFromMemory": ("key",),
+}
+
+# Inputs of a KSampler taken from every prompt of the batch, the others are shared
+SAMPLER_BATCH_INPUTS = ("positive", "negative", "latent_image", "seed")
+
+def get_batch_signature(prompt):
+    """
+    Returns a hash that is equal for prompts that only differ in their BATCH_INPUTS, or None
+    if the prompt has no KSampler to batch.
+    """
+    if not any(node["class_type"] == "KSampler" for node in prompt.values()):
+        return None
+
+    masked = {}
+    for node_id, node in prompt.items():
+        inputs = dict(node["inputs"])
+        for name in BATCH_INPUTS.get(node["class_type"], ()):
+            if name in inputs and not is_link(inputs[name]):
+                inputs[name] = None
+        masked[node_id] = {"class_type": node["class_type"], "inputs": inputs}
+
+    try:
+        signature = json.dumps(masked, sort_keys=True)
+    except TypeError:
+        return None
+    return hashlib.sha256(signature.encode()).hexdigest()
+
+def get_varying_nodes(prompts):
+    """Returns the ids of the nodes whose inputs differ between the prompts and of every node using their outputs."""
+    first = prompts[0]
+    varying = {}
+
+    def is_varying(node_id):
+        if node_id in varying:
+            return varying[node_id]
+        varying[node_id] = False
+        for name, value in first[node_id]["inputs"].items():
+            if is_link(value):
+                if is_varying(value[0]):
+                    varying[node_id] = True
+            elif any(prompt[node_id]["inputs"].get(name) != value for prompt in prompts[1:]):
+                varying[node_id] = True
+        return varying[node_id]
+
+    return set(node_id for node_id in first if is_varying(node_id))
+
+def merge_prompts(prompts):
+    """
+    Merges prompts with the same batch signature into a single prompt. Nodes that are the same
+    in every prompt are kept once, the others are copied for each prompt with the id
+    "<node_id>#<index>". Every KSampler that has to be copied is replaced by a single
+    KSamplerPromptBatch node that samples all the prompts at once, and a PromptBatchSelect
+    node per prompt with the copied id that outputs its latent.
+
+    Returns the merged prompt and, for each prompt, a dict mapping its node ids to the ids in
+    the merged prompt, or None if the prompts can't be merged.
+    """
+    first = prompts[0]
+    if any(prompt.keys() != first.keys() for prompt in prompts[1:]):
+        return None
+
+    varying = get_varying_nodes(prompts)
+    node_ids = []
+    for index in range(len(prompts)):
+        node_ids.append({node_id: "{}#{}".format(node_id, index) if node_id in varying else node_id for node_id in first})
+
+    def relink(inputs, ids):
+        return {name: [ids[value[0]], value[1]] if is_link(value) else value for name, value in inputs.items()}
+
+    merged = {}
+    for node_id, node in first.items():
+        if node_id not in varying:
+            merged[node_id] = node
+            continue
+
+        if node["class_type"] != "KSampler":
+            for prompt, ids in zip(prompts, node_ids):
+                merged[ids[node_id]] = {"class_type": prompt[node_id]["class_type"], "inputs": relink(prompt[node_id]["inputs"], ids)}
+            continue
+
+        batch = None
+        shared_inputs = None
+        for index, (prompt, ids) in enumerate(zip(prompts, node_ids)):
+            inputs = relink(prompt[node_id]["inputs"], ids)
+            gather_inputs = {name: inputs.pop(name) for name in SAMPLER_BATCH_INPUTS}
+            if shared_inputs is None:
+                shared_inputs = inputs
+            elif inputs != shared_inputs:
+                # The model or a sampling setting differs between the prompts
+                return None
+
+            if batch is not None:
+                gather_inputs["batch"] = batch
+            gather_id = "{}#gather{}".format(node_id, index)
+            merged[gather_id] = {"class_type": "PromptBatchGather", "inputs": gather_inputs}
+            batch = [gather_id, 0]
+
+        sample_id = "{}#sample".format(node_id)
+        merged[sample_id] = {"class_type": "KSamplerPromptBatch", "inputs": dict(shared_inputs, batch=batch)}
+        for index, ids in enumerate(node_ids):
+            merged[ids[node_id]] = {"class_type": "PromptBatchSelect", "inputs": {"samples": [sample_id, 0], "index": index}}
+
+    return merged, node_ids
@@ -1,8 +1,13 @@
+import heapq
+import hashlib
 import itertools
+import weakref
 from typing import Sequence, Mapping, Dict
 from comfy_execution.graph import DynamicPrompt
 
+import torch
 import nodes
+import comfy.model_management
 
 from comfy_execution.graph_utils import is_link
 
@@ -72,6 +77,32 @@ class CacheKeySetID(CacheKeySet):
             self.keys[node_id] = (node_id, node["class_type"])
             self.subcache_keys[node_id] = (node_id, node["class_type"])
 
+def encode_signature(obj, parts):
+    """
+    Appends an encoding of a signature made of plain values, mappings and sequences to parts,
+    raises TypeError for anything else or NaN, which never compares equal.
+    """
+    if isinstance(obj, float) and obj != obj:
+        raise TypeError("NaN")
+    if isinstance(obj, (int, float, str, bool, bytes, type(None))):
+        parts.append("{}:{!r}".format(type(obj).__name__, obj))
+    elif isinstance(obj, Mapping):
+        parts.append("{")
+        for k, v in sorted(obj.items()):
+            encode_signature(k, parts)
+            encode_signature(v, parts)
+        parts.append("}")
+    elif isinstance(obj, Sequence):
+        parts.append("[")
+        for v in obj:
+            encode_signature(v, parts)
+        parts.append("]")
+    else:
+        raise TypeError(type(obj).__name__)
+
+# Node signatures of the prompts being executed, shared by all the caches of a prompt
+NODE_SIGNATURES = weakref.WeakKeyDictionary()
+
 class CacheKeySetInputSignature(CacheKeySet):
     def __init__(self, dynprompt, node_ids, is_changed_cache):
         super().__init__(dynprompt, node_ids, is_changed_cache)
@@ -92,18 +123,36 @@ class CacheKeySetInputSignature(CacheKeySet):
             self.keys[node_id] = self.get_node_signature(self.dynprompt, node_id)
             self.subcache_keys[node_id] = (node_id, node["class_type"])
 
+    # The signature of a node is a digest of its own inputs and of the signatures of the nodes
+    # it is linked to, so it is computed once per node and prompt no matter how deep the graph
+    # is. Nodes whose inputs can't be hashed get an Unhashable signature, as do the nodes using
+    # their outputs, so they are never found in the cache of another prompt.
     def get_node_signature(self, dynprompt, node_id):
-        signature = []
-        ancestors, order_mapping = self.get_ordered_ancestry(dynprompt, node_id)
-        signature.append(self.get_immediate_node_signature(dynprompt, node_id, order_mapping))
-        for ancestor_id in ancestors:
-            signature.append(self.get_immediate_node_signature(dynprompt, ancestor_id, order_mapping))
-        return to_hashable(signature)
-
-    def get_immediate_node_signature(self, dynprompt, node_id, ancestor_order_mapping):
-        if not dynprompt.has_node(node_id):
-            # This node doesn't exist -- we can't cache it.
-            return [float("NaN")]
+        signatures = NODE_SIGNATURES.setdefault(dynprompt, {})
+        stack = [node_id]
+        visiting = set(stack)
+        while len(stack) > 0:
+            current = stack[-1]
+            if current in signatures:
+                stack.pop()
+                continue
+            if not dynprompt.has_node(current):
+                # This node doesn't exist -- we can't cache it.
+                signatures[current] = Unhashable()
+                stack.pop()
+                continue
+
+            inputs = dynprompt.get_node(current)["inputs"]
+            missing = [x[0] for x in inputs.values() if is_link(x) and x[0] not in signatures and x[0] not in visiting]
+            if len(missing) > 0:
+                visiting.update(missing)
+                stack.extend(missing)
+                continue
+            signatures[current] = self.get_immediate_node_signature(dynprompt, current, signatures)
+            stack.pop()
+        return signatures[node_id]
+
+    def get_immediate_node_signature(self, dynprompt, node_id, signatures):
         node = dynprompt.get_node(node_id)
         class_type = node["class_type"]
         class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
@@ -114,36 +163,25 @@ class CacheKeySetInputSignature(CacheKeySet):
         for key in sorted(inputs.keys()):
             if is_link(inputs[key]):
                 (ancestor_id, ancestor_socket) = inputs[key]
-                ancestor_index = ancestor_order_mapping[ancestor_id]
-                signature.append((key,("ANCESTOR", ancestor_index, ancestor_socket)))
+                ancestor_signature = signatures.get(ancestor_id, None)
+                if not isinstance(ancestor_signature, str):
+                    # The ancestor can't be cached or is part of a cycle
+                    return Unhashable()
+                signature.append((key, ("ANCESTOR", ancestor_signature, ancestor_socket)))
             else:
                 signature.append((key, inputs[key]))
-        return signature
-
-    # This function returns a list of all ancestors of the given node. The order of the list is
-    # deterministic based on which specific inputs the ancestor is connected by.
-    def get_ordered_ancestry(self, dynprompt, node_id):
-        ancestors = []
-        order_mapping = {}
-        self.get_ordered_ancestry_internal(dynprompt, node_id, ancestors, order_mapping)
-        return ancestors, order_mapping
-
-    def get_ordered_ancestry_internal(self, dynprompt, node_id, ancestors, order_mapping):
-        if not dynprompt.has_node(node_id):
-            return
-        inputs = dynprompt.get_node(node_id)["inputs"]
-        input_keys = sorted(inputs.keys())
-        for key in input_keys:
-            if is_link(inputs[key]):
-                ancestor_id = inputs[key][0]
-                if ancestor_id not in order_mapping:
-                    ancestors.append(ancestor_id)
-                    order_mapping[ancestor_id] = len(ancestors) - 1
-                    self.get_ordered_ancestry_internal(dynprompt, ancestor_id, ancestors, order_mapping)
+
+        parts = []
+        try:
+            encode_signature(signature, parts)
+        except TypeError:
+            return Unhashable()
+        return hashlib.sha256("".join(parts).encode()).hexdigest()
 
 class BasicCache:
-    def __init__(self, key_class):
+    def __init__(self, key_class, persistent_cache=None):
         self.key_class = key_class
+        self.persistent_cache = persistent_cache
         self.initialized = False
         self.dynprompt: DynamicPrompt
         self.cache_key_set: CacheKeySet
@@ -191,6 +229,8 @@ class BasicCache:
         assert self.initialized
         cache_key = self.cache_key_set.get_data_key(node_id)
         self.cache[cache_key] = value
+        if self.persistent_cache is not None:
+            self.persistent_cache.set(cache_key, self.dynprompt.get_node(node_id), value)
 
     def _get_immediate(self, node_id):
         if not self.initialized:
@@ -198,6 +238,11 @@ class BasicCache:
         cache_key = self.cache_key_set.get_data_key(node_id)
         if cache_key in self.cache:
             return self.cache[cache_key]
+        elif self.persistent_cache is not None and cache_key is not None:
+            value = self.persistent_cache.get(cache_key)
+            if value is not None:
+                self.cache[cache_key] = value
+            return value
         else:
             return None
 
@@ -205,7 +250,7 @@ class BasicCache:
         subcache_key = self.cache_key_set.get_subcache_key(node_id)
         subcache = self.subcaches.get(subcache_key, None)
         if subcache is None:
-            subcache = BasicCache(self.key_class)
+            subcache = BasicCache(self.key_class, self.persistent_cache)
             self.subcaches[subcache_key] = subcache
         subcache.set_prompt(self.dynprompt, children_ids, self.is_changed_cache)
         return subcache
@@ -227,8 +272,8 @@ class BasicCache:
         return result
 
 class HierarchicalCache(BasicCache):
-    def __init__(self, key_class):
-        super().__init__(key_class)
+    def __init__(self, key_class, persistent_cache=None):
+        super().__init__(key_class, persistent_cache)
 
     def _get_cache_for(self, node_id):
         assert self.dynprompt is not None
@@ -264,14 +309,58 @@ class HierarchicalCache(BasicCache):
         assert cache is not None
         return cache._ensure_subcache(node_id, children_ids)
 
+def get_output_size(value):
+    """
+    Returns the bytes of the tensors held by a cached output per device and the models it
+    references by id, with their size. Tensors sharing storage are counted once.
+    """
+    storages = {}
+    models = {}
+
+    def visit(obj):
+        if isinstance(obj, torch.Tensor):
+            storage = obj.untyped_storage()
+            storages[(str(obj.device), storage.data_ptr())] = storage.nbytes()
+        elif isinstance(obj, (list, tuple)):
+            for x in obj:
+                visit(x)
+        elif isinstance(obj, dict):
+            for x in obj.values():
+                visit(x)
+        elif callable(getattr(obj, "model_size", None)):
+            # ModelPatcher, clones share the same model
+            models[id(obj.model)] = obj.model_size()
+        elif hasattr(obj, "patcher"):
+            # CLIP, VAE
+            visit(obj.patcher)
+
+    visit(value)
+    device_bytes = {}
+    for (device, data_ptr), size in storages.items():
+        device_bytes[device] = device_bytes.get(device, 0) + size
+    return device_bytes, models
+
 class LRUCache(BasicCache):
-    def __init__(self, key_class, max_size=100):
-        super().__init__(key_class)
+    """
+    Keeps the outputs of the last prompts until there are more than max_size of them or they
+    hold more than max_bytes of tensors and models, then drops the least recently used ones.
+    Outputs of the running prompt are never dropped.
+    """
+    def __init__(self, key_class, max_size=100, max_bytes=None, persistent_cache=None):
+        super().__init__(key_class, persistent_cache)
         self.max_size = max_size
-        self.min_generation = 0
+        self.max_bytes = max_bytes
         self.generation = 0
         self.used_generation = {}
         self.children = {}
+        # (generation, counter, key) for every use, entries for older uses are skipped
+        self.usage_heap = []
+        self.usage_counter = itertools.count()
+        self.sizes = {}
+        self.tensor_bytes = 0
+        # id(model) -> [size, number of outputs referencing it]
+        self.models = {}
+        comfy.model_management.register_output_cache(self)
 
     def set_prompt(self, dynprompt, node_ids, is_changed_cache):
         super().set_prompt(dynprompt, node_ids, is_changed_cache)
@@ -279,29 +368,84 @@ class LRUCache(BasicCache):
         for node_id in node_ids:
             self._mark_used(node_id)
 
+    def total_bytes(self):
+        return self.tensor_bytes + sum(size for size, references in self.models.values())
+
+    def _is_full(self):
+        if len(self.cache) > self.max_size:
+            return True
+        return self.max_bytes is not None and self.total_bytes() > self.max_bytes
+
     def clean_unused(self):
-        while len(self.cache) > self.max_size and self.min_generation < self.generation:
-            self.min_generation += 1
-            to_remove = [key for key in self.cache if self.used_generation[key] < self.min_generation]
-            for key in to_remove:
-                del self.cache[key]
-                del self.used_generation[key]
-                if key in self.children:
-                    del self.children[key]
+        self._evict()
         self._clean_subcaches()
 
+    def _evict(self):
+        while len(self.usage_heap) > 0 and self._is_full():
+            generation, _, key = self.usage_heap[0]
+            if generation >= self.generation:
+                break
+            heapq.heappop(self.usage_heap)
+            if self.used_generation.get(key, None) == generation:
+                self._remove(key)
+
+    def free_memory(self, memory_required, device):
+        """Drops outputs of earlier prompts holding tensors on device, least recently used first."""
+        keys = [key for key, (device_bytes, models) in self.sizes.items() if device_bytes.get(str(device), 0) > 0]
+        for key in sorted(keys, key=lambda key: self.used_generation.get(key, 0)):
+            if self.used_generation.get(key, 0) >= self.generation or comfy.model_management.get_free_memory(device) > memory_required:
+                break
+            self._remove(key)
+
+    def _remove(self, key):
+        self.cache.pop(key, None)
+        self.used_generation.pop(key, None)
+        self.children.pop(key, None)
+        self._remove_size(key)
+
+    def _add_size(self, key, value):
+        device_bytes, models = get_output_size(value)
+        self.sizes[key] = (device_bytes, models)
+        self.tensor_bytes += sum(device_bytes.values())
+        for model_id, size in models.items():
+            self.models.setdefault(model_id, [size, 0])[1] += 1
+
+    def _remove_size(self, key):
+        if key not in self.sizes:
+            return
+        device_bytes, models = self.sizes.pop(key)
+        self.tensor_bytes -= sum(device_bytes.values())
+        for model_id in models:
+            self.models[model_id][1] -= 1
+            if self.models[model_id][1] == 0:
+                del self.models[model_id]
+
     def get(self, node_id):
         self._mark_used(node_id)
-        return self._get_immediate(node_id)
+        value = self._get_immediate(node_id)
+        cache_key = self.cache_key_set.get_data_key(node_id)
+        if value is not None and cache_key not in self.sizes:
+            # Read from the persistent cache
+            self._add_size(cache_key, value)
+        return value
 
     def _mark_used(self, node_id):
         cache_key = self.cache_key_set.get_data_key(node_id)
         if cache_key is not None:
             self.used_generation[cache_key] = self.generation
+            heapq.heappush(self.usage_heap, (self.generation, next(self.usage_counter), cache_key))
+            if len(self.usage_heap) > 2 * len(self.used_generation) + 100:
+                self.usage_heap = [(generation, next(self.usage_counter), key) for key, generation in self.used_generation.items()]
+                heapq.heapify(self.usage_heap)
 
     def set(self, node_id, value):
         self._mark_used(node_id)
-        return self._set_immediate(node_id, value)
+        cache_key = self.cache_key_set.get_data_key(node_id)
+        self._remove_size(cache_key)
+        self._add_size(cache_key, value)
+        self._set_immediate(node_id, value)
+        # Makes room right away so the outputs of earlier prompts don't pile up on top of new ones
+        self._evict()
 
     def ensure_subcache_for(self, node_id, children_ids):
         # Just uses subcaches for tracking 'live' nodes
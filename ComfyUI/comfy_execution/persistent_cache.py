@@ -0,0 +1,192 @@
+import os
+import json
+import math
+import uuid
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import safetensors
+import safetensors.torch
+
+import nodes
+import comfyui_version
+import comfy.model_management
+from comfy_execution.caching import Unhashable
+from comfy_execution.graph_utils import is_link
+
+# Outputs of nodes that only return these types are stored
+PERSISTENT_TYPES = {"CONDITIONING", "LATENT", "IMAGE", "MASK"}
+
+# Number of cache key digests kept in memory
+MAX_DIGESTS = 10000
+
+class NotPersistable(Exception):
+    pass
+
+def stable_digest(cache_key):
+    """
+    Returns a digest of a cache key that is the same in every process, unlike hash() which is
+    salted per process, and changes with the ComfyUI version.
+    """
+    def encode(obj):
+        if isinstance(obj, Unhashable) or (isinstance(obj, float) and not math.isfinite(obj)):
+            raise NotPersistable()
+        if isinstance(obj, (int, float, str, bool, type(None))):
+            return "{}:{!r}".format(type(obj).__name__, obj)
+        if isinstance(obj, frozenset):
+            return "{" + ",".join(sorted(encode(x) for x in obj)) + "}"
+        if isinstance(obj, (tuple, list)):
+            return "(" + ",".join(encode(x) for x in obj) + ")"
+        raise NotPersistable()
+
+    data = "{};{}".format(comfyui_version.__version__, encode(cache_key))
+    return hashlib.sha256(data.encode()).hexdigest()
+
+def flatten(value, tensors):
+    """Splits a node output into a JSON structure and the tensors it references."""
+    if torch.is_tensor(value):
+        name = str(len(tensors))
+        # Copied so tensors sharing memory can be saved together
+        tensors[name] = value.detach().to("cpu", copy=True).contiguous()
+        return {"tensor": name, "dtype": str(value.dtype), "device": value.device.type}
+    if isinstance(value, (int, float, str, bool, type(None))):
+        return value
+    if isinstance(value, dict) and all(isinstance(k, str) for k in value):
+        return {"dict": {k: flatten(v, tensors) for k, v in value.items()}}
+    if isinstance(value, list):
+        return {"list": [flatten(v, tensors) for v in value]}
+    if isinstance(value, tuple):
+        return {"tuple": [flatten(v, tensors) for v in value]}
+    raise NotPersistable()
+
+def unflatten(structure, tensors):
+    if not isinstance(structure, dict):
+        return structure
+    if "tensor" in structure:
+        tensor = tensors[structure["tensor"]]
+        if str(tensor.dtype) != structure["dtype"]:
+            raise ValueError("tensor {} is {}, expected {}".format(structure["tensor"], tensor.dtype, structure["dtype"]))
+        # Outputs that were on a device are returned where node outputs are kept
+        if structure["device"] != "cpu":
+            tensor = tensor.to(comfy.model_management.intermediate_device())
+        return tensor
+    if "dict" in structure:
+        return {k: unflatten(v, tensors) for k, v in structure["dict"].items()}
+    if "list" in structure:
+        return [unflatten(v, tensors) for v in structure["list"]]
+    return tuple(unflatten(v, tensors) for v in structure["tuple"])
+
+class PersistentCache:
+    """
+    Second tier for the output caches, storing node outputs as safetensors files in a directory
+    that outlives the process and can be shared with other processes, e.g. under /dev/shm or on
+    a network volume. Files are named after the stable digest of the input signature and the
+    least recently used ones are removed when the directory grows over max_size bytes.
+
+    Outputs are written on a background thread, tensors are memory mapped when read back.
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.digests = {}
+        self.lock = threading.Lock()
+        self.write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistent_cache")
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(size for path, size, mtime in self.list_files())
+
+    def list_files(self):
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(".safetensors"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    files.append((entry.path, stat.st_size, stat.st_mtime))
+        return files
+
+    def get_path(self, cache_key):
+        digest = self.digests.get(cache_key, None)
+        if digest is None:
+            try:
+                digest = stable_digest(cache_key)
+            except NotPersistable:
+                digest = ""
+            if len(self.digests) >= MAX_DIGESTS:
+                self.digests.clear()
+            self.digests[cache_key] = digest
+        if digest == "":
+            return None
+        return os.path.join(self.directory, digest + ".safetensors")
+
+    def is_persistable(self, node):
+        # Nodes without linked inputs only load or create data, that is as fast as reading it back
+        if not any(is_link(value) for value in node["inputs"].values()):
+            return False
+        class_def = nodes.NODE_CLASS_MAPPINGS[node["class_type"]]
+        return_types = getattr(class_def, "RETURN_TYPES", ())
+        return len(return_types) > 0 and all(t in PERSISTENT_TYPES for t in return_types)
+
+    def get(self, cache_key):
+        path = self.get_path(cache_key)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with safetensors.safe_open(path, framework="pt") as f:
+                structure = json.loads(f.metadata()["structure"])
+                tensors = {k: f.get_tensor(k) for k in f.keys()}
+            value = unflatten(structure, tensors)
+            os.utime(path)
+        except Exception as e:
+            logging.warning("Could not read persistent cache file {}: {}".format(path, e))
+            return None
+        return value
+
+    def set(self, cache_key, node, value):
+        if not self.is_persistable(node):
+            return
+        path = self.get_path(cache_key)
+        if path is None or os.path.exists(path):
+            return
+        self.write_executor.submit(self.write, path, value)
+
+    def write(self, path, value):
+        try:
+            tensors = {}
+            structure = flatten(value, tensors)
+        except NotPersistable:
+            return
+
+        temp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        try:
+            safetensors.torch.save_file(tensors, temp_path, metadata={"structure": json.dumps(structure)})
+            size = os.path.getsize(temp_path)
+            # Atomic so other processes never read a partially written file
+            os.replace(temp_path, path)
+        except Exception as e:
+            logging.warning("Could not write persistent cache file {}: {}".format(path, e))
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+
+        with self.lock:
+            self.size += size
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        # Rescanned since other processes may be writing to the same directory
+        files = sorted(self.list_files(), key=lambda f: f[2])
+        self.size = sum(size for path, size, mtime in files)
+        for path, size, mtime in files:
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
@@ -0,0 +1,109 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+import psutil
+
+import folder_paths
+
+# Inputs naming model files and the folder they are loaded from
+MODEL_FOLDERS = {
+    "ckpt_name": "checkpoints",
+    "unet_name": "diffusion_models",
+    "vae_name": "vae",
+    "lora_name": "loras",
+    "clip_name": "text_encoders",
+    "clip_name1": "text_encoders",
+    "clip_name2": "text_encoders",
+    "clip_name3": "text_encoders",
+    "control_net_name": "controlnet",
+    "style_model_name": "style_models",
+    "upscale_model_name": "upscale_models",
+    "hypernetwork_name": "hypernetworks",
+    "gligen_name": "gligen",
+}
+
+# Memory left to the rest of the system when deciding whether a file fits in the page cache
+RESERVED_MEMORY = 4 * 1024 * 1024 * 1024
+
+READ_CHUNK_SIZE = 16 * 1024 * 1024
+
+def get_model_files(prompt):
+    """Returns the paths of the model files loaded by a prompt, in node order."""
+    paths = []
+    for node in prompt.values():
+        for name, value in node.get("inputs", {}).items():
+            folder_name = MODEL_FOLDERS.get(name, None)
+            if folder_name is None or not isinstance(value, str):
+                continue
+            path = folder_paths.get_full_path(folder_name, value)
+            if path is not None and path not in paths:
+                paths.append(path)
+    return paths
+
+class ModelPrefetcher:
+    """
+    Reads the model files of queued prompts on a background thread while the current prompt
+    runs, so loading them when their prompt starts reads from the page cache instead of the
+    disk. Files are only read when they fit in the available memory, and each file is read
+    once until max_files other files were read after it.
+    """
+    def __init__(self, max_files=16):
+        self.max_files = max_files
+        self.pending = []
+        self.read_files = OrderedDict()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        threading.Thread(target=self.run, daemon=True, name="model_prefetch").start()
+
+    def prefetch(self, queue, running=None):
+        """Schedules the model files of the queued items, in queue order, skipping those of the running prompt."""
+        skip = set(get_model_files(running[2])) if running is not None else set()
+        paths = []
+        for item in sorted(queue, key=lambda x: x[0]):
+            for path in get_model_files(item[2]):
+                if path not in skip and path not in paths:
+                    paths.append(path)
+
+        with self.lock:
+            self.pending = [path for path in paths if path not in self.read_files]
+            if len(self.pending) > 0:
+                self.wake.set()
+
+    def run(self):
+        buffer = bytearray(READ_CHUNK_SIZE)
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            while True:
+                with self.lock:
+                    if len(self.pending) == 0:
+                        break
+                    path = self.pending.pop(0)
+                try:
+                    self.read_file(path, buffer)
+                except OSError as e:
+                    logging.warning("Could not prefetch {}: {}".format(path, e))
+
+    def read_file(self, path, buffer):
+        stat = os.stat(path)
+        key = (stat.st_size, stat.st_mtime)
+        with self.lock:
+            if self.read_files.get(path, None) == key:
+                return
+        if stat.st_size > psutil.virtual_memory().available - RESERVED_MEMORY:
+            return
+
+        logging.debug("Prefetching {}".format(path))
+        with open(path, "rb", buffering=0) as f:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            while f.readinto(buffer) > 0:
+                pass
+
+        with self.lock:
+            self.read_files[path] = key
+            self.read_files.move_to_end(path)
+            while len(self.read_files) > self.max_files:
+                self.read_files.popitem(last=False)
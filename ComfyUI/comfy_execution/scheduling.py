@@ -0,0 +1,126 @@
+import math
+import time
+
+# Inputs that name the model files a prompt loads, used to run prompts that share
+# the models of the previous prompt back to back.
+MODEL_INPUT_NAMES = {
+    "ckpt_name",
+    "unet_name",
+    "vae_name",
+    "lora_name",
+    "clip_name",
+    "clip_name1",
+    "clip_name2",
+    "clip_name3",
+    "control_net_name",
+    "style_model_name",
+    "upscale_model_name",
+    "hypernetwork_name",
+    "gligen_name",
+}
+
+def get_number(extra_data, name, default):
+    """Returns extra_data[name] as a float, or default when it is missing or not a number."""
+    value = extra_data.get(name, None)
+    if value is None or isinstance(value, bool):
+        return default
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return default
+    if math.isnan(value):
+        return default
+    return value
+
+def get_model_names(prompt):
+    model_names = set()
+    for node in prompt.values():
+        for name, value in node.get("inputs", {}).items():
+            if name in MODEL_INPUT_NAMES and isinstance(value, str):
+                model_names.add(value)
+    return frozenset(model_names)
+
+class PromptScheduler:
+    """
+    Picks which queued prompt runs next. Queue items are the
+    (number, prompt_id, prompt, extra_data, outputs_to_execute) tuples of the
+    PromptQueue. Prompts queued with front=True, which get a negative number,
+    always run first, most recently queued first. The others are ordered by, in
+    turn:
+
+    - priority: extra_data["priority"], lower runs first, defaults to 0.
+    - deadline: prompts whose extra_data["deadline"] (unix time) is closer than
+      deadline_slack seconds run first, earliest deadline first.
+      Values that are not numbers are ignored.
+    - starvation: prompts passed over max_bypass times run in queue order.
+    - fair share: the client that has had the fewest prompts started runs next.
+    - model affinity: prompts loading the same models as the previous prompt,
+      those are still cached so no model swap is needed.
+    - the number the prompt was queued with.
+    """
+    def __init__(self, deadline_slack=60.0, max_bypass=4):
+        self.deadline_slack = deadline_slack
+        self.max_bypass = max_bypass
+        self.served = {}
+        self.bypassed = {}
+        self.model_names = {}
+        self.last_model_names = frozenset()
+
+    def sort_key(self, item, now):
+        number, prompt_id, prompt, extra_data = item[:4]
+        if number < 0:
+            return (False, number)
+
+        priority = get_number(extra_data, "priority", 0)
+        deadline = get_number(extra_data, "deadline", None)
+        urgent = deadline is not None and deadline - now <= self.deadline_slack
+        starved = self.bypassed.get(prompt_id, 0) >= self.max_bypass
+        served = self.served.get(extra_data.get("client_id", None), 0)
+
+        model_names = self.model_names.get(prompt_id, None)
+        if model_names is None:
+            model_names = get_model_names(prompt)
+            self.model_names[prompt_id] = model_names
+        affine = len(model_names & self.last_model_names) > 0
+
+        return (
+            True,
+            priority,
+            not urgent,
+            deadline if urgent else 0,
+            not starved,
+            served,
+            not affine,
+            number,
+        )
+
+    def select(self, queue, now=None):
+        """Returns the index in queue of the prompt to run next and marks it as started."""
+        if now is None:
+            now = time.time()
+
+        # Clients that just started queueing catch up with the others instead of
+        # getting every slot until their count matches
+        clients = set(item[3].get("client_id", None) for item in queue)
+        self.served = {client: served for client, served in self.served.items() if client in clients}
+        baseline = min(self.served.values(), default=0)
+        for client in clients:
+            self.served.setdefault(client, baseline)
+
+        index = min(range(len(queue)), key=lambda i: self.sort_key(queue[i], now))
+        selected = queue[index]
+        for item in queue:
+            if item[0] < selected[0]:
+                self.bypassed[item[1]] = self.bypassed.get(item[1], 0) + 1
+
+        prompt_id = selected[1]
+        client = selected[3].get("client_id", None)
+        self.served[client] += 1
+        self.bypassed.pop(prompt_id, None)
+        self.last_model_names = self.model_names.pop(prompt_id, None) or get_model_names(selected[2])
+        return index
+
+    def forget(self, prompt_id):
+        """Drops the state kept for a prompt removed from the queue without running."""
+        self.bypassed.pop(prompt_id, None)
+        self.model_names.pop(prompt_id, None)
@@ -0,0 +1,58 @@
+import logging
+
+import comfy.model_management
+from comfy_execution.graph_utils import is_link
+
+# Nodes encoding their "text" input with their "clip" input, these are encoded together with the
+# other nodes of the prompt using the same text encoder
+BATCHED_TEXT_ENCODERS = {"CLIPTextEncode"}
+
+def get_pending_texts(dynprompt, outputs, execution_list, clip_link):
+    """
+    Returns the texts of the BATCHED_TEXT_ENCODERS nodes pending in execution_list that use
+    clip_link and whose output isn't cached, with the ids of the nodes using each text.
+    """
+    texts = {}
+    for node_id in execution_list.pendingNodes:
+        node = dynprompt.get_node(node_id)
+        if node["class_type"] not in BATCHED_TEXT_ENCODERS or node["inputs"].get("clip", None) != clip_link:
+            continue
+        text = node["inputs"].get("text", None)
+        if not isinstance(text, str) or outputs.get(node_id) is not None:
+            continue
+        texts.setdefault(text, []).append(node_id)
+    return texts
+
+def encode_pending_texts(dynprompt, outputs, execution_list, node_id):
+    """
+    Encodes the text of a node together with the texts of the other nodes pending in the
+    execution list with the same text encoder, in one forward pass. The encodings are stored as
+    the outputs of the nodes, which then run as cached.
+    """
+    clip_link = dynprompt.get_node(node_id)["inputs"].get("clip", None)
+    if not is_link(clip_link):
+        return
+    clip_output = outputs.get(clip_link[0])
+    if clip_output is None or len(clip_output[clip_link[1]]) != 1:
+        return
+    clip = clip_output[clip_link[1]][0]
+    # Scheduled encodes give one conditioning per keyframe
+    if clip.patcher.forced_hooks is not None and clip.use_clip_schedule:
+        return
+
+    texts = get_pending_texts(dynprompt, outputs, execution_list, clip_link)
+    if len(texts) < 2:
+        return
+    try:
+        encodings = clip.encode_from_tokens_batch([clip.tokenize(text) for text in texts])
+    except comfy.model_management.InterruptProcessingException:
+        raise
+    except Exception as e:
+        logging.warning("Could not encode {} texts together, encoding them one by one: {}".format(len(texts), e))
+        return
+    for node_ids, encoding in zip(texts.values(), encodings):
+        for pending_id in node_ids:
+            # Same output as CLIPTextEncode.encode
+            pooled_dict = dict(encoding)
+            cond = pooled_dict.pop("cond")
+            outputs.set(pending_id, [[[[cond, pooled_dict]]]])
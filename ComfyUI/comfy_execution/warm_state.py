@@ -0,0 +1,214 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+
+import nodes
+import comfy.model_patcher
+import comfy.model_management
+from comfy_execution.caching import LRUCache
+from comfy_execution.graph_utils import is_link
+
+# Changed when the format of the manifest changes
+MANIFEST_VERSION = 1
+
+# Nodes only returning these types load models or encode text, they make up the warm state of a worker
+WARM_TYPES = {"MODEL", "CLIP", "VAE", "CONDITIONING", "CLIP_VISION", "CLIP_VISION_OUTPUT", "CONTROL_NET", "STYLE_MODEL", "UPSCALE_MODEL"}
+
+def get_warm_nodes(prompt):
+    """
+    Returns the nodes of a prompt that only return WARM_TYPES and whose linked inputs all come
+    from such nodes, e.g. checkpoint and LoRA loaders and the text encoders using them.
+    """
+    warm = {}
+
+    def is_warm(node_id):
+        if node_id in warm:
+            return warm[node_id]
+        warm[node_id] = False
+        node = prompt.get(node_id, None)
+        if node is None:
+            return False
+        class_def = nodes.NODE_CLASS_MAPPINGS.get(node["class_type"], None)
+        return_types = getattr(class_def, "RETURN_TYPES", ())
+        if len(return_types) == 0 or any(t not in WARM_TYPES for t in return_types):
+            return False
+        for value in node["inputs"].values():
+            if is_link(value) and not is_warm(value[0]):
+                return False
+        warm[node_id] = True
+        return True
+
+    return {node_id: {"class_type": prompt[node_id]["class_type"], "inputs": prompt[node_id]["inputs"]} for node_id in prompt if is_warm(node_id)}
+
+# Text encodings are only recorded once the same text was encoded in this many prompts, e.g. a
+# default negative prompt, so the texts of individual requests are never written to the file
+STABLE_TEXT_PROMPTS = 3
+
+# Changes that only reorder the recorded prompts are written at most this often, in seconds
+SAVE_INTERVAL = 300.0
+
+def without_nodes(prompt, removed):
+    """Returns prompt without the removed nodes and the nodes linked to them."""
+    prompt = dict(prompt)
+    removed = set(removed)
+    while len(removed) > 0:
+        for node_id in removed:
+            prompt.pop(node_id, None)
+        removed = set(node_id for node_id, node in prompt.items() if any(is_link(value) and value[0] not in prompt for value in node["inputs"].values()))
+    return prompt
+
+def get_text_digest(node):
+    """Returns a digest of the texts a node encodes, or None if it doesn't encode text."""
+    texts = [value for value in node["inputs"].values() if isinstance(value, str)]
+    class_def = nodes.NODE_CLASS_MAPPINGS.get(node["class_type"], None)
+    if len(texts) == 0 or "CONDITIONING" not in getattr(class_def, "RETURN_TYPES", ()):
+        return None
+    return hashlib.sha256(json.dumps([node["class_type"], texts]).encode()).hexdigest()
+
+def get_patchers(value):
+    patcher = getattr(value, "patcher", value)
+    if isinstance(patcher, comfy.model_patcher.ModelPatcher):
+        return [patcher]
+    return []
+
+def get_dtype(patcher):
+    dtype = patcher.model_dtype()
+    if dtype is None:
+        # Text encoders don't report a dtype
+        dtype = next(patcher.model.parameters()).dtype
+    return str(dtype).split(".")[-1]
+
+class WarmState:
+    """
+    Manifest of what makes a worker warm, stored as JSON: the parts of the last prompts that load
+    models, LoRAs included, and encode texts many prompts share, and the device, dtype and patches of the models they
+    left loaded. A new worker restores it before running prompts by executing those parts again,
+    so their outputs are in the cache, and loading the models that were loaded.
+    """
+    def __init__(self, path, max_entries=8):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = []
+        # How many recorded prompts encoded each text, by digest
+        self.text_counts = {}
+        self.last_save = 0.0
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    manifest = json.load(f)
+                if manifest.get("version", None) == MANIFEST_VERSION:
+                    self.entries = manifest["entries"][:max_entries]
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning("Could not read the warm state {}: {}".format(path, e))
+        # Texts in the file were already used by many prompts
+        for entry in self.entries:
+            for node in entry["prompt"].values():
+                digest = get_text_digest(node)
+                if digest is not None:
+                    self.text_counts[digest] = STABLE_TEXT_PROMPTS
+
+    def record(self, prompt, executor):
+        """Adds the warm part of a prompt the executor ran successfully, most recent first."""
+        try:
+            self.add_prompt(prompt, executor)
+        except Exception as e:
+            logging.warning("Could not record the warm state: {}".format(e))
+
+    def add_prompt(self, prompt, executor):
+        warm_nodes = self.get_stable_nodes(get_warm_nodes(prompt))
+        if len(warm_nodes) == 0:
+            return
+
+        loaded = comfy.model_management.loaded_models()
+        models = []
+        for node_id in warm_nodes:
+            outputs = executor.caches.outputs.get(node_id)
+            if outputs is None:
+                continue
+            for i, values in enumerate(outputs):
+                for patcher in [p for v in values for p in get_patchers(v)]:
+                    if not any(m.model is patcher.model for m in loaded):
+                        continue
+                    models.append({
+                        "node": node_id,
+                        "output": i,
+                        "class": type(patcher.model).__name__,
+                        "dtype": get_dtype(patcher),
+                        "device": str(patcher.load_device),
+                        "loaded_memory": patcher.loaded_size(),
+                        "patches": len(patcher.patches),
+                    })
+
+        entry = {"prompt": warm_nodes, "models": models}
+        entries = [entry] + [e for e in self.entries if e["prompt"] != warm_nodes]
+        entries = entries[:self.max_entries]
+        if entries == self.entries:
+            return
+        only_reordered = sorted(json.dumps(e["prompt"], sort_keys=True) for e in entries) == sorted(json.dumps(e["prompt"], sort_keys=True) for e in self.entries)
+        self.entries = entries
+        if not only_reordered or time.monotonic() - self.last_save >= SAVE_INTERVAL:
+            self.save()
+
+    def get_stable_nodes(self, warm_nodes):
+        """Returns warm_nodes without the text encodings of texts encoded in fewer than STABLE_TEXT_PROMPTS prompts."""
+        removed = []
+        for node_id, node in warm_nodes.items():
+            digest = get_text_digest(node)
+            if digest is None:
+                continue
+            if len(self.text_counts) >= 4096 and digest not in self.text_counts:
+                self.text_counts.clear()
+            self.text_counts[digest] = self.text_counts.get(digest, 0) + 1
+            if self.text_counts[digest] < STABLE_TEXT_PROMPTS:
+                removed.append(node_id)
+        return without_nodes(warm_nodes, removed)
+
+    def save(self):
+        self.last_save = time.monotonic()
+        temp_path = "{}.{}.tmp".format(self.path, uuid.uuid4().hex)
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(temp_path, "w") as f:
+                json.dump({"version": MANIFEST_VERSION, "entries": self.entries}, f)
+            os.replace(temp_path, self.path)
+        except (OSError, TypeError, ValueError) as e:
+            logging.warning("Could not write the warm state {}: {}".format(self.path, e))
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def restore(self, executor):
+        """Executes the recorded prompts, oldest first, and loads the models that were loaded."""
+        entries = self.entries
+        # The classic cache only keeps the outputs of the last prompt
+        if not isinstance(executor.caches.outputs, LRUCache):
+            entries = entries[:1]
+
+        for n, entry in enumerate(reversed(entries)):
+            prompt = entry["prompt"]
+            linked = set(value[0] for node in prompt.values() for value in node["inputs"].values() if is_link(value))
+            outputs = [node_id for node_id in prompt if node_id not in linked]
+            try:
+                executor.execute(prompt, "warm_state_{}".format(n), {}, outputs)
+            except Exception as e:
+                logging.warning("Could not restore the warm state: {}".format(e))
+                continue
+            if not executor.success:
+                logging.warning("Could not restore the warm state: {}".format(executor.status_messages[-1][1].get("exception_message", "execution failed")))
+                continue
+
+            patchers = []
+            for model in entry["models"]:
+                cached = executor.caches.outputs.get(model["node"])
+                if cached is None or model["output"] >= len(cached):
+                    continue
+                for patcher in [p for v in cached[model["output"]] for p in get_patchers(v)]:
+                    dtype = get_dtype(patcher)
+                    if dtype != model["dtype"]:
+                        logging.info("{} was recorded in {} and is now loaded in {}".format(model["class"], model["dtype"], dtype))
+                    patchers.append(patcher)
+            if len(patchers) > 0:
+                comfy.model_management.load_models_gpu(patchers)
+        logging.info("Restored {} warm state entries from {}".format(len(entries), self.path))
@@ -0,0 +1,161 @@
+import torch
+import comfy.conds
+import comfy.sample
+import comfy.samplers
+import comfy.utils
+import latent_preview
+
+#These nodes run the KSamplers of several queued prompts as one batch, they are
+#inserted by comfy_execution.batching.merge_prompts and aren't meant to be used
+#in workflows directly.
+
+def batch_conds(conds, batch_sizes):
+    """Stacks the conditioning of several prompts along the batch dimension, returns None if they can't be stacked."""
+    if any(len(c) != len(conds[0]) for c in conds):
+        return None
+
+    out = []
+    for parts in zip(*conds):
+        cross_attn = [comfy.conds.CONDCrossAttn(comfy.utils.repeat_to_batch_size(p[0], b)) for p, b in zip(parts, batch_sizes)]
+        # can_concat expects the same batch size, only the token lengths have to be compatible
+        first = comfy.conds.CONDCrossAttn(cross_attn[0].cond[:1])
+        if not all(first.can_concat(comfy.conds.CONDCrossAttn(c.cond[:1])) for c in cross_attn[1:]):
+            return None
+
+        if any(p[1].keys() != parts[0][1].keys() for p in parts):
+            return None
+
+        options = {}
+        for key, value in parts[0][1].items():
+            values = [p[1][key] for p in parts]
+            if all(torch.is_tensor(v) for v in values):
+                if any(v.shape[1:] != value.shape[1:] for v in values):
+                    return None
+                options[key] = torch.cat([comfy.utils.repeat_to_batch_size(v, b) for v, b in zip(values, batch_sizes)])
+            elif all(v is value for v in values) or all(not torch.is_tensor(v) and v == value for v in values):
+                options[key] = value
+            else:
+                return None
+        out.append([cross_attn[0].concat(cross_attn[1:]), options])
+    return out
+
+def batch_noise_masks(latents, batch_sizes):
+    masks = [latent.get("noise_mask", None) for latent in latents]
+    if all(mask is None for mask in masks):
+        return None
+    return torch.cat([comfy.utils.repeat_to_batch_size(mask, b) for mask, b in zip(masks, batch_sizes)])
+
+def group_batch(model, batch):
+    """Splits the prompts of a batch into groups with latents and masks of the same shape."""
+    groups = {}
+    for index, (positive, negative, latent, seed) in enumerate(batch):
+        samples = comfy.sample.fix_empty_latent_channels(model, latent["samples"])
+        mask = latent.get("noise_mask", None)
+        key = (tuple(samples.shape), samples.dtype, None if mask is None else tuple(mask.shape))
+        groups.setdefault(key, []).append((index, samples))
+    return list(groups.values())
+
+def sample_batch(model, batch, steps, cfg, sampler_name, scheduler, denoise):
+    """
+    Samples a list of (positive, negative, latent, seed) with a single sampler call per group of
+    compatible prompts. The noise of every prompt is created from its own seed so the results
+    match sampling the prompts one by one, except for samplers that add noise while sampling.
+    """
+    out = [None] * len(batch)
+    groups = []
+    for group in group_batch(model, batch):
+        batch_sizes = [samples.shape[0] for index, samples in group]
+        positive = batch_conds([batch[index][0] for index, samples in group], batch_sizes)
+        negative = batch_conds([batch[index][1] for index, samples in group], batch_sizes)
+        if positive is not None and negative is not None:
+            groups.append((group, positive, negative))
+        else:
+            # The conditionings can't be stacked, sample these prompts one by one
+            groups += [([(index, samples)], batch[index][0], batch[index][1]) for index, samples in group]
+
+    callback = latent_preview.prepare_callback(model, steps)
+    disable_pbar = not comfy.utils.PROGRESS_BAR_ENABLED
+    for group, positive, negative in groups:
+        indexes = [index for index, samples in group]
+        batch_sizes = [samples.shape[0] for index, samples in group]
+        latents = [batch[i][2] for i in indexes]
+        seeds = [batch[i][3] for i in indexes]
+
+        latent_image = torch.cat([samples for index, samples in group])
+        noise = torch.cat([comfy.sample.prepare_noise(samples, seed, latent.get("batch_index", None)) for (index, samples), latent, seed in zip(group, latents, seeds)])
+        noise_mask = batch_noise_masks(latents, batch_sizes)
+        samples = comfy.sample.sample(model, noise, steps, cfg, sampler_name, scheduler, positive, negative, latent_image,
+                                      denoise=denoise, noise_mask=noise_mask, callback=callback, disable_pbar=disable_pbar, seed=seeds[0])
+
+        for index, latent, chunk in zip(indexes, latents, samples.split(batch_sizes)):
+            out[index] = latent.copy()
+            out[index]["samples"] = chunk
+    return out
+
+class PromptBatchGather:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required":
+                    {"positive": ("CONDITIONING", ),
+                     "negative": ("CONDITIONING", ),
+                     "latent_image": ("LATENT", ),
+                     "seed": ("INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff}),
+                    },
+                "optional":
+                    {"batch": ("PROMPT_BATCH", ),}
+                }
+
+    RETURN_TYPES = ("PROMPT_BATCH",)
+    FUNCTION = "gather"
+
+    CATEGORY = "sampling/batching"
+
+    def gather(self, positive, negative, latent_image, seed, batch=None):
+        batch = [] if batch is None else list(batch)
+        batch.append((positive, negative, latent_image, seed))
+        return (batch, )
+
+class KSamplerPromptBatch:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required":
+                    {"model": ("MODEL",),
+                     "batch": ("PROMPT_BATCH", ),
+                     "steps": ("INT", {"default": 20, "min": 1, "max": 10000}),
+                     "cfg": ("FLOAT", {"default": 8.0, "min": 0.0, "max": 100.0, "step":0.1, "round": 0.01}),
+                     "sampler_name": (comfy.samplers.KSampler.SAMPLERS, ),
+                     "scheduler": (comfy.samplers.KSampler.SCHEDULERS, ),
+                     "denoise": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.01}),
+                    }
+                }
+
+    RETURN_TYPES = ("PROMPT_BATCH_LATENTS",)
+    FUNCTION = "sample"
+
+    CATEGORY = "sampling/batching"
+
+    def sample(self, model, batch, steps, cfg, sampler_name, scheduler, denoise=1.0):
+        return (sample_batch(model, batch, steps, cfg, sampler_name, scheduler, denoise), )
+
+class PromptBatchSelect:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required":
+                    {"samples": ("PROMPT_BATCH_LATENTS", ),
+                     "index": ("INT", {"default": 0, "min": 0, "max": 4096}),
+                    }
+                }
+
+    RETURN_TYPES = ("LATENT",)
+    FUNCTION = "select"
+
+    CATEGORY = "sampling/batching"
+
+    def select(self, samples, index):
+        return (samples[index], )
+
+NODE_CLASS_MAPPINGS = {
+    "PromptBatchGather": PromptBatchGather,
+    "KSamplerPromptBatch": KSamplerPromptBatch,
+    "PromptBatchSelect": PromptBatchSelect,
+}
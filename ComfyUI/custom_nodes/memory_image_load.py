@@ -0,0 +1,158 @@
+from PIL import Image, ImageOps
+import numpy as np
+import torch
+import base64
+import hashlib
+import threading
+from io import BytesIO
+import node_helpers
+
+#These nodes load images sent with an API request without going through the
+#input directory. The Base64 nodes take the encoded image as a string input
+#so they work through the /prompt endpoint, the FromMemory nodes take the key
+#of an image registered in-process with LoadImageFromMemory.register so the
+#image is decoded a single time by the caller and never touches the disk.
+
+#Memory keys are hashes of the image bytes, so sending the same image twice
+#reuses the cached outputs of every node that depends on it.
+
+def decode_image(image_bytes):
+    i = node_helpers.pillow(Image.open, BytesIO(image_bytes))
+    i = node_helpers.pillow(ImageOps.exif_transpose, i)
+    if i.mode == 'I':
+        i = i.point(lambda i: i * (1 / 255))
+    return i
+
+def image_to_tensors(i):
+    image = np.array(i.convert("RGB")).astype(np.float32) / 255.0
+    image = torch.from_numpy(image)[None,]
+    if 'A' in i.getbands():
+        mask = np.array(i.getchannel('A')).astype(np.float32) / 255.0
+        mask = 1. - torch.from_numpy(mask)
+    else:
+        mask = torch.zeros((64,64), dtype=torch.float32, device="cpu")
+    return (image, mask.unsqueeze(0))
+
+def image_to_mask(i, channel):
+    if i.getbands() != ("R", "G", "B", "A"):
+        i = i.convert("RGBA")
+    c = channel[0].upper()
+    mask = np.array(i.getchannel(c)).astype(np.float32) / 255.0
+    mask = torch.from_numpy(mask)
+    if c == 'A':
+        mask = 1. - mask
+    return (mask.unsqueeze(0),)
+
+class LoadImageBase64:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required":
+                    {"image": ("STRING", {"multiline": False}),}
+                }
+
+    CATEGORY = "api/image"
+
+    RETURN_TYPES = ("IMAGE", "MASK")
+    FUNCTION = "load_image"
+
+    def load_image(self, image):
+        return image_to_tensors(decode_image(base64.b64decode(image)))
+
+class LoadImageMaskBase64:
+    _color_channels = ["alpha", "red", "green", "blue"]
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required":
+                    {"image": ("STRING", {"multiline": False}),
+                     "channel": (s._color_channels, ), }
+                }
+
+    CATEGORY = "api/image"
+
+    RETURN_TYPES = ("MASK",)
+    FUNCTION = "load_image"
+
+    def load_image(self, image, channel):
+        return image_to_mask(decode_image(base64.b64decode(image)), channel)
+
+class LoadImageFromMemory:
+    # key -> [decoded image, number of registrations]
+    images = {}
+    lock = threading.Lock()
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required":
+                    {"key": ("STRING", {"multiline": False}),}
+                }
+
+    CATEGORY = "api/image"
+
+    RETURN_TYPES = ("IMAGE", "MASK")
+    FUNCTION = "load_image"
+
+    def load_image(self, key):
+        return image_to_tensors(self.get(key))
+
+    @classmethod
+    def register(s, image_bytes):
+        key = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+        with s.lock:
+            entry = s.images.get(key)
+            if entry is not None:
+                entry[1] += 1
+                return key
+        image = decode_image(image_bytes)
+        image.load()
+        with s.lock:
+            entry = s.images.setdefault(key, [image, 0])
+            entry[1] += 1
+        return key
+
+    @classmethod
+    def release(s, key):
+        with s.lock:
+            entry = s.images.get(key)
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    s.images.pop(key)
+
+    @classmethod
+    def get(s, key):
+        with s.lock:
+            return s.images[key][0]
+
+    @classmethod
+    def VALIDATE_INPUTS(s, key):
+        if key not in s.images:
+            return "Image not registered in memory: {}".format(key)
+        return True
+
+class LoadImageMaskFromMemory:
+    _color_channels = ["alpha", "red", "green", "blue"]
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required":
+                    {"key": ("STRING", {"multiline": False}),
+                     "channel": (s._color_channels, ), }
+                }
+
+    CATEGORY = "api/image"
+
+    RETURN_TYPES = ("MASK",)
+    FUNCTION = "load_image"
+
+    def load_image(self, key, channel):
+        return image_to_mask(LoadImageFromMemory.get(key), channel)
+
+    @classmethod
+    def VALIDATE_INPUTS(s, key):
+        return LoadImageFromMemory.VALIDATE_INPUTS(key)
+
+NODE_CLASS_MAPPINGS = {
+    "LoadImageBase64": LoadImageBase64,
+    "LoadImageMaskBase64": LoadImageMaskBase64,
+    "LoadImageFromMemory": LoadImageFromMemory,
+    "LoadImageMaskFromMemory": LoadImageMaskFromMemory,
+}
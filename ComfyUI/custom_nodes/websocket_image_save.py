@@ -1,5 +1,9 @@
 from PIL import Image
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import struct
+import torch
 import comfy.utils
 import time
 
@@ -8,13 +12,29 @@ import time
 #binary images on the websocket with a 8 byte header indicating the type
 #of binary message (first 4 bytes) and the image format (next 4 bytes).
 
+#The image format is 1 for JPEG, 2 for PNG, 3 for WEBP and 4 for RAW. RAW
+#images are the uint8 RGB pixels in row major order, preceded by a 12 byte
+#header with the height, width and number of channels as big endian uint32.
+
+#Images are encoded on a thread pool by the executing prompt, not on the
+#server's event loop. When ComfyUI runs in-process without a PromptServer the
+#node does nothing and the caller encodes the images with encode_image.
+
 #Note that no metadata will be put in the images saved with this node.
 
+IMAGE_FORMATS = {"JPEG": 1, "PNG": 2, "WEBP": 3, "RAW": 4}
+
+encode_pool = ThreadPoolExecutor(thread_name_prefix="websocket_image_save")
+
 class SaveImageWebsocket:
     @classmethod
     def INPUT_TYPES(s):
         return {"required":
-                    {"images": ("IMAGE", ),}
+                    {"images": ("IMAGE", ),},
+                "optional":
+                    {"format": (list(IMAGE_FORMATS.keys()), {"default": "PNG"}),
+                     "quality": ("INT", {"default": 95, "min": 1, "max": 100, "step": 1, "tooltip": "Quality of JPEG and WEBP images."}),
+                     "compress_level": ("INT", {"default": 1, "min": 0, "max": 9, "step": 1, "tooltip": "Compression level of PNG images."}),}
                 }
 
     RETURN_TYPES = ()
@@ -24,19 +44,40 @@ class SaveImageWebsocket:
 
     CATEGORY = "api/image"
 
-    def save_images(self, images):
+    def save_images(self, images, format="PNG", quality=95, compress_level=1):
+        from server import PromptServer, BinaryEventTypes
+        server = getattr(PromptServer, "instance", None)
+        if server is None:
+            # Running in-process without a server, the caller reads the images from the output cache
+            return {}
+
         pbar = comfy.utils.ProgressBar(images.shape[0])
-        step = 0
-        for image in images:
-            i = 255. * image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-            pbar.update_absolute(step, images.shape[0], ("PNG", img, None))
-            step += 1
+        pixels = self.to_uint8(images)
+        encoded = encode_pool.map(lambda i: self.encode_image(i, format, quality, compress_level), pixels)
+        header = struct.pack(">I", IMAGE_FORMATS[format])
+        for step, image_bytes in enumerate(encoded):
+            server.send_sync(BinaryEventTypes.PREVIEW_IMAGE, header + image_bytes, server.client_id)
+            pbar.update_absolute(step + 1, images.shape[0])
 
         return {}
 
+    @staticmethod
+    def to_uint8(images):
+        # Converted on the device the images are on, a single copy to the cpu
+        return torch.clamp(images * 255.0, 0, 255).to(torch.uint8).cpu().numpy()
+
+    @staticmethod
+    def encode_image(image, format="PNG", quality=95, compress_level=1):
+        if format == "RAW":
+            image = np.ascontiguousarray(image)
+            return struct.pack(">III", *image.shape) + image.tobytes()
+
+        bytesIO = BytesIO()
+        Image.fromarray(image).save(bytesIO, format=format, quality=quality, compress_level=compress_level)
+        return bytesIO.getvalue()
+
     @classmethod
-    def IS_CHANGED(s, images):
+    def IS_CHANGED(s, images, **kwargs):
         return time.time()
 
 NODE_CLASS_MAPPINGS = {
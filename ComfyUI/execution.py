@@ -17,6 +17,9 @@ from comfy_execution.graph import get_input_info, ExecutionList, DynamicPrompt,
 from comfy_execution.graph_utils import is_link, GraphBuilder
 from comfy_execution.caching import HierarchicalCache, LRUCache, CacheKeySetInputSignature, CacheKeySetID
 from comfy_execution.validation import validate_node_input
+from comfy_execution.scheduling import PromptScheduler
+from comfy_execution.prefetch import get_model_files
+from comfy_execution.text_encoding import BATCHED_TEXT_ENCODERS, encode_pending_texts
 
 class ExecutionResult(Enum):
     SUCCESS = 0
@@ -48,35 +51,36 @@ class IsChangedCache:
             return self.is_changed[node_id]
 
         # Intentionally do not use cached outputs here. We only want constants in IS_CHANGED
+        # The result is not written back to the node, queued prompts are not copied and are kept in the history
         input_data_all, _ = get_input_data(node["inputs"], class_def, node_id, None)
         try:
             is_changed = _map_node_over_list(class_def, input_data_all, "IS_CHANGED")
-            node["is_changed"] = [None if isinstance(x, ExecutionBlocker) else x for x in is_changed]
+            self.is_changed[node_id] = [None if isinstance(x, ExecutionBlocker) else x for x in is_changed]
         except Exception as e:
             logging.warning("WARNING: {}".format(e))
-            node["is_changed"] = float("NaN")
-        finally:
-            self.is_changed[node_id] = node["is_changed"]
+            self.is_changed[node_id] = float("NaN")
         return self.is_changed[node_id]
 
 class CacheSet:
-    def __init__(self, lru_size=None):
-        if lru_size is None or lru_size == 0:
+    def __init__(self, lru_size=None, persistent_cache=None, lru_max_bytes=None):
+        self.persistent_cache = persistent_cache
+        if (lru_size is None or lru_size == 0) and lru_max_bytes is None:
             self.init_classic_cache()
         else:
-            self.init_lru_cache(lru_size)
+            self.init_lru_cache(lru_size or float("inf"), lru_max_bytes)
         self.all = [self.outputs, self.ui, self.objects]
 
     # Useful for those with ample RAM/VRAM -- allows experimenting without
     # blowing away the cache every time
-    def init_lru_cache(self, cache_size):
-        self.outputs = LRUCache(CacheKeySetInputSignature, max_size=cache_size)
-        self.ui = LRUCache(CacheKeySetInputSignature, max_size=cache_size)
+    def init_lru_cache(self, cache_size, max_bytes=None):
+        self.outputs = LRUCache(CacheKeySetInputSignature, max_size=cache_size, max_bytes=max_bytes, persistent_cache=self.persistent_cache)
+        # ui outputs hold no tensors, without a size limit they are kept as long as the history
+        self.ui = LRUCache(CacheKeySetInputSignature, max_size=min(cache_size, MAXIMUM_HISTORY_SIZE))
         self.objects = HierarchicalCache(CacheKeySetID)
 
     # Performs like the old cache -- dump data ASAP
     def init_classic_cache(self):
-        self.outputs = HierarchicalCache(CacheKeySetInputSignature)
+        self.outputs = HierarchicalCache(CacheKeySetInputSignature, persistent_cache=self.persistent_cache)
         self.ui = HierarchicalCache(CacheKeySetInputSignature)
         self.objects = HierarchicalCache(CacheKeySetID)
 
@@ -253,6 +257,8 @@ def execute(server, dynprompt, caches, current_item, extra_data, executed, promp
     inputs = dynprompt.get_node(unique_id)['inputs']
     class_type = dynprompt.get_node(unique_id)['class_type']
     class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
+    if class_type in BATCHED_TEXT_ENCODERS and caches.outputs.get(unique_id) is None:
+        encode_pending_texts(dynprompt, caches.outputs, execution_list, unique_id)
     if caches.outputs.get(unique_id) is not None:
         if server.client_id is not None:
             cached_output = caches.ui.get(unique_id) or {}
@@ -414,13 +420,15 @@ def execute(server, dynprompt, caches, current_item, extra_data, executed, promp
     return (ExecutionResult.SUCCESS, None, None)
 
 class PromptExecutor:
-    def __init__(self, server, lru_size=None):
+    def __init__(self, server, lru_size=None, persistent_cache=None, lru_max_bytes=None):
         self.lru_size = lru_size
+        self.lru_max_bytes = lru_max_bytes
+        self.persistent_cache = persistent_cache
         self.server = server
         self.reset()
 
     def reset(self):
-        self.caches = CacheSet(self.lru_size)
+        self.caches = CacheSet(self.lru_size, self.persistent_cache, self.lru_max_bytes)
         self.status_messages = []
         self.success = True
 
@@ -866,6 +874,102 @@ def validate_prompt(prompt):
 
     return (True, None, list(good_outputs), node_errors)
 
+class PromptTemplate:
+    """A prompt that is validated once and then queued many times with different input values.
+
+    Only the nodes whose inputs are overridden are validated again, the rest of the
+    graph keeps the result of the first validation.
+    """
+    def __init__(self, prompt):
+        self.prompt = prompt
+        self.valid = validate_prompt(prompt)
+        node_errors = self.valid[3]
+        self.validated = {node_id: (True, [], node_id) for node_id in prompt if node_id not in node_errors}
+
+    def instantiate(self, overrides):
+        """Returns a copy of the prompt with the overridden inputs and its validation result.
+
+        overrides maps node ids to the input values to replace, e.g. {"3": {"seed": 5}}.
+        The validation result has the same shape as the return value of validate_prompt.
+        """
+        # The template is shared by every job, overrides go to copies of the nodes
+        prompt = {}
+        for node_id, node in self.prompt.items():
+            prompt[node_id] = dict(node)
+            prompt[node_id]["inputs"] = dict(node["inputs"])
+
+        if not self.valid[0]:
+            return prompt, self.valid
+
+        for node_id, inputs in overrides.items():
+            if node_id not in prompt:
+                error = {
+                    "type": "invalid_prompt_override",
+                    "message": "Cannot override the inputs of a node that is not in the template",
+                    "details": f"Node ID '#{node_id}'",
+                    "extra_info": {}
+                }
+                return prompt, (False, error, [], [])
+            for x, val in inputs.items():
+                if x not in prompt[node_id]["inputs"]:
+                    error = {
+                        "type": "invalid_prompt_override",
+                        "message": "Cannot override an input that is not in the template",
+                        "details": f"Node ID '#{node_id}', {x}",
+                        "extra_info": {}
+                    }
+                    return prompt, (False, error, [], [])
+                if is_link(val) or is_link(prompt[node_id]["inputs"].get(x)):
+                    error = {
+                        "type": "invalid_prompt_override",
+                        "message": "Cannot override a linked input of a template",
+                        "details": f"Node ID '#{node_id}', {x}",
+                        "extra_info": {}
+                    }
+                    return prompt, (False, error, [], [])
+                prompt[node_id]["inputs"][x] = val
+
+        validated = {node_id: result for node_id, result in self.validated.items() if node_id not in overrides}
+        node_errors = {}
+        for node_id in overrides:
+            try:
+                m = validate_inputs(prompt, node_id, validated)
+                valid = m[0]
+                reasons = m[1]
+            except Exception as ex:
+                typ, _, tb = sys.exc_info()
+                valid = False
+                reasons = [{
+                    "type": "exception_during_validation",
+                    "message": "Exception when validating node",
+                    "details": str(ex),
+                    "extra_info": {
+                        "exception_type": full_type_name(typ),
+                        "traceback": traceback.format_tb(tb)
+                    }
+                }]
+            if valid is not True:
+                node_errors[node_id] = {
+                    "errors": reasons,
+                    "dependent_outputs": list(self.valid[2]),
+                    "class_type": prompt[node_id]['class_type']
+                }
+
+        if len(node_errors) > 0:
+            errors_list = []
+            for node_id, node_error in node_errors.items():
+                for error in node_error["errors"]:
+                    errors_list.append(f"{error['message']}: {error['details']}")
+            error = {
+                "type": "prompt_outputs_failed_validation",
+                "message": "Prompt outputs failed validation",
+                "details": "\n".join(errors_list),
+                "extra_info": {}
+            }
+            return prompt, (False, error, [], node_errors)
+
+        return prompt, (True, None, list(self.valid[2]), self.valid[3])
+
 MAXIMUM_HISTORY_SIZE = 10000
 
 class PromptQueue:
@@ -875,14 +979,37 @@ class PromptQueue:
         self.not_empty = threading.Condition(self.mutex)
         self.task_counter = 0
         self.queue = []
+        self.scheduler = PromptScheduler()
+        # Optional comfy_execution.prefetch.ModelPrefetcher reading the models of queued prompts ahead of time
+        self.prefetcher = None
         self.currently_running = {}
         self.history = {}
         self.flags = {}
+        # Model files loaded by each queued prompt and how many queued prompts load each file
+        self.model_files = {}
+        self.model_file_demand = {}
         server.prompt_queue = self
 
+    def update_model_file_demand(self, paths, count):
+        demand = dict(self.model_file_demand)
+        for path in paths:
+            demand[path] = demand.get(path, 0) + count
+            if demand[path] <= 0:
+                demand.pop(path)
+        # Replaced instead of updated in place so get_queued_model_files doesn't need the mutex
+        self.model_file_demand = demand
+
+    def forget_model_files(self, prompt_id):
+        self.update_model_file_demand(self.model_files.pop(prompt_id, []), -1)
+
     def put(self, item):
+        model_files = get_model_files(item[2])
         with self.mutex:
             heapq.heappush(self.queue, item)
+            self.model_files[item[1]] = model_files
+            self.update_model_file_demand(model_files, 1)
+            if self.prefetcher is not None:
+                self.prefetcher.prefetch(self.queue, next(iter(self.currently_running.values()), None))
             self.server.queue_updated()
             self.not_empty.notify()
 
@@ -892,13 +1019,44 @@ class PromptQueue:
                 self.not_empty.wait(timeout=timeout)
                 if timeout is not None and len(self.queue) == 0:
                     return None
-            item = heapq.heappop(self.queue)
+            item = self.queue.pop(self.scheduler.select(self.queue))
+            heapq.heapify(self.queue)
+            self.forget_model_files(item[1])
             i = self.task_counter
-            self.currently_running[i] = copy.deepcopy(item)
+            # Execution doesn't modify the prompt, so the item is shared with the history instead of copied
+            self.currently_running[i] = item
+            if self.prefetcher is not None:
+                self.prefetcher.prefetch(self.queue, item)
             self.task_counter += 1
             self.server.queue_updated()
             return (item, i)
 
+    def get_batch(self, matches, max_items):
+        """Removes up to max_items queued items for which matches(item) is true and marks them as running."""
+        with self.mutex:
+            batch = []
+            for item in sorted(self.queue, key=lambda x: x[0]):
+                if len(batch) >= max_items:
+                    break
+                if matches(item):
+                    batch.append(item)
+
+            if len(batch) == 0:
+                return []
+            batch_ids = set(id(item) for item in batch)
+            self.queue = [item for item in self.queue if id(item) not in batch_ids]
+            heapq.heapify(self.queue)
+            out = []
+            for item in batch:
+                self.scheduler.forget(item[1])
+                self.forget_model_files(item[1])
+                i = self.task_counter
+                self.currently_running[i] = item
+                self.task_counter += 1
+                out.append((item, i))
+            self.server.queue_updated()
+            return out
+
     class ExecutionStatus(NamedTuple):
         status_str: Literal['success', 'error']
         completed: bool
@@ -928,7 +1086,11 @@ class PromptQueue:
             out = []
             for x in self.currently_running.values():
                 out += [x]
-            return (out, copy.deepcopy(self.queue))
+            return (out, list(self.queue))
+
+    def get_queued_model_files(self):
+        """Returns how many queued prompts load each model file, the dict must not be modified."""
+        return self.model_file_demand
 
     def get_tasks_remaining(self):
         with self.mutex:
@@ -936,13 +1098,19 @@ class PromptQueue:
 
     def wipe_queue(self):
         with self.mutex:
+            for item in self.queue:
+                self.scheduler.forget(item[1])
             self.queue = []
+            self.model_files = {}
+            self.model_file_demand = {}
             self.server.queue_updated()
 
     def delete_queue_item(self, function):
         with self.mutex:
             for x in range(len(self.queue)):
                 if function(self.queue[x]):
+                    self.scheduler.forget(self.queue[x][1])
+                    self.forget_model_files(self.queue[x][1])
                     if len(self.queue) == 1:
                         self.wipe_queue()
                     else:
@@ -134,6 +134,9 @@ if args.windows_standalone_build:
 import comfy.utils
 
 import execution
+from comfy_execution.persistent_cache import PersistentCache
+from comfy_execution.prefetch import ModelPrefetcher
+from comfy_execution.warm_state import WarmState
 import server
 from server import BinaryEventTypes
 import nodes
@@ -153,7 +156,18 @@ def cuda_malloc_warning():
 
 def prompt_worker(q, server_instance):
     current_time: float = 0.0
-    e = execution.PromptExecutor(server_instance, lru_size=args.cache_lru)
+    persistent_cache = None
+    if args.cache_persistent_dir is not None:
+        persistent_cache = PersistentCache(args.cache_persistent_dir, int(args.cache_persistent_size * 1024 * 1024 * 1024))
+    lru_max_bytes = None
+    if args.cache_lru_max_memory is not None:
+        lru_max_bytes = int(args.cache_lru_max_memory * 1024 * 1024 * 1024)
+    e = execution.PromptExecutor(server_instance, lru_size=args.cache_lru, persistent_cache=persistent_cache, lru_max_bytes=lru_max_bytes)
+    warm_state = None
+    if args.warm_state is not None:
+        warm_state = WarmState(args.warm_state)
+        warm_state.restore(e)
+    server_instance.ready.set()
     last_gc_collect = 0
     need_gc = False
     gc_collect_interval = 10.0
@@ -171,6 +185,8 @@ def prompt_worker(q, server_instance):
             server_instance.last_prompt_id = prompt_id
 
             e.execute(item[2], prompt_id, item[3], item[4])
+            if warm_state is not None and e.success:
+                warm_state.record(item[2], e)
             need_gc = True
             q.task_done(item_id,
                         e.history_result,
@@ -257,6 +273,9 @@ def start_comfyui(asyncio_loop=None):
         asyncio.set_event_loop(asyncio_loop)
     prompt_server = server.PromptServer(asyncio_loop)
     q = execution.PromptQueue(prompt_server)
+    comfy.model_management.register_queued_model_files(q.get_queued_model_files)
+    if args.prefetch_models:
+        q.prefetcher = ModelPrefetcher()
 
     nodes.init_extra_nodes(init_custom_nodes=not args.disable_all_custom_nodes)
 
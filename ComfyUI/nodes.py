@@ -768,6 +768,8 @@ class VAELoader:
             vae_path = folder_paths.get_full_path_or_raise("vae", vae_name)
             sd = comfy.utils.load_torch_file(vae_path)
         vae = comfy.sd.VAE(sd=sd)
+        if vae_name not in ["taesd", "taesdxl", "taesd3", "taef1"]:
+            comfy.model_management.set_model_source(vae, vae_path)
         return (vae,)
 
 class ControlNetLoader:
@@ -2226,6 +2228,7 @@ def init_builtin_extra_nodes():
         "nodes_hooks.py",
         "nodes_load_3d.py",
         "nodes_cosmos.py",
+        "nodes_prompt_batch.py",
     ]
 
     import_failed = []
@@ -2,6 +2,7 @@ import os
 import sys
 import asyncio
 import traceback
+import threading
 
 import nodes
 import folder_paths
@@ -11,12 +12,14 @@ import urllib
 import json
 import glob
 import struct
+import hashlib
 import ssl
 import socket
 import ipaddress
 from PIL import Image, ImageOps
 from PIL.PngImagePlugin import PngInfo
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 
 import aiohttp
 from aiohttp import web
@@ -39,6 +42,41 @@ class BinaryEventTypes:
     PREVIEW_IMAGE = 1
     UNENCODED_PREVIEW_IMAGE = 2
 
+# Names used to subscribe to binary events with the events parameter of /ws
+BINARY_EVENT_NAMES = {
+    BinaryEventTypes.PREVIEW_IMAGE: "preview_image",
+    BinaryEventTypes.UNENCODED_PREVIEW_IMAGE: "preview_image",
+}
+
+# Oldest registered prompt templates are dropped past this many
+MAXIMUM_PROMPT_TEMPLATES = 100
+
+# Preview images are resized and encoded on these threads instead of the event loop
+PREVIEW_ENCODE_WORKERS = min(4, os.cpu_count() or 1)
+
+def encode_preview_image(image_data):
+    image_type = image_data[0]
+    image = image_data[1]
+    max_size = image_data[2]
+    if max_size is not None:
+        if hasattr(Image, 'Resampling'):
+            resampling = Image.Resampling.BILINEAR
+        else:
+            resampling = Image.ANTIALIAS
+
+        image = ImageOps.contain(image, (max_size, max_size), resampling)
+    type_num = 1
+    if image_type == "JPEG":
+        type_num = 1
+    elif image_type == "PNG":
+        type_num = 2
+
+    bytesIO = BytesIO()
+    header = struct.pack(">I", type_num)
+    bytesIO.write(header)
+    image.save(bytesIO, format=image_type, quality=95, compress_level=1)
+    return bytesIO.getvalue()
+
 async def send_socket_catch_exception(function, message):
     try:
         await function(message)
@@ -148,6 +186,15 @@ class PromptServer():
         self.messages = asyncio.Queue()
         self.client_session:Optional[aiohttp.ClientSession] = None
         self.number = 0
+        self.prompt_templates = {}
+        self.image_encode_executor = ThreadPoolExecutor(max_workers=PREVIEW_ENCODE_WORKERS, thread_name_prefix="preview_encode")
+        self.pending_previews = {}
+        self.preview_tasks = {}
+        self.socket_events = dict()
+        self.pending_progress = {}
+        self.progress_lock = threading.Lock()
+        # Set by the prompt worker once it can run prompts, after restoring the --warm-state
+        self.ready = threading.Event()
 
         middlewares = [cache_control]
         if args.enable_cors_header:
@@ -182,6 +229,9 @@ class PromptServer():
             else:
                 sid = uuid.uuid4().hex
 
+            # Optional comma separated list of the events this client wants, all events if not set
+            events = request.rel_url.query.get('events', '')
+            self.socket_events[sid] = set(events.split(',')) if events else None
             self.sockets[sid] = ws
 
             try:
@@ -196,6 +246,7 @@ class PromptServer():
                         logging.warning('ws connection closed with exception %s' % ws.exception())
             finally:
                 self.sockets.pop(sid, None)
+                self.socket_events.pop(sid, None)
             return ws
 
         @routes.get("/")
@@ -510,6 +561,8 @@ class PromptServer():
                     "os": os.name,
                     "ram_total": ram_total,
                     "ram_free": ram_free,
+                    "pinned_memory_total": comfy.model_management.pinned_memory_total(),
+                    "pinned_memory_used": comfy.model_management.pinned_memory_used(),
                     "comfyui_version": __version__,
                     "python_version": sys.version,
                     "pytorch_version": comfy.model_management.torch_version,
@@ -530,6 +583,11 @@ class PromptServer():
             }
             return web.json_response(system_stats)
 
+        @routes.get("/ready")
+        async def get_ready(request):
+            ready = self.ready.is_set()
+            return web.json_response({"ready": ready}, status=200 if ready else 503)
+
         @routes.get("/prompt")
         async def get_prompt(request):
             return web.json_response(self.get_queue_info())
@@ -610,37 +668,46 @@ class PromptServer():
             json_data =  await request.json()
             json_data = self.trigger_on_prompt(json_data)
 
-            if "number" in json_data:
-                number = float(json_data['number'])
-            else:
-                number = self.number
-                if "front" in json_data:
-                    if json_data['front']:
-                        number = -number
-
-                self.number += 1
-
             if "prompt" in json_data:
                 prompt = json_data["prompt"]
                 valid = execution.validate_prompt(prompt)
-                extra_data = {}
-                if "extra_data" in json_data:
-                    extra_data = json_data["extra_data"]
-
-                if "client_id" in json_data:
-                    extra_data["client_id"] = json_data["client_id"]
-                if valid[0]:
-                    prompt_id = str(uuid.uuid4())
-                    outputs_to_execute = valid[2]
-                    self.prompt_queue.put((number, prompt_id, prompt, extra_data, outputs_to_execute))
-                    response = {"prompt_id": prompt_id, "number": number, "node_errors": valid[3]}
-                    return web.json_response(response)
-                else:
-                    logging.warning("invalid prompt: {}".format(valid[1]))
-                    return web.json_response({"error": valid[1], "node_errors": valid[3]}, status=400)
+                return self.queue_prompt(json_data, prompt, valid)
             else:
                 return web.json_response({"error": "no prompt", "node_errors": []}, status=400)
 
+        @routes.post("/prompt_template")
+        async def post_prompt_template(request):
+            json_data = await request.json()
+            if "prompt" not in json_data:
+                return web.json_response({"error": "no prompt", "node_errors": []}, status=400)
+
+            prompt = json_data["prompt"]
+            template_id = hashlib.sha256(json.dumps(prompt, sort_keys=True).encode("utf-8")).hexdigest()
+            template = self.prompt_templates.pop(template_id, None)
+            if template is None:
+                template = execution.PromptTemplate(prompt)
+            if len(self.prompt_templates) >= MAXIMUM_PROMPT_TEMPLATES:
+                self.prompt_templates.pop(next(iter(self.prompt_templates)))
+            self.prompt_templates[template_id] = template
+
+            valid = template.valid
+            if valid[0]:
+                return web.json_response({"template_id": template_id, "node_errors": valid[3]})
+            else:
+                logging.warning("invalid prompt template: {}".format(valid[1]))
+                return web.json_response({"error": valid[1], "node_errors": valid[3]}, status=400)
+
+        @routes.post("/prompt_template/{template_id}")
+        async def post_prompt_template_instance(request):
+            template_id = request.match_info.get("template_id", None)
+            template = self.prompt_templates.get(template_id)
+            if template is None:
+                return web.json_response({"error": "unknown template", "node_errors": []}, status=404)
+
+            json_data = await request.json()
+            prompt, valid = template.instantiate(json_data.get("overrides", {}))
+            return self.queue_prompt(json_data, prompt, valid)
+
         @routes.post("/queue")
         async def post_queue(request):
             json_data =  await request.json()
@@ -716,6 +783,38 @@ class PromptServer():
             web.static('/', self.web_root),
         ])
 
+    def queue_prompt(self, json_data, prompt, valid):
+        if "number" in json_data:
+            number = float(json_data['number'])
+        else:
+            number = self.number
+            if "front" in json_data:
+                if json_data['front']:
+                    number = -number
+
+            self.number += 1
+
+        extra_data = {}
+        if "extra_data" in json_data:
+            extra_data = json_data["extra_data"]
+
+        if "client_id" in json_data:
+            extra_data["client_id"] = json_data["client_id"]
+        for name in ("priority", "deadline"):
+            value = extra_data.get(name, None)
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+                error = {"type": "invalid_prompt", "message": "extra_data {} must be a number".format(name), "details": "", "extra_info": {}}
+                return web.json_response({"error": error, "node_errors": {}}, status=400)
+        if valid[0]:
+            prompt_id = str(uuid.uuid4())
+            outputs_to_execute = valid[2]
+            self.prompt_queue.put((number, prompt_id, prompt, extra_data, outputs_to_execute))
+            response = {"prompt_id": prompt_id, "number": number, "node_errors": valid[3]}
+            return web.json_response(response)
+        else:
+            logging.warning("invalid prompt: {}".format(valid[1]))
+            return web.json_response({"error": valid[1], "node_errors": valid[3]}, status=400)
+
     def get_queue_info(self):
         prompt_info = {}
         exec_info = {}
@@ -741,60 +840,100 @@ class PromptServer():
         return message
 
     async def send_image(self, image_data, sid=None):
-        image_type = image_data[0]
-        image = image_data[1]
-        max_size = image_data[2]
-        if max_size is not None:
-            if hasattr(Image, 'Resampling'):
-                resampling = Image.Resampling.BILINEAR
-            else:
-                resampling = Image.ANTIALIAS
-
-            image = ImageOps.contain(image, (max_size, max_size), resampling)
-        type_num = 1
-        if image_type == "JPEG":
-            type_num = 1
-        elif image_type == "PNG":
-            type_num = 2
-
-        bytesIO = BytesIO()
-        header = struct.pack(">I", type_num)
-        bytesIO.write(header)
-        image.save(bytesIO, format=image_type, quality=95, compress_level=1)
-        preview_bytes = bytesIO.getvalue()
+        preview_bytes = await self.loop.run_in_executor(self.image_encode_executor, encode_preview_image, image_data)
         await self.send_bytes(BinaryEventTypes.PREVIEW_IMAGE, preview_bytes, sid=sid)
 
+    def queue_preview_image(self, image_data, sid=None):
+        # Only the newest preview of each client waits to be encoded, older ones are dropped
+        self.pending_previews[sid] = image_data
+        if sid not in self.preview_tasks:
+            self.preview_tasks[sid] = self.loop.create_task(self.send_preview_images(sid))
+
+    async def send_preview_images(self, sid):
+        while sid in self.pending_previews:
+            image_data = self.pending_previews.pop(sid)
+            await self.send_image(image_data, sid=sid)
+        self.preview_tasks.pop(sid, None)
+
+    async def flush_preview_images(self, sid=None):
+        # Previews of a node are sent before the messages that follow them, e.g. the executing message of the next node
+        sids = list(self.preview_tasks.keys()) if sid is None else [sid]
+        for preview_sid in sids:
+            task = self.preview_tasks.get(preview_sid, None)
+            if task is not None:
+                await task
+
+    def wants_event(self, sid, event):
+        events = self.socket_events.get(sid)
+        if events is None:
+            return True
+        if isinstance(event, int):
+            event = BINARY_EVENT_NAMES.get(event, str(event))
+        return event in events
+
     async def send_bytes(self, event, data, sid=None):
         message = self.encode_bytes(event, data)
 
         if sid is None:
-            sockets = list(self.sockets.values())
-            for ws in sockets:
-                await send_socket_catch_exception(ws.send_bytes, message)
-        elif sid in self.sockets:
+            sockets = list(self.sockets.items())
+            for ws_sid, ws in sockets:
+                if self.wants_event(ws_sid, event):
+                    await send_socket_catch_exception(ws.send_bytes, message)
+        elif sid in self.sockets and self.wants_event(sid, event):
             await send_socket_catch_exception(self.sockets[sid].send_bytes, message)
 
     async def send_json(self, event, data, sid=None):
-        message = {"type": event, "data": data}
+        # Serialized once no matter how many sockets the message goes to
+        message = json.dumps({"type": event, "data": data})
 
         if sid is None:
-            sockets = list(self.sockets.values())
-            for ws in sockets:
-                await send_socket_catch_exception(ws.send_json, message)
-        elif sid in self.sockets:
-            await send_socket_catch_exception(self.sockets[sid].send_json, message)
+            sockets = list(self.sockets.items())
+            for ws_sid, ws in sockets:
+                if self.wants_event(ws_sid, event):
+                    await send_socket_catch_exception(ws.send_str, message)
+        elif sid in self.sockets and self.wants_event(sid, event):
+            await send_socket_catch_exception(self.sockets[sid].send_str, message)
 
     def send_sync(self, event, data, sid=None):
+        if sid is not None and not self.wants_event(sid, event):
+            return
+
+        if event == "progress":
+            # Progress is coalesced per client, only the latest value is sent once the loop gets to it
+            with self.progress_lock:
+                flush_scheduled = sid in self.pending_progress
+                self.pending_progress[sid] = data
+            if not flush_scheduled:
+                self.loop.call_soon_threadsafe(self.flush_progress, sid)
+            return
+
+        with self.progress_lock:
+            progress = self.pending_progress.pop(sid, None)
+        if progress is not None:
+            # Keep the pending progress ahead of the messages that follow it
+            self.loop.call_soon_threadsafe(
+                self.messages.put_nowait, ("progress", progress, sid))
         self.loop.call_soon_threadsafe(
             self.messages.put_nowait, (event, data, sid))
 
+    def flush_progress(self, sid):
+        with self.progress_lock:
+            progress = self.pending_progress.pop(sid, None)
+        if progress is not None:
+            self.messages.put_nowait(("progress", progress, sid))
+
     def queue_updated(self):
         self.send_sync("status", { "status": self.get_queue_info() })
 
     async def publish_loop(self):
         while True:
             msg = await self.messages.get()
-            await self.send(*msg)
+            if msg[0] == BinaryEventTypes.UNENCODED_PREVIEW_IMAGE:
+                self.queue_preview_image(msg[1], msg[2])
+            else:
+                if msg[0] != "progress":
+                    await self.flush_preview_images(msg[2])
+                await self.send(*msg)
 
     async def start(self, address, port, verbose=True, call_on_start=None):
         await self.start_multi_address([(address, port)], call_on_start=call_on_start)
@@ -0,0 +1,44 @@
+import os
+import torch
+from comfy.cli_args import args
+import comfy.checkpoint_cache as checkpoint_cache
+
+
+def test_config_round_trip():
+    config = {"dtype": torch.float16, "channel_mult": [1, 2, 4], "context_dim": 768, "image_model": "flux", "nested": {"a": None}}
+    encoded = checkpoint_cache.encode_config(config)
+    assert checkpoint_cache.decode_config(encoded) == config
+    assert checkpoint_cache.decode_config(checkpoint_cache.encode_config(None)) is None
+
+
+def test_cache_path_changes_with_file(tmp_path, monkeypatch):
+    ckpt = tmp_path / "model.safetensors"
+    ckpt.write_bytes(b"\0" * 16)
+    monkeypatch.setattr(args, "checkpoint_cache_dir", None)
+    assert checkpoint_cache.get_cache_path(str(ckpt), []) is None
+
+    monkeypatch.setattr(args, "checkpoint_cache_dir", str(tmp_path / "cache"))
+    path = checkpoint_cache.get_cache_path(str(ckpt), [True, True, {}, {}])
+    assert os.path.basename(path).startswith("model.")
+    assert checkpoint_cache.get_cache_path(str(ckpt), [True, True, {}, {}]) == path
+    assert checkpoint_cache.get_cache_path(str(ckpt), [True, True, {"dtype": torch.float16}, {}]) != path
+
+    os.utime(ckpt, ns=(0, 0))
+    assert checkpoint_cache.get_cache_path(str(ckpt), [True, True, {}, {}]) != path
+    assert checkpoint_cache.load(path) is None
+
+
+def test_least_recently_used_checkpoints_are_removed(tmp_path, monkeypatch):
+    monkeypatch.setattr(args, "checkpoint_cache_size", 2048 / (1024 ** 3))
+    for i, name in enumerate(["old", "new"]):
+        path = tmp_path / "{}.safetensors".format(name)
+        path.write_bytes(b"\0" * 1024)
+        os.utime(path, (i, i))
+
+    checkpoint_cache.write(str(tmp_path / "large.safetensors"), {"w": torch.zeros(1024)}, {})
+    assert not (tmp_path / "large.safetensors").exists()
+    assert (tmp_path / "old.safetensors").exists()
+
+    checkpoint_cache.write(str(tmp_path / "cached.safetensors"), {"w": torch.zeros(16)}, {})
+    assert (tmp_path / "cached.safetensors").exists()
+    assert not (tmp_path / "old.safetensors").exists() and (tmp_path / "new.safetensors").exists()
@@ -0,0 +1,54 @@
+import torch
+import comfy.model_patcher
+import comfy.sd
+from comfy.conditioning_cache import ConditioningCache, freeze, get_key
+
+
+def make_encoding(size):
+    return {"cond": torch.zeros(size // 4), "pooled_output": None}
+
+
+def test_least_recently_used_encodings_are_dropped():
+    cache = ConditioningCache(1024)
+    cache.put("a", make_encoding(512))
+    cache.put("b", make_encoding(256))
+    assert cache.get("a") is not None
+    cache.put("c", make_encoding(512))
+    assert cache.get("b") is None and cache.get("a") is not None and cache.get("c") is not None
+    assert cache.total_bytes == 1024
+
+    # Larger than the whole cache
+    cache.put("d", make_encoding(2048))
+    assert cache.get("d") is None and cache.total_bytes == 1024
+
+
+def test_get_returns_a_copy():
+    cache = ConditioningCache(1024)
+    cache.put("a", make_encoding(16))
+    cache.get("a")["hooks"] = object()
+    assert "hooks" not in cache.get("a")
+
+
+def test_freeze_embeddings():
+    tokens = {"l": [[(1, 1.0), (torch.ones(4), 1.2)]]}
+    same = {"l": [[(1, 1.0), (torch.ones(4), 1.2)]]}
+    other = {"l": [[(1, 1.0), (torch.zeros(4), 1.2)]]}
+    assert freeze(tokens) == freeze(same)
+    assert freeze(tokens) != freeze(other)
+
+
+def test_key_follows_lora_content():
+    """The same LoRA loaded again in a new clone shares the encodings, another strength doesn't"""
+    def make_clip(model, strength):
+        clip = comfy.sd.CLIP.__new__(comfy.sd.CLIP)
+        clip.cond_stage_model = model
+        clip.patcher = comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+        clip.layer_idx = None
+        clip.apply_hooks_to_conds = None
+        clip.patcher.add_patches({"weight": ("lora", (torch.ones(4, 1), torch.ones(1, 4), None, None, None, None))}, strength)
+        return clip
+
+    model = torch.nn.Linear(4, 4)
+    tokens = {"l": [[(1, 1.0)]]}
+    assert get_key(make_clip(model, 1.0), tokens, True) == get_key(make_clip(model, 1.0), tokens, True)
+    assert get_key(make_clip(model, 1.0), tokens, True) != get_key(make_clip(model, 0.5), tokens, True)
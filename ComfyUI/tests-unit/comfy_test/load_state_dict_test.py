@@ -0,0 +1,42 @@
+import torch
+import safetensors.torch
+import comfy.utils
+
+
+class TiedModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embed = torch.nn.Embedding(4, 8)
+        self.proj = torch.nn.Linear(8, 8)
+        self.out = torch.nn.Linear(8, 4, bias=False)
+        self.out.weight = self.embed.weight
+        self.fp16 = torch.nn.Linear(8, 8).half()
+
+
+def test_load_state_dict_uses_mapped_tensors(tmp_path):
+    source = TiedModel()
+    path = str(tmp_path / "model.safetensors")
+    sd = {k: v for k, v in source.state_dict().items() if k != "out.weight"}
+    sd["fp16.weight"] = sd["fp16.weight"].float()
+    safetensors.torch.save_file(sd, path)
+
+    sd = comfy.utils.load_torch_file(path)
+    model = TiedModel()
+    m, u = comfy.utils.load_state_dict(model, sd)
+    assert m == ["out.weight"] and u == []
+
+    assert model.proj.weight.data_ptr() == sd["proj.weight"].data_ptr()
+    assert model.embed.weight.data_ptr() == sd["embed.weight"].data_ptr()
+    assert model.out.weight is model.embed.weight
+    # Different dtype, copied
+    assert model.fp16.weight.dtype == torch.float16
+    assert model.fp16.weight.data_ptr() != sd["fp16.weight"].data_ptr()
+    for k, v in source.state_dict().items():
+        assert torch.allclose(model.state_dict()[k].float(), v.float(), atol=1e-3)
+
+
+def test_load_state_dict_missing_keys():
+    model = torch.nn.Linear(2, 2)
+    m, u = comfy.utils.load_state_dict(model, {"weight": torch.zeros(2, 2), "extra": torch.zeros(1)})
+    assert m == ["bias"] and u == ["extra"]
+    assert torch.equal(model.weight, torch.zeros(2, 2))
@@ -0,0 +1,57 @@
+import torch
+import comfy.model_management as model_management
+
+
+class FakePatcher:
+    def __init__(self):
+        self.model = torch.nn.Linear(1, 1)
+
+
+class FakeLoadedModel:
+    def __init__(self, name, unloaded):
+        self.name = name
+        self.model = FakePatcher()
+        self.device = torch.device("cpu")
+        self.currently_used = True
+        self.unloaded = unloaded
+
+    def is_dead(self):
+        return False
+
+    def model_unload(self, memory_to_free=None):
+        self.unloaded.append(self.name)
+        return True
+
+
+def make_models(monkeypatch):
+    unloaded = []
+    models = {name: FakeLoadedModel(name, unloaded) for name in ("cold", "hot", "queued", "slow")}
+    monkeypatch.setattr(model_management, "current_loaded_models", list(models.values()))
+    for name, model in models.items():
+        stats = model_management.get_model_stats(model.model)
+        stats.load_rate = 1e-9
+        stats.use_count = 1
+        stats.last_used = 1000.0
+        stats.sources.add(name + ".safetensors")
+    return models, unloaded
+
+
+def test_reload_cost_policy(monkeypatch):
+    """Cold and cheap to reload models are unloaded first, models queued prompts use last"""
+    models, unloaded = make_models(monkeypatch)
+    model_management.get_model_stats(models["cold"].model).last_used = 0.0
+    model_management.get_model_stats(models["hot"].model).use_count = 5
+    model_management.get_model_stats(models["slow"].model).load_rate = 3e-9
+    monkeypatch.setattr(model_management, "queued_model_files", lambda: {"queued.safetensors": 2})
+    monkeypatch.setattr(model_management.time, "time", lambda: 1000.0)
+    monkeypatch.setattr(model_management, "eviction_policy", model_management.ReloadCostEvictionPolicy(half_life=600.0))
+
+    model_management.free_memory(1e30, torch.device("cpu"))
+    assert unloaded == ["cold", "slow", "hot", "queued"]
+
+
+def test_keep_loaded(monkeypatch):
+    models, unloaded = make_models(monkeypatch)
+    monkeypatch.setattr(model_management, "queued_model_files", None)
+    model_management.free_memory(1e30, torch.device("cpu"), keep_loaded=[models["hot"]])
+    assert "hot" not in unloaded and len(unloaded) == 3
@@ -0,0 +1,63 @@
+import gc
+import torch
+import comfy.model_management
+import comfy.model_patcher
+import comfy.ops
+from comfy.pinned_memory import PinnedArena
+
+
+def test_ranges_are_freed_with_their_tensors():
+    arena = PinnedArena(1024, pin=False)
+    a = arena.empty_like(torch.zeros(10))
+    b = arena.empty_like(torch.zeros(3, 4, dtype=torch.float16))
+    assert a.shape == (10,) and b.dtype == torch.float16
+    assert arena.used == 128
+
+    # Views keep the range allocated
+    view = a.view(2, 5)
+    del a
+    gc.collect()
+    assert arena.used == 128
+    del view
+    assert arena.used == 64 and arena.free_ranges == [(0, 64), (128, 896)]
+
+    del b
+    assert arena.used == 0 and arena.free_ranges == [(0, 1024)]
+
+
+def test_full_arena_returns_none():
+    arena = PinnedArena(256, pin=False)
+    a = arena.empty_like(torch.zeros(48))
+    assert arena.empty_like(torch.zeros(32)) is None
+    del a
+    assert arena.empty_like(torch.zeros(64)) is not None
+
+
+def test_pin_module_falls_back_to_pageable_memory():
+    module = torch.nn.Sequential(torch.nn.Linear(16, 16), torch.nn.Linear(16, 16))
+    expected = [p.detach().clone() for p in module.parameters()]
+    arena = PinnedArena(16 * 16 * 4 + 64, pin=False)
+
+    assert arena.pin_module(module) == 16 * 16 * 4 + 16 * 4
+    for p, e in zip(module.parameters(), expected):
+        assert torch.equal(p, e)
+    assert module[0].weight.data_ptr() == arena.buffer.data_ptr()
+    assert module[1].weight.data_ptr() != arena.buffer.data_ptr()
+
+    module.to(torch.float16)
+    assert arena.used == 0
+
+
+def test_partial_unload_synchronizes_once(monkeypatch):
+    model = torch.nn.Sequential(*[comfy.ops.disable_weight_init.Linear(16, 16) for _ in range(4)])
+    model.model_lowvram = False
+    model.lowvram_patch_counter = 0
+    model.device = torch.device("cpu")
+    patcher = comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+    patcher.patch_model(torch.device("cpu"))
+
+    synchronized = []
+    monkeypatch.setattr(comfy.model_management, "get_pinned_arena", lambda: PinnedArena(1024 * 1024, pin=False))
+    monkeypatch.setattr(torch.cuda, "synchronize", lambda: synchronized.append(True))
+    patcher.partially_unload(torch.device("cpu"), memory_to_free=1024 * 1024)
+    assert len(synchronized) == 1
@@ -0,0 +1,76 @@
+import torch
+from comfy.cli_args import args
+import comfy.model_patcher
+import comfy.ops
+import comfy.weight_cache
+
+ops = comfy.ops.disable_weight_init
+
+
+class Model(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = ops.Conv2d(4, 8, 3, padding=1)
+        self.linear = ops.Linear(8, 6)
+        self.model_lowvram = False
+        self.lowvram_patch_counter = 0
+        self.device = torch.device("cpu")
+        for param in self.parameters():
+            torch.nn.init.normal_(param)
+
+    def forward(self, x):
+        return self.linear(self.conv(x).mean((2, 3)))
+
+
+def make_lora(seed):
+    generator = torch.Generator().manual_seed(seed)
+    return {
+        "conv.weight": ("lora", (torch.randn(8, 2, 1, 1, generator=generator), torch.randn(2, 4, 3, 3, generator=generator), 1.0, None, None, None)),
+        "linear.weight": ("lora", (torch.randn(6, 2, generator=generator), torch.randn(2, 8, generator=generator), None, None, None, None)),
+    }
+
+
+def run(monkeypatch, model, lora, x, lora_mode, force_patch_weights=False):
+    monkeypatch.setattr(args, "lora_mode", lora_mode)
+    patcher = comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+    patcher.add_patches(lora, 0.5)
+    patcher.patch_model(torch.device("cpu"), force_patch_weights=force_patch_weights)
+    runtime = model.linear.runtime_loras is not None and model.conv.runtime_loras is not None
+    out = model(x)
+    patcher.unpatch_model(torch.device("cpu"))
+    return runtime, out
+
+
+def test_runtime_loras_match_merged_loras(monkeypatch):
+    model = Model()
+    x = torch.randn(1, 4, 5, 5)
+    base = model(x)
+    monkeypatch.setattr(comfy.weight_cache.cache, "max_bytes", 0)
+    runtime, merged = run(monkeypatch, model, make_lora(0), x, "merge")
+    assert not runtime
+    runtime, out = run(monkeypatch, model, make_lora(0), x, "runtime")
+    assert runtime
+    assert torch.allclose(out, merged, atol=1e-4)
+    assert model.linear.runtime_loras is None and torch.equal(model(x), base)
+
+
+def test_force_patch_weights_merges_loras(monkeypatch):
+    """Saving a model or extracting a LoRA force-patches the weights, which must include the LoRAs"""
+    model = Model()
+    x = torch.randn(1, 4, 5, 5)
+    monkeypatch.setattr(comfy.weight_cache.cache, "max_bytes", 0)
+    merged = run(monkeypatch, model, make_lora(0), x, "merge")[1]
+    runtime, out = run(monkeypatch, model, make_lora(0), x, "runtime", force_patch_weights=True)
+    assert not runtime
+    assert torch.equal(out, merged)
+
+
+def test_auto_mode_switches_when_the_loras_change(monkeypatch):
+    model = Model()
+    x = torch.randn(1, 4, 5, 5)
+    # Kept alive so the patch sets, told apart by their tensors, don't reuse each other's ids
+    loras = [make_lora(i) for i in range(3)]
+    assert not run(monkeypatch, model, loras[0], x, "auto")[0]
+    assert not run(monkeypatch, model, loras[0], x, "auto")[0]
+    assert not run(monkeypatch, model, loras[1], x, "auto")[0]
+    assert run(monkeypatch, model, loras[2], x, "auto")[0]
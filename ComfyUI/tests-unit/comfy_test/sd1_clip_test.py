@@ -0,0 +1,63 @@
+import os
+import torch
+from comfy.sd1_clip import ClipTokenWeightEncoder
+
+
+class FakeEncoder(ClipTokenWeightEncoder):
+    special_tokens = {"start": 1, "end": 2, "pad": 2}
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def encode(self, tokens):
+        self.batch_sizes.append(len(tokens))
+        tokens = torch.tensor(tokens, dtype=torch.float32)
+        # Every position depends on the whole section, like attention
+        out = tokens.unsqueeze(-1) * torch.arange(1, 5) + tokens.sum(dim=1, keepdim=True).unsqueeze(-1)
+        return out, out[:, 0]
+
+
+def make_tokens(*sections):
+    return [[(t, w) for t, w in section] for section in sections]
+
+
+def test_batch_matches_single_prompts():
+    prompts = [
+        make_tokens([(1, 1.0), (5, 1.2), (2, 1.0)]),
+        make_tokens([(1, 1.0), (7, 1.0), (2, 1.0)], [(1, 1.0), (8, 0.5), (2, 1.0)]),
+    ]
+    encoder = FakeEncoder()
+    single = [encoder.encode_token_weights(p) for p in prompts]
+    batch = encoder.encode_token_weights_batch(prompts)
+    # All sections plus one empty section
+    assert encoder.batch_sizes[-1] == 4
+
+    for (cond, pooled), (batch_cond, batch_pooled) in zip(single, batch):
+        assert torch.equal(cond, batch_cond)
+        assert torch.equal(pooled, batch_pooled)
+
+
+def test_sections_of_different_lengths_are_encoded_one_by_one():
+    prompts = [make_tokens([(1, 1.0), (2, 1.0)]), make_tokens([(1, 1.0), (5, 1.0), (2, 1.0)]), make_tokens()]
+    encoder = FakeEncoder()
+    batch = encoder.encode_token_weights_batch(prompts)
+    assert encoder.batch_sizes == [1, 1, 1]
+    assert [cond.shape[1] for cond, pooled in batch] == [2, 3, 2]
+
+
+def test_tokenizer_sees_new_embedding_files(tmp_path):
+    import safetensors.torch
+    from comfy.sd1_clip import SDTokenizer
+
+    tokenizer = SDTokenizer(embedding_directory=str(tmp_path))
+    text = "a (photo:1.2) of embedding:style"
+    tokens = tokenizer.tokenize_with_weights(text)
+    assert all(not torch.is_tensor(t) for t, w in tokens[0])
+    assert tokenizer.tokenize_with_weights(text) == tokens
+    # Copies of the memoized tokens
+    assert tokenizer.tokenize_with_weights(text)[0] is not tokens[0]
+
+    os.makedirs(tmp_path / "styles")
+    safetensors.torch.save_file({"emb_params": torch.ones(2, 768)}, str(tmp_path / "styles" / "style.safetensors"))
+    tokens = tokenizer.tokenize_with_weights(text)
+    assert sum(1 for t, w in tokens[0] if torch.is_tensor(t)) == 2
@@ -0,0 +1,81 @@
+import torch
+import comfy.lora
+import comfy.model_patcher
+import comfy.weight_cache
+from comfy.weight_cache import PatchedWeightCache
+
+
+class Model(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.layers = torch.nn.ModuleList([torch.nn.Linear(32, 32) for _ in range(3)])
+        self.model_lowvram = False
+        self.lowvram_patch_counter = 0
+        self.device = torch.device("cpu")
+
+
+def make_lora(seed):
+    generator = torch.Generator().manual_seed(seed)
+    return {"layers.{}.weight".format(i): ("lora", (torch.randn(32, 4, generator=generator), torch.randn(4, 32, generator=generator), 2.0, None, None, None)) for i in range(3)}
+
+
+def load(model, lora):
+    patcher = comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+    patcher.add_patches(lora, 0.5)
+    patcher.patch_model(torch.device("cpu"))
+    weights = [layer.weight.clone() for layer in model.layers]
+    patcher.unpatch_model(torch.device("cpu"))
+    return patcher, weights
+
+
+def test_least_recently_used_weights_are_dropped():
+    cache = PatchedWeightCache(1024)
+    cache.put("a", torch.zeros(128))
+    cache.put("b", torch.zeros(64))
+    assert cache.get("a") is not None
+    cache.put("c", torch.zeros(128))
+    assert cache.get("b") is None and cache.get("a") is not None and cache.get("c") is not None
+    assert cache.total_bytes == 1024
+
+
+def test_cached_weights_match_merged_weights(monkeypatch):
+    model = Model()
+    original = [layer.weight.clone() for layer in model.layers]
+    comfy.weight_cache.cache.clear()
+    max_bytes = comfy.weight_cache.cache.max_bytes
+    try:
+        comfy.weight_cache.cache.max_bytes = 0
+        _, merged = load(model, make_lora(1))
+
+        comfy.weight_cache.cache.max_bytes = 1024 * 1024
+        load(model, make_lora(1))
+        assert len(comfy.weight_cache.cache.entries) == 3
+        # A LoRA loaded again has new tensors with the same content
+        gets = []
+        get = comfy.weight_cache.cache.get
+        monkeypatch.setattr(comfy.weight_cache.cache, "get", lambda key: gets.append(key) or get(key))
+        patcher, cached = load(model, make_lora(1))
+        assert len(comfy.weight_cache.cache.entries) == 3
+        # Each weight is looked up once
+        assert len(gets) == 3
+        assert all(torch.equal(a, b) for a, b in zip(merged, cached))
+
+        patcher.add_patches(make_lora(2))
+        assert patcher.get_weight_cache_key("layers.0.weight") not in comfy.weight_cache.cache.entries
+    finally:
+        comfy.weight_cache.cache.max_bytes = max_bytes
+        comfy.weight_cache.cache.clear()
+    assert all(torch.equal(layer.weight, w) for layer, w in zip(model.layers, original))
+
+
+def test_batched_lora_products():
+    generator = torch.Generator().manual_seed(0)
+    patches = {"a{}".format(i): [(1.0, ("lora", (torch.randn(16, 4, generator=generator), torch.randn(4, 8, generator=generator), None, None, None, None)), 1.0, None, None)] for i in range(3)}
+    patches["conv"] = [(1.0, ("lora", (torch.randn(16, 4, 1, 1, generator=generator), torch.randn(4, 2, 3, 3, generator=generator), None, None, None, None)), 1.0, None, None)]
+    weights = {k: torch.randn(16, 8) for k in patches}
+    weights["conv"] = torch.randn(16, 2, 3, 3)
+
+    lora_diffs = comfy.lora.calculate_lora_diffs(patches, torch.device("cpu"))
+    for k in patches:
+        expected = comfy.lora.calculate_weight(patches[k], weights[k].clone(), k)
+        assert torch.allclose(comfy.lora.calculate_weight(patches[k], weights[k].clone(), k, lora_diffs=lora_diffs[k]), expected)
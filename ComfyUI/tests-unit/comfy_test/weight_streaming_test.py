@@ -0,0 +1,74 @@
+import time
+import torch
+import comfy.ops
+from comfy.weight_streaming import WeightStreamer
+
+
+class SlowWeightStreamer(WeightStreamer):
+    """Simulates a device copy that takes as long as computing a layer."""
+    def __init__(self, events, delay, window=2):
+        super().__init__(torch.device("cpu"), window=window)
+        self.events = events
+        self.delay = delay
+
+    def copy(self, module, dtype, bias_dtype, staging=None):
+        self.events.append(("copy start", module.index))
+        time.sleep(self.delay)
+        out = super().copy(module, dtype, bias_dtype, staging)
+        self.events.append(("copy end", module.index))
+        return out
+
+
+def make_model(streamer, events, delay, layers=4):
+    model = torch.nn.Sequential()
+    for i in range(layers):
+        layer = comfy.ops.manual_cast.Linear(8, 8)
+        torch.nn.init.normal_(layer.weight)
+        torch.nn.init.normal_(layer.bias)
+        layer.index = i
+        layer.comfy_weight_streamer = streamer
+
+        def compute_hook(module, input, output):
+            time.sleep(delay)
+            events.append(("compute", module.index))
+        layer.register_forward_hook(compute_hook)
+        model.append(layer)
+    return model
+
+
+def test_streamed_weights_overlap_compute():
+    """After the pass recording the layer order, the copies of the next layers run while a layer computes"""
+    events = []
+    streamer = SlowWeightStreamer(events, delay=0.05)
+    model = make_model(streamer, events, delay=0.05)
+    x = torch.randn(2, 8)
+
+    expected = x
+    for layer in model:
+        expected = torch.nn.functional.linear(expected, layer.weight, layer.bias)
+
+    with torch.no_grad():
+        assert torch.allclose(model(x), expected)
+        assert [e for e in events if e[0] == "copy start"] == [("copy start", i) for i in range(4)]
+        events.clear()
+        assert torch.allclose(model(x), expected)
+
+    # Layer 0 is copied when it is used, then queues the copies of layers 1 and 2
+    assert events.index(("copy start", 1)) < events.index(("compute", 0))
+    assert events.index(("copy start", 2)) < events.index(("compute", 1))
+    assert events.index(("copy start", 3)) < events.index(("compute", 2))
+    # Every layer is copied exactly once per pass
+    assert sorted(e for e in events if e[0] == "copy start") == [("copy start", i) for i in range(4)]
+    assert len(streamer.pending) == 0
+
+
+def test_window_limits_queued_copies():
+    events = []
+    streamer = SlowWeightStreamer(events, delay=0.0, window=1)
+    model = make_model(streamer, events, delay=0.0, layers=6)
+    x = torch.randn(2, 8)
+    with torch.no_grad():
+        model(x)
+        model(x)
+        model[0](x)
+        assert list(streamer.pending) == [id(model[1])]
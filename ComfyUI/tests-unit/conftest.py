@@ -0,0 +1,6 @@
+from comfy.cli_args import args
+
+
+def pytest_configure(config):
+    # comfy.model_management picks the device when the test modules import it
+    args.cpu = True
@@ -0,0 +1,56 @@
+import os
+import base64
+import importlib.util
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+spec = importlib.util.spec_from_file_location("memory_image_load", os.path.join(os.path.dirname(__file__), "..", "..", "custom_nodes", "memory_image_load.py"))
+memory_image_load = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(memory_image_load)
+LoadImageFromMemory = memory_image_load.LoadImageFromMemory
+
+
+def make_image_bytes(color, mode="RGB"):
+    buffer = BytesIO()
+    Image.new(mode, (8, 4), color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+@pytest.fixture(autouse=True)
+def images(monkeypatch):
+    monkeypatch.setattr(LoadImageFromMemory, "images", {})
+    return LoadImageFromMemory.images
+
+
+def test_keys_are_hashes_of_the_image_bytes(images):
+    red = make_image_bytes((255, 0, 0))
+    key = LoadImageFromMemory.register(red)
+    assert LoadImageFromMemory.register(make_image_bytes((255, 0, 0))) == key
+    assert LoadImageFromMemory.register(make_image_bytes((0, 0, 255))) != key
+    assert images[key][1] == 2
+
+    LoadImageFromMemory.release(key)
+    assert LoadImageFromMemory.VALIDATE_INPUTS(key) is True
+    LoadImageFromMemory.release(key)
+    assert key not in images
+    assert LoadImageFromMemory.VALIDATE_INPUTS(key) is not True
+
+
+def test_memory_and_base64_nodes_load_the_same_image():
+    image_bytes = make_image_bytes((255, 0, 0, 128), mode="RGBA")
+    key = LoadImageFromMemory.register(image_bytes)
+    image, mask = LoadImageFromMemory().load_image(key)
+    assert image.shape == (1, 4, 8, 3) and mask.shape == (1, 4, 8)
+    assert np.allclose(image[0, 0, 0].numpy(), [1.0, 0.0, 0.0])
+    assert np.allclose(mask.numpy(), 1.0 - 128 / 255)
+
+    image_base64 = base64.b64encode(image_bytes).decode()
+    base64_image, base64_mask = memory_image_load.LoadImageBase64().load_image(image_base64)
+    assert (base64_image == image).all() and (base64_mask == mask).all()
+
+    red = memory_image_load.LoadImageMaskFromMemory().load_image(key, "red")[0]
+    assert (red == memory_image_load.LoadImageMaskBase64().load_image(image_base64, "red")[0]).all()
+    assert np.allclose(red.numpy(), 1.0)
@@ -0,0 +1,61 @@
+import os
+import sys
+import struct
+import importlib.util
+from io import BytesIO
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+# nodes puts comfy/ first on sys.path, which would shadow the utils package for the other tests
+sys_path = list(sys.path)
+import server  # noqa: E402
+sys.path[:] = sys_path
+
+spec = importlib.util.spec_from_file_location("websocket_image_save", os.path.join(os.path.dirname(__file__), "..", "..", "custom_nodes", "websocket_image_save.py"))
+websocket_image_save = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(websocket_image_save)
+SaveImageWebsocket = websocket_image_save.SaveImageWebsocket
+
+
+def make_pixels():
+    pixels = np.zeros((4, 6, 3), dtype=np.uint8)
+    pixels[:, :3] = (255, 0, 0)
+    return pixels
+
+
+def test_raw_encoding():
+    pixels = make_pixels()
+    data = SaveImageWebsocket.encode_image(pixels, "RAW")
+    assert struct.unpack(">III", data[:12]) == (4, 6, 3)
+    assert np.array_equal(np.frombuffer(data[12:], dtype=np.uint8).reshape(4, 6, 3), pixels)
+
+
+@pytest.mark.parametrize("format", ["PNG", "JPEG", "WEBP"])
+def test_image_encodings(format):
+    pixels = make_pixels()
+    image = Image.open(BytesIO(SaveImageWebsocket.encode_image(pixels, format, quality=100)))
+    assert image.format == format and image.size == (6, 4)
+    if format == "PNG":
+        assert np.array_equal(np.array(image), pixels)
+
+
+def test_images_are_sent_with_their_format(monkeypatch):
+    sent = []
+    monkeypatch.setattr(server.PromptServer, "instance", SimpleNamespace(client_id="client", send_sync=lambda *message: sent.append(message)), raising=False)
+    images = torch.from_numpy(make_pixels()).float().div(255).repeat(2, 1, 1, 1)
+    SaveImageWebsocket().save_images(images, format="RAW")
+
+    assert len(sent) == 2
+    for event, data, sid in sent:
+        assert event == server.BinaryEventTypes.PREVIEW_IMAGE and sid == "client"
+        assert struct.unpack(">I", data[:4])[0] == websocket_image_save.IMAGE_FORMATS["RAW"]
+        assert np.array_equal(np.frombuffer(data[16:], dtype=np.uint8).reshape(4, 6, 3), make_pixels())
+
+
+def test_nothing_is_sent_without_a_server(monkeypatch):
+    monkeypatch.setattr(server.PromptServer, "instance", None, raising=False)
+    assert SaveImageWebsocket().save_images(torch.zeros(1, 4, 6, 3)) == {}
@@ -0,0 +1,57 @@
+from comfy_execution.batching import get_batch_signature, merge_prompts
+
+
+def make_prompt(text="a photo", seed=0, steps=20, image="image.png"):
+    return {
+        "1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "model.safetensors"}},
+        "2": {"class_type": "CLIPTextEncode", "inputs": {"text": text, "clip": ["1", 1]}},
+        "3": {"class_type": "CLIPTextEncode", "inputs": {"text": "blurry", "clip": ["1", 1]}},
+        "4": {"class_type": "LoadImage", "inputs": {"image": image}},
+        "5": {"class_type": "VAEEncode", "inputs": {"pixels": ["4", 0], "vae": ["1", 2]}},
+        "6": {"class_type": "KSampler", "inputs": {
+            "model": ["1", 0], "seed": seed, "steps": steps, "cfg": 8.0, "sampler_name": "euler", "scheduler": "normal",
+            "positive": ["2", 0], "negative": ["3", 0], "latent_image": ["5", 0], "denoise": 1.0}},
+        "7": {"class_type": "VAEDecode", "inputs": {"samples": ["6", 0], "vae": ["1", 2]}},
+        "8": {"class_type": "SaveImage", "inputs": {"images": ["7", 0], "filename_prefix": "ComfyUI"}},
+    }
+
+
+def test_batch_signature():
+    """Prompts differing only in text, seed and images have the same signature"""
+    signature = get_batch_signature(make_prompt())
+    assert signature is not None
+    assert get_batch_signature(make_prompt(text="a cat", seed=1, image="other.png")) == signature
+    assert get_batch_signature(make_prompt(steps=30)) != signature
+
+
+def test_batch_signature_without_sampler():
+    prompt = make_prompt()
+    del prompt["6"]
+    assert get_batch_signature(prompt) is None
+
+
+def test_merge_prompts():
+    """Shared nodes are kept once, the KSamplers are replaced by a single batch sampler"""
+    prompts = [make_prompt(text="a cat", seed=1), make_prompt(text="a dog", seed=2, image="other.png")]
+    merged, node_ids = merge_prompts(prompts)
+
+    for node_id in ("1", "3"):
+        assert merged[node_id] is prompts[0][node_id]
+        assert node_ids[0][node_id] == node_ids[1][node_id] == node_id
+
+    assert merged["2#0"]["inputs"] == {"text": "a cat", "clip": ["1", 1]}
+    assert merged["2#1"]["inputs"] == {"text": "a dog", "clip": ["1", 1]}
+    assert merged["5#1"]["inputs"]["pixels"] == ["4#1", 0]
+
+    assert merged["6#gather0"]["inputs"] == {"positive": ["2#0", 0], "negative": ["3", 0], "latent_image": ["5#0", 0], "seed": 1}
+    assert merged["6#gather1"]["inputs"]["batch"] == ["6#gather0", 0]
+    assert merged["6#sample"]["class_type"] == "KSamplerPromptBatch"
+    assert merged["6#sample"]["inputs"]["batch"] == ["6#gather1", 0]
+    assert merged["6#sample"]["inputs"]["model"] == ["1", 0]
+    assert merged["6#1"] == {"class_type": "PromptBatchSelect", "inputs": {"samples": ["6#sample", 0], "index": 1}}
+    assert merged["8#1"]["inputs"]["images"] == ["7#1", 0]
+    assert node_ids[1]["8"] == "8#1"
+
+
+def test_merge_prompts_different_settings():
+    assert merge_prompts([make_prompt(), make_prompt(steps=30)]) is None
@@ -0,0 +1,161 @@
+import sys
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+# nodes puts comfy/ first on sys.path, which would shadow the utils package for the other tests
+sys_path = list(sys.path)
+import comfy.model_management  # noqa: E402
+import nodes  # noqa: E402
+from comfy_execution.caching import CacheKeySetID, CacheKeySetInputSignature, LRUCache, Unhashable  # noqa: E402
+from comfy_execution.graph import DynamicPrompt  # noqa: E402
+sys.path[:] = sys_path
+
+CPU = torch.device("cpu")
+
+
+def make_prompt(*node_ids):
+    return DynamicPrompt({node_id: {"class_type": "Node", "inputs": {}} for node_id in node_ids})
+
+
+def run_prompt(cache, *node_ids):
+    cache.set_prompt(make_prompt(*node_ids), node_ids, {})
+
+
+def make_output(size):
+    return [[torch.zeros(size // 4)]]
+
+
+def is_cached(cache, node_id):
+    return (node_id, "Node") in cache.cache
+
+
+def test_least_recently_used_outputs_are_evicted():
+    cache = LRUCache(CacheKeySetID, max_bytes=512)
+    run_prompt(cache, "1", "2")
+    cache.set("1", make_output(256))
+    cache.set("2", make_output(256))
+
+    run_prompt(cache, "1", "3")
+    cache.set("3", make_output(256))
+    assert is_cached(cache, "1") and not is_cached(cache, "2") and is_cached(cache, "3")
+    assert cache.total_bytes() == 512
+
+
+def test_outputs_of_the_running_prompt_are_kept():
+    cache = LRUCache(CacheKeySetID, max_bytes=256)
+    run_prompt(cache, "1", "2")
+    cache.set("1", make_output(256))
+    cache.set("2", make_output(256))
+    assert is_cached(cache, "1") and is_cached(cache, "2")
+
+    # Only as many as needed to get under max_bytes are dropped
+    run_prompt(cache, "3")
+    cache.clean_unused()
+    assert not is_cached(cache, "1") and is_cached(cache, "2")
+    assert cache.total_bytes() == 256
+
+
+def test_sizes_are_updated_on_overwrite():
+    cache = LRUCache(CacheKeySetID)
+    run_prompt(cache, "1", "2")
+    cache.set("1", make_output(256))
+    cache.set("1", make_output(1024))
+    assert cache.total_bytes() == 1024
+
+    # Views of the same tensor and clones of the same model are counted once
+    tensor = torch.zeros(64)
+    model = SimpleNamespace(model=object(), model_size=lambda: 4096)
+    cache.set("1", [[tensor, tensor.view(8, 8)], [model, SimpleNamespace(model=model.model, model_size=model.model_size)]])
+    cache.set("2", [[model]])
+    assert cache.total_bytes() == 256 + 4096
+
+    cache._remove(("1", "Node"))
+    assert cache.total_bytes() == 4096
+    cache._remove(("2", "Node"))
+    assert cache.total_bytes() == 0 and cache.models == {}
+
+
+def test_free_memory_drops_least_recently_used_first(monkeypatch):
+    cache = LRUCache(CacheKeySetID)
+    for node_id in ("1", "2", "3"):
+        run_prompt(cache, node_id)
+        cache.set(node_id, make_output(256))
+    monkeypatch.setattr(comfy.model_management, "get_free_memory", lambda device: 1024 - cache.tensor_bytes)
+
+    cache.free_memory(400, CPU)
+    assert not is_cached(cache, "1") and is_cached(cache, "2") and is_cached(cache, "3")
+
+    # Outputs of the running prompt are kept
+    cache.free_memory(4096, CPU)
+    assert not is_cached(cache, "2") and is_cached(cache, "3")
+
+    # Other devices are left alone
+    run_prompt(cache, "4")
+    cache.free_memory(4096, torch.device("meta"))
+    assert is_cached(cache, "3")
+
+
+class PlainNode:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {}}
+
+
+class UniqueIdNode:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {}, "hidden": {"unique_id": "UNIQUE_ID"}}
+
+
+@pytest.fixture
+def node_classes(monkeypatch):
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "PlainNode", PlainNode)
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "UniqueIdNode", UniqueIdNode)
+
+
+def get_signature(prompt, node_id, is_changed=None):
+    is_changed = is_changed or {}
+    keys = CacheKeySetInputSignature(DynamicPrompt(prompt), [node_id], SimpleNamespace(get=lambda node_id: is_changed.get(node_id)))
+    return keys.get_data_key(node_id)
+
+
+def make_graph(loader_id="1", encoder_id="2", name="model", class_type="PlainNode"):
+    return {
+        loader_id: {"class_type": class_type, "inputs": {"name": name}},
+        encoder_id: {"class_type": "PlainNode", "inputs": {"text": "a photo", "clip": [loader_id, 1], "model": [loader_id, 0]}},
+    }
+
+
+def test_signatures_ignore_node_ids(node_classes):
+    signature = get_signature(make_graph(), "2")
+    assert isinstance(signature, str)
+    assert get_signature(make_graph("10", "20"), "20") == signature
+    assert get_signature(make_graph(name="other"), "2") != signature
+
+
+def test_unhashable_inputs_are_never_cached(node_classes):
+    for value in (float("nan"), object()):
+        graph = make_graph(name=value)
+        for node_id in ("1", "2"):
+            signature = get_signature(graph, node_id)
+            assert isinstance(signature, Unhashable)
+            assert signature != get_signature(graph, node_id)
+
+
+def test_unique_id_and_is_changed_change_the_key(node_classes):
+    assert get_signature(make_graph(class_type="UniqueIdNode"), "2") != get_signature(make_graph("10", "2", class_type="UniqueIdNode"), "2")
+    signature = get_signature(make_graph(), "2")
+    assert get_signature(make_graph(), "2", is_changed={"1": 1.0}) != signature
+    assert get_signature(make_graph(), "2", is_changed={"2": 1.0}) != signature
+
+
+def test_signatures_are_stable(node_classes):
+    signature = get_signature(make_graph(), "2")
+    graph = make_graph()
+    graph["2"]["inputs"] = dict(reversed(list(graph["2"]["inputs"].items())))
+    assert get_signature(graph, "2") == signature
+    # Swapping which outputs the links use changes the key
+    graph["2"]["inputs"]["clip"], graph["2"]["inputs"]["model"] = ["1", 0], ["1", 1]
+    assert get_signature(graph, "2") != signature
@@ -0,0 +1,106 @@
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+import torch
+import safetensors.torch
+
+# nodes puts comfy/ first on sys.path, which would shadow the utils package for the other tests
+sys_path = list(sys.path)
+from comfy_execution.caching import Unhashable  # noqa: E402
+from comfy_execution.persistent_cache import NotPersistable, PersistentCache, flatten, stable_digest, unflatten  # noqa: E402
+sys.path[:] = sys_path
+
+CACHE_KEY = frozenset([("text", "a photo"), ("seed", 1), ("inputs", (1.5, None, True))])
+
+
+def test_stable_digest_is_the_same_in_every_process():
+    digest = stable_digest(CACHE_KEY)
+    assert stable_digest(frozenset(reversed(list(CACHE_KEY)))) == digest
+    assert stable_digest(frozenset([("text", "a photo"), ("seed", 2), ("inputs", (1.5, None, True))])) != digest
+
+    # hash() of the strings in the key differs in a process with another seed
+    code = "from comfy.cli_args import args; args.cpu = True; from comfy_execution.persistent_cache import stable_digest; print(stable_digest({!r}))".format(CACHE_KEY)
+    env = dict(os.environ, PYTHONHASHSEED="1234")
+    cwd = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    output = subprocess.run([sys.executable, "-c", code], env=env, cwd=cwd, capture_output=True, text=True, check=True).stdout
+    assert output.strip().splitlines()[-1] == digest
+
+
+@pytest.mark.parametrize("cache_key", [Unhashable(), ("seed", float("nan")), ("seed", float("inf")), ("object", object())])
+def test_unpersistable_keys(tmp_path, cache_key):
+    with pytest.raises(NotPersistable):
+        stable_digest(cache_key)
+    assert PersistentCache(str(tmp_path), 1024).get_path(cache_key) is None
+
+
+def test_flatten_round_trip():
+    tensor = torch.arange(8, dtype=torch.float16)
+    value = [[{"samples": tensor, "batch_index": [0, 1]}], ([tensor.view(2, 4), ("a", 1.5, None)],)]
+    tensors = {}
+    structure = json.loads(json.dumps(flatten(value, tensors)))
+    result = unflatten(structure, tensors)
+
+    assert isinstance(result[1], tuple) and isinstance(result[1][0], list) and isinstance(result[1][0][1], tuple)
+    assert result[0][0]["batch_index"] == [0, 1] and result[1][0][1] == ("a", 1.5, None)
+    # Tensors sharing memory are stored separately
+    assert torch.equal(result[0][0]["samples"], tensor) and result[0][0]["samples"].dtype == torch.float16
+    assert torch.equal(result[1][0][0], tensor.view(2, 4))
+
+    with pytest.raises(NotPersistable):
+        flatten([object()], {})
+    with pytest.raises(NotPersistable):
+        flatten({1: tensor}, {})
+
+
+def test_write_and_get(tmp_path):
+    cache = PersistentCache(str(tmp_path), 1024 * 1024)
+    value = [[torch.ones(4, 4)], [{"pooled_output": None}]]
+    cache.write(cache.get_path(CACHE_KEY), value)
+    assert os.listdir(tmp_path) == [os.path.basename(cache.get_path(CACHE_KEY))]
+
+    result = cache.get(CACHE_KEY)
+    assert torch.equal(result[0][0], value[0][0]) and result[1] == value[1]
+    assert cache.get(("other", 1)) is None
+
+    # Outputs that can't be stored are skipped
+    cache.write(cache.get_path(("other", 1)), [[object()]])
+    assert len(os.listdir(tmp_path)) == 1
+
+
+def test_failed_writes_leave_no_files(tmp_path, monkeypatch):
+    def save_file(tensors, path, metadata=None):
+        with open(path, "wb") as f:
+            f.write(b"partial")
+        raise OSError("disk full")
+
+    cache = PersistentCache(str(tmp_path), 1024 * 1024)
+    monkeypatch.setattr(safetensors.torch, "save_file", save_file)
+    cache.write(cache.get_path(CACHE_KEY), [[torch.ones(4)]])
+    assert os.listdir(tmp_path) == [] and cache.size == 0
+
+
+def test_mismatched_dtypes_are_not_returned(tmp_path):
+    cache = PersistentCache(str(tmp_path), 1024 * 1024)
+    structure = {"list": [{"tensor": "0", "dtype": "torch.float32", "device": "cpu"}]}
+    safetensors.torch.save_file({"0": torch.ones(4, dtype=torch.float16)}, cache.get_path(CACHE_KEY), metadata={"structure": json.dumps(structure)})
+    assert cache.get(CACHE_KEY) is None
+
+
+def test_least_recently_used_files_are_evicted(tmp_path):
+    cache = PersistentCache(str(tmp_path), 1024 * 1024)
+    keys = [("seed", i) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.write(cache.get_path(key), [[torch.zeros(256)]])
+        os.utime(cache.get_path(key), (i, i))
+    file_size = os.path.getsize(cache.get_path(keys[0]))
+
+    # Reading a file makes it the most recently used
+    assert cache.get(keys[0]) is not None
+    cache.max_size = 2 * file_size
+    cache.write(cache.get_path(("seed", 3)), [[torch.zeros(256)]])
+    assert not os.path.exists(cache.get_path(keys[1])) and not os.path.exists(cache.get_path(keys[2]))
+    assert os.path.exists(cache.get_path(keys[0])) and os.path.exists(cache.get_path(("seed", 3)))
+    assert cache.size <= cache.max_size
@@ -0,0 +1,40 @@
+import os
+import time
+import pytest
+import folder_paths
+from comfy_execution.prefetch import ModelPrefetcher, get_model_files
+
+
+@pytest.fixture
+def model_dir(tmp_path, monkeypatch):
+    for folder_name in ("checkpoints", "loras"):
+        os.makedirs(tmp_path / folder_name)
+        monkeypatch.setitem(folder_paths.folder_names_and_paths, folder_name, ([str(tmp_path / folder_name)], {".safetensors"}))
+    for name in ("checkpoints/a.safetensors", "checkpoints/b.safetensors", "loras/c.safetensors"):
+        (tmp_path / name).write_bytes(b"\0" * 1024)
+    return tmp_path
+
+
+def make_item(number, ckpt_name, lora_name=None):
+    prompt = {"1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": ckpt_name}}}
+    if lora_name is not None:
+        prompt["2"] = {"class_type": "LoraLoader", "inputs": {"lora_name": lora_name, "model": ["1", 0], "clip": ["1", 1]}}
+    return (number, "prompt_{}".format(number), prompt, {}, [])
+
+
+def test_get_model_files(model_dir):
+    prompt = make_item(0, "a.safetensors", "c.safetensors")[2]
+    prompt["3"] = {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "missing.safetensors"}}
+    assert get_model_files(prompt) == [str(model_dir / "checkpoints/a.safetensors"), str(model_dir / "loras/c.safetensors")]
+
+
+def test_prefetch_skips_running_prompt(model_dir):
+    prefetcher = ModelPrefetcher()
+    queue = [make_item(2, "b.safetensors", "c.safetensors"), make_item(1, "a.safetensors")]
+    prefetcher.prefetch(queue, running=make_item(0, "a.safetensors"))
+
+    for _ in range(100):
+        if len(prefetcher.read_files) == 2:
+            break
+        time.sleep(0.01)
+    assert list(prefetcher.read_files) == [str(model_dir / "checkpoints/b.safetensors"), str(model_dir / "loras/c.safetensors")]
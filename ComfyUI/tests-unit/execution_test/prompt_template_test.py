@@ -0,0 +1,46 @@
+import sys
+
+# nodes puts comfy/ first on sys.path, which would shadow the utils package for the other tests
+sys_path = list(sys.path)
+from execution import PromptTemplate  # noqa: E402
+sys.path[:] = sys_path
+
+
+def make_prompt():
+    return {
+        "1": {"class_type": "EmptyLatentImage", "inputs": {"width": 64, "height": 64, "batch_size": 1}},
+        "2": {"class_type": "SaveLatent", "inputs": {"samples": ["1", 0], "filename_prefix": "latents/ComfyUI"}},
+    }
+
+
+def test_overrides_are_applied_to_copies():
+    template = PromptTemplate(make_prompt())
+    prompt, valid = template.instantiate({"1": {"width": 128}, "2": {"filename_prefix": "other"}})
+    assert valid == (True, None, ["2"], {})
+    assert prompt["1"]["inputs"]["width"] == 128 and prompt["2"]["inputs"]["filename_prefix"] == "other"
+    assert template.prompt == make_prompt()
+
+
+def test_overrides_are_validated():
+    template = PromptTemplate(make_prompt())
+    prompt, valid = template.instantiate({"1": {"width": "wide"}})
+    assert not valid[0] and valid[1]["type"] == "prompt_outputs_failed_validation"
+    assert list(valid[3]) == ["1"] and valid[3]["1"]["errors"][0]["type"] == "invalid_input_type"
+
+    prompt, valid = template.instantiate({"1": {"width": 1}})
+    assert not valid[0] and valid[3]["1"]["errors"][0]["type"] == "value_smaller_than_min"
+
+
+def test_invalid_overrides_are_rejected():
+    template = PromptTemplate(make_prompt())
+    for overrides in ({"3": {"width": 128}}, {"1": {"seed": 5}}, {"2": {"samples": 5}}, {"1": {"width": ["2", 0]}}):
+        prompt, valid = template.instantiate(overrides)
+        assert not valid[0] and valid[1]["type"] == "invalid_prompt_override"
+
+
+def test_invalid_template():
+    prompt = make_prompt()
+    prompt["1"]["inputs"]["width"] = "wide"
+    template = PromptTemplate(prompt)
+    assert not template.valid[0]
+    assert template.instantiate({})[1] == template.valid
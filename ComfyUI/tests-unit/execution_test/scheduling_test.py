@@ -0,0 +1,83 @@
+from comfy_execution.scheduling import PromptScheduler, get_model_names
+
+
+def make_item(number, client_id=None, ckpt_name="model.safetensors", **extra_data):
+    prompt = {"1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": ckpt_name}}}
+    extra_data["client_id"] = client_id
+    return (number, "prompt_{}".format(number), prompt, extra_data, ["1"])
+
+
+def run_all(scheduler, queue, now=0.0):
+    order = []
+    queue = list(queue)
+    while len(queue) > 0:
+        order.append(queue.pop(scheduler.select(queue, now))[0])
+    return order
+
+
+def test_fifo_by_default():
+    """Prompts without scheduling hints run in queue order"""
+    queue = [make_item(i) for i in range(5)]
+    assert run_all(PromptScheduler(), queue) == [0, 1, 2, 3, 4]
+
+
+def test_priority():
+    """Lower priority values run first"""
+    queue = [make_item(0, priority=1), make_item(1), make_item(2, priority=-1)]
+    assert run_all(PromptScheduler(), queue) == [2, 1, 0]
+
+
+def test_deadline():
+    """Prompts close to their deadline run first, earliest deadline first"""
+    queue = [make_item(0), make_item(1, deadline=50.0), make_item(2, deadline=30.0), make_item(3, deadline=500.0)]
+    assert run_all(PromptScheduler(deadline_slack=60.0), queue) == [2, 1, 0, 3]
+
+
+def test_fair_share():
+    """Clients take turns instead of one client's backlog running first"""
+    queue = [make_item(0, "a"), make_item(1, "a"), make_item(2, "a"), make_item(3, "b"), make_item(4, "b")]
+    assert run_all(PromptScheduler(), queue) == [0, 3, 1, 4, 2]
+
+
+def test_new_client_starts_at_baseline():
+    """A client joining late does not get every slot until it has caught up"""
+    scheduler = PromptScheduler()
+    assert run_all(scheduler, [make_item(i, "a") for i in range(4)]) == [0, 1, 2, 3]
+    queue = [make_item(4, "a"), make_item(5, "a"), make_item(6, "b"), make_item(7, "b")]
+    assert run_all(scheduler, queue) == [4, 6, 5, 7]
+
+
+def test_model_affinity():
+    """Prompts using the models of the previous prompt run next"""
+    queue = [make_item(0, ckpt_name="a"), make_item(1, ckpt_name="b"), make_item(2, ckpt_name="a")]
+    assert run_all(PromptScheduler(), queue) == [0, 2, 1]
+
+
+def test_affinity_does_not_starve():
+    """A prompt passed over max_bypass times runs next"""
+    queue = [make_item(0, ckpt_name="a"), make_item(1, ckpt_name="b")] + [make_item(i, ckpt_name="a") for i in range(2, 8)]
+    order = run_all(PromptScheduler(max_bypass=2), queue)
+    assert order.index(1) == 3
+
+
+def test_front_runs_first():
+    """Prompts queued with front=True run before every other prompt, most recent first"""
+    scheduler = PromptScheduler()
+    run_all(scheduler, [make_item(i, "a") for i in range(3)])
+    queue = [make_item(3, "b", priority=-5), make_item(-4, "a", ckpt_name="b"), make_item(-5, "a")]
+    assert run_all(scheduler, queue) == [-5, -4, 3]
+
+
+def test_invalid_scheduling_values_are_ignored():
+    """Priorities and deadlines that are not numbers fall back to the defaults"""
+    queue = [make_item(0, priority="high", deadline="soon"), make_item(1, priority=None, deadline=None), make_item(2, priority="-1", deadline=[1])]
+    assert run_all(PromptScheduler(), queue) == [2, 0, 1]
+
+
+def test_get_model_names():
+    prompt = {
+        "1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "model.safetensors"}},
+        "2": {"class_type": "LoraLoader", "inputs": {"lora_name": "lora.safetensors", "model": ["1", 0]}},
+        "3": {"class_type": "CLIPTextEncode", "inputs": {"text": "a photo", "clip": ["2", 1]}},
+    }
+    assert get_model_names(prompt) == frozenset(["model.safetensors", "lora.safetensors"])
@@ -0,0 +1,52 @@
+from types import SimpleNamespace
+
+from comfy_execution.text_encoding import encode_pending_texts
+
+
+class Outputs(dict):
+    def set(self, node_id, value):
+        self[node_id] = value
+
+
+class FakeClip:
+    def __init__(self):
+        self.patcher = SimpleNamespace(forced_hooks=None)
+        self.use_clip_schedule = False
+        self.batches = []
+
+    def tokenize(self, text):
+        return text
+
+    def encode_from_tokens_batch(self, tokens_list):
+        self.batches.append(tokens_list)
+        return [{"cond": "cond " + tokens, "pooled_output": "pooled " + tokens} for tokens in tokens_list]
+
+
+def make_prompt():
+    prompt = {"1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "model.safetensors"}}}
+    for node_id, text in (("2", "a cat"), ("3", "blurry"), ("4", "a cat"), ("5", "a dog")):
+        prompt[node_id] = {"class_type": "CLIPTextEncode", "inputs": {"text": text, "clip": ["1", 1]}}
+    return SimpleNamespace(get_node=prompt.__getitem__)
+
+
+def test_pending_texts_are_encoded_together():
+    clip = FakeClip()
+    outputs = Outputs({"1": [["model"], [clip], ["vae"]]})
+    # Node 5 isn't in the execution list, e.g. because no output uses it
+    execution_list = SimpleNamespace(pendingNodes={"2": True, "3": True, "4": True})
+    encode_pending_texts(make_prompt(), outputs, execution_list, "2")
+
+    assert clip.batches == [["a cat", "blurry"]]
+    assert outputs["2"] == [[[["cond a cat", {"pooled_output": "pooled a cat"}]]]]
+    assert outputs["3"] == [[[["cond blurry", {"pooled_output": "pooled blurry"}]]]]
+    assert outputs["4"] == outputs["2"] and outputs["4"][0][0][0][1] is not outputs["2"][0][0][0][1]
+    assert "5" not in outputs
+
+
+def test_scheduled_encodes_are_not_batched():
+    clip = FakeClip()
+    clip.patcher.forced_hooks = object()
+    clip.use_clip_schedule = True
+    outputs = Outputs({"1": [["model"], [clip], ["vae"]]})
+    encode_pending_texts(make_prompt(), outputs, SimpleNamespace(pendingNodes={"2": True, "3": True}), "2")
+    assert clip.batches == [] and "2" not in outputs
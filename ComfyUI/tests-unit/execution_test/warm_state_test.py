@@ -0,0 +1,79 @@
+import sys
+import json
+from types import SimpleNamespace
+
+# nodes puts comfy/ first on sys.path, which would shadow the utils package for the other tests
+sys_path = list(sys.path)
+from comfy_execution.warm_state import WarmState, get_warm_nodes  # noqa: E402
+sys.path[:] = sys_path
+
+
+def make_prompt(text="a photo", lora_name="detail.safetensors"):
+    return {
+        "1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "model.safetensors"}},
+        "2": {"class_type": "LoraLoader", "inputs": {
+            "model": ["1", 0], "clip": ["1", 1], "lora_name": lora_name, "strength_model": 1.0, "strength_clip": 1.0}},
+        "3": {"class_type": "CLIPTextEncode", "inputs": {"text": text, "clip": ["2", 1]}},
+        "4": {"class_type": "LoadImage", "inputs": {"image": "image.png"}},
+        "5": {"class_type": "VAEEncode", "inputs": {"pixels": ["4", 0], "vae": ["1", 2]}},
+        "6": {"class_type": "InpaintModelConditioning", "inputs": {
+            "positive": ["3", 0], "negative": ["3", 0], "vae": ["1", 2], "pixels": ["4", 0], "mask": ["4", 1], "noise_mask": True}},
+        "7": {"class_type": "SaveImage", "inputs": {"images": ["4", 0], "filename_prefix": "ComfyUI"}},
+    }
+
+
+def make_executor():
+    return SimpleNamespace(caches=SimpleNamespace(outputs=SimpleNamespace(get=lambda node_id: None)))
+
+
+def test_get_warm_nodes():
+    """Loaders and the text encoders using them are warm, nodes depending on images aren't"""
+    assert list(get_warm_nodes(make_prompt())) == ["1", "2", "3"]
+
+
+def test_record_keeps_most_recent_first(tmp_path):
+    path = str(tmp_path / "warm" / "state.json")
+    warm_state = WarmState(path, max_entries=2)
+    for lora_name in ("a", "b", "a", "c"):
+        warm_state.record(make_prompt(lora_name=lora_name), make_executor())
+
+    lora_names = [entry["prompt"]["2"]["inputs"]["lora_name"] for entry in WarmState(path).entries]
+    assert lora_names == ["c", "a"]
+
+
+def test_only_shared_texts_are_recorded(tmp_path):
+    """The text of a request is left out until enough prompts encoded it"""
+    path = str(tmp_path / "state.json")
+    warm_state = WarmState(path)
+    warm_state.record(make_prompt("private"), make_executor())
+    with open(path) as f:
+        assert "private" not in f.read()
+
+    for _ in range(3):
+        warm_state.record(make_prompt("watermark, ugly"), make_executor())
+    assert list(WarmState(path).entries[0]["prompt"]) == ["1", "2", "3"]
+    assert "private" not in json.dumps(WarmState(path).entries)
+
+
+def test_reordering_is_not_saved_every_time(tmp_path, monkeypatch):
+    path = tmp_path / "state.json"
+    warm_state = WarmState(str(path))
+    for i, lora_name in enumerate(("a", "b", "c")):
+        warm_state.record(make_prompt(str(i), lora_name=lora_name), make_executor())
+    saved = path.read_text()
+    warm_state.record(make_prompt("3", lora_name="a"), make_executor())
+    assert path.read_text() == saved
+
+    monkeypatch.setattr(warm_state, "last_save", warm_state.last_save - 3600)
+    warm_state.record(make_prompt("4", lora_name="b"), make_executor())
+    lora_names = [entry["prompt"]["2"]["inputs"]["lora_name"] for entry in json.loads(path.read_text())["entries"]]
+    assert lora_names == ["b", "a", "c"]
+
+
+def test_record_errors_are_logged(tmp_path):
+    """A prompt that can't be written must not stop the prompt worker"""
+    path = tmp_path / "warm_state.json"
+    prompt = make_prompt()
+    prompt["1"]["inputs"]["ckpt_name"] = object()
+    WarmState(str(path)).record(prompt, make_executor())
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,55 @@
+import os
+import sys
+import json
+
+import pytest
+
+# The worker modules are next to the ComfyUI directory
+sys_path = list(sys.path)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
+from comfy_serverless import ComfyClient, PendingPrompt  # noqa: E402
+sys.path[:] = sys_path
+
+SAVE_NODE = "save_image_websocket_node"
+
+
+def executing(prompt_id, node):
+    return json.dumps({"type": "executing", "data": {"node": node, "prompt_id": prompt_id}})
+
+
+def make_client(*prompt_ids):
+    client = ComfyClient()
+    for prompt_id in prompt_ids:
+        client.pending[prompt_id] = PendingPrompt()
+    return client
+
+
+def test_messages_are_routed_by_prompt_id():
+    client = make_client("a", "b")
+    client.handle_message(executing("a", SAVE_NODE))
+    client.handle_message(b"\0\0\0\1\0\0\0\2image a")
+    client.handle_message(executing("b", "3"))
+    # Binary frames belong to the executing prompt, whose current node isn't the save node
+    client.handle_message(b"\0\0\0\1\0\0\0\2preview b")
+    client.handle_message(json.dumps({"type": "execution_error", "data": {"prompt_id": "b", "exception_message": "out of memory"}}))
+    client.handle_message(executing("other", "5"))
+    assert not client.pending["a"].future.done() and not client.pending["b"].future.done()
+
+    client.handle_message(executing("a", None))
+    assert client.pending["a"].future.result(timeout=0) == {SAVE_NODE: [b"image a"]}
+    client.handle_message(executing("b", None))
+    with pytest.raises(RuntimeError, match="out of memory"):
+        client.pending["b"].future.result(timeout=0)
+
+
+def test_closed_websocket_fails_pending_prompts():
+    class ClosedSocket:
+        def recv(self):
+            raise ConnectionResetError("reset")
+
+    client = make_client("a")
+    client.ws = ClosedSocket()
+    client.receive_loop(client.ws)
+    assert client.ws is None
+    with pytest.raises(ConnectionError):
+        client.pending["a"].future.result(timeout=0)
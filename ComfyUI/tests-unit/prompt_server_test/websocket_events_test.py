@@ -0,0 +1,60 @@
+import sys
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+import pytest_asyncio
+from aiohttp import web
+
+# nodes puts comfy/ first on sys.path, which would shadow the utils package for the other tests
+sys_path = list(sys.path)
+import server  # noqa: E402
+sys.path[:] = sys_path
+
+pytestmark = (
+    pytest.mark.asyncio
+)  # This applies the asyncio mark to all test functions in the module
+
+
+@pytest_asyncio.fixture
+async def prompt_server():
+    prompt_server = server.PromptServer(asyncio.get_running_loop())
+    prompt_server.prompt_queue = SimpleNamespace(get_tasks_remaining=lambda: 0)
+    return prompt_server
+
+
+@pytest.fixture
+def app(prompt_server):
+    app = web.Application()
+    app.add_routes(prompt_server.routes)
+    return app
+
+
+async def test_wants_event(prompt_server):
+    prompt_server.socket_events = {"all": None, "some": {"executing", "preview_image"}}
+    assert prompt_server.wants_event("all", "progress")
+    assert prompt_server.wants_event("some", "executing")
+    assert not prompt_server.wants_event("some", "status")
+    assert prompt_server.wants_event("some", server.BinaryEventTypes.PREVIEW_IMAGE)
+    assert prompt_server.wants_event("some", server.BinaryEventTypes.UNENCODED_PREVIEW_IMAGE)
+
+
+async def test_initial_status_is_filtered(aiohttp_client, app, prompt_server):
+    client = await aiohttp_client(app)
+    ws = await client.ws_connect("/ws?clientId=all")
+    message = await ws.receive_json(timeout=5)
+    assert message["type"] == "status" and message["data"]["sid"] == "all"
+
+    filtered = await client.ws_connect("/ws?clientId=some&events=executing,preview_image")
+    await prompt_server.send("status", {"status": {}}, "some")
+    await prompt_server.send("executing", {"node": "1"}, "some")
+    await prompt_server.send_bytes(server.BinaryEventTypes.PREVIEW_IMAGE, b"image", "some")
+    await prompt_server.send("progress", {"value": 1, "max": 2})
+    await prompt_server.send_bytes(server.BinaryEventTypes.PREVIEW_IMAGE, b"broadcast")
+
+    assert (await filtered.receive_json(timeout=5))["type"] == "executing"
+    assert (await filtered.receive_bytes(timeout=5))[4:] == b"image"
+    assert (await filtered.receive_bytes(timeout=5))[4:] == b"broadcast"
+    assert (await ws.receive_json(timeout=5))["type"] == "progress"
+    await ws.close()
+    await filtered.close()
@@ -0,0 +1,409 @@
+import os
+import sys
+import base64
+import gc
+import logging
+import copy
+import uuid
+import itertools
+import threading
+from concurrent.futures import Future
+
+# Path to the bundled ComfyUI checkout, imported directly instead of talking to it over HTTP
+COMFYUI_PATH = os.path.abspath(os.getenv("COMFYUI_PATH", "ComfyUI"))
+
+# Seconds without work after which the worker collects garbage and empties the device cache
+GC_COLLECT_INTERVAL = 10.0
+
+# GB of RAM and VRAM that node outputs of earlier workflows may hold to be reused, unset to only keep the last workflow's
+CACHE_MEMORY_GB = os.getenv("COMFY_CACHE_MEMORY_GB")
+
+# Directory (e.g. under /dev/shm) where node outputs are kept across restarts and shared between workers, unset to disable
+PERSISTENT_CACHE_DIR = os.getenv("COMFY_PERSISTENT_CACHE_DIR")
+PERSISTENT_CACHE_SIZE_GB = float(os.getenv("COMFY_PERSISTENT_CACHE_SIZE_GB", "10"))
+
+# Directory (e.g. on a network volume) keeping loaded checkpoints ready to load without model detection or dtype conversion
+CHECKPOINT_CACHE_DIR = os.getenv("COMFY_CHECKPOINT_CACHE_DIR")
+CHECKPOINT_CACHE_SIZE_GB = float(os.getenv("COMFY_CHECKPOINT_CACHE_SIZE_GB", "50"))
+
+# JSON file (e.g. on a network volume) recording the models and text encodings to restore when the worker starts, unset to disable
+WARM_STATE_PATH = os.getenv("COMFY_WARM_STATE_PATH")
+
+# How LoRAs are applied: "merge" into the weights, "runtime" by the layers, "auto" uses runtime when the LoRAs change from job to job
+LORA_MODE = os.getenv("COMFY_LORA_MODE")
+
+# MB of RAM keeping weights with their LoRAs merged, so switching back to a LoRA stack doesn't merge it again, unset to disable
+PATCHED_WEIGHT_CACHE_MB = os.getenv("COMFY_PATCHED_WEIGHT_CACHE_MB")
+
+# Read the model files of queued workflows from disk while the current one runs
+PREFETCH_MODELS = os.getenv("COMFY_PREFETCH_MODELS", "0") == "1"
+
+# Maximum number of queued prompts that differ only in text, seed and images sampled as one batch, 1 disables batching
+PROMPT_BATCH_SIZE = int(os.getenv("COMFY_PROMPT_BATCH_SIZE", "1"))
+
+_prompt_queue = None
+_pending = {}
+_templates = {}
+_prompt_numbers = itertools.count()
+_init_lock = threading.Lock()
+# Set once the warm state is restored and prompts can run
+_ready = threading.Event()
+
+
+class InProcessServer:
+    """Minimal stand-in for server.PromptServer used by execution.PromptExecutor"""
+
+    def __init__(self):
+        self.client_id = None
+        self.last_node_id = None
+        self.last_prompt_id = None
+
+    def send_sync(self, event, data, sid=None) -> None:
+        # There are no websocket clients in-process, status is read from the executor instead
+        pass
+
+    def queue_updated(self) -> None:
+        pass
+
+
+def get_prompt_queue():
+    """Imports ComfyUI and returns the in-process PromptQueue, starting its worker thread"""
+    global _prompt_queue
+    with _init_lock:
+        if _prompt_queue is not None:
+            return _prompt_queue
+
+        if COMFYUI_PATH not in sys.path:
+            sys.path.insert(0, COMFYUI_PATH)
+
+        # Has to happen before torch is imported so the allocator config is applied
+        import cuda_malloc  # noqa: F401
+        import comfy.utils
+        import comfy.model_management
+        import comfy.weight_cache
+        import execution
+        import nodes
+        from comfy.cli_args import args
+
+        if CHECKPOINT_CACHE_DIR:
+            args.checkpoint_cache_dir = CHECKPOINT_CACHE_DIR
+            args.checkpoint_cache_size = CHECKPOINT_CACHE_SIZE_GB
+        if LORA_MODE:
+            args.lora_mode = LORA_MODE
+        if PATCHED_WEIGHT_CACHE_MB:
+            # The cache is created when comfy.weight_cache is imported
+            comfy.weight_cache.cache.max_bytes = int(float(PATCHED_WEIGHT_CACHE_MB) * 1024 * 1024)
+
+        nodes.init_extra_nodes(init_custom_nodes=not args.disable_all_custom_nodes)
+
+        def progress_hook(value, total, preview_image):
+            comfy.model_management.throw_exception_if_processing_interrupted()
+
+        comfy.utils.set_progress_bar_global_hook(progress_hook)
+
+        server = InProcessServer()
+        prompt_queue = execution.PromptQueue(server)
+        comfy.model_management.register_queued_model_files(prompt_queue.get_queued_model_files)
+        if PREFETCH_MODELS:
+            from comfy_execution.prefetch import ModelPrefetcher
+
+            prompt_queue.prefetcher = ModelPrefetcher()
+        persistent_cache = None
+        if PERSISTENT_CACHE_DIR:
+            from comfy_execution.persistent_cache import PersistentCache
+
+            persistent_cache = PersistentCache(PERSISTENT_CACHE_DIR, int(PERSISTENT_CACHE_SIZE_GB * 1024**3))
+        lru_max_bytes = None
+        if CACHE_MEMORY_GB:
+            lru_max_bytes = int(float(CACHE_MEMORY_GB) * 1024**3)
+        executor = execution.PromptExecutor(
+            server,
+            lru_size=args.cache_lru,
+            persistent_cache=persistent_cache,
+            lru_max_bytes=lru_max_bytes,
+        )
+        warm_state = None
+        if WARM_STATE_PATH:
+            from comfy_execution.warm_state import WarmState
+
+            warm_state = WarmState(WARM_STATE_PATH)
+        threading.Thread(target=prompt_worker, args=(prompt_queue, executor, warm_state), daemon=True).start()
+        _prompt_queue = prompt_queue
+        return _prompt_queue
+
+
+def wait_until_ready(timeout: float | None = None) -> bool:
+    """Imports ComfyUI and waits until the warm state is restored, returns False on timeout"""
+    get_prompt_queue()
+    return _ready.wait(timeout)
+
+
+def prompt_worker(prompt_queue, executor, warm_state=None) -> None:
+    """Executes queued prompts one after another, like ComfyUI's main.prompt_worker.
+
+    With PROMPT_BATCH_SIZE above 1, queued prompts with the same batch signature
+    as the next prompt are merged with it and sampled as a single batch. With a
+    warm state it is restored first, and updated with every prompt that runs alone.
+    """
+    import comfy.model_management
+
+    if warm_state is not None:
+        warm_state.restore(executor)
+    _ready.set()
+
+    need_gc = False
+    while True:
+        queue_item = prompt_queue.get(timeout=GC_COLLECT_INTERVAL if need_gc else None)
+        if queue_item is None:
+            gc.collect()
+            comfy.model_management.soft_empty_cache()
+            need_gc = False
+            continue
+
+        batch = [queue_item]
+        batch_signature = queue_item[0][3].get("batch_signature")
+        if batch_signature is not None:
+            batch += prompt_queue.get_batch(
+                lambda item: item[3].get("batch_signature") == batch_signature,
+                PROMPT_BATCH_SIZE - 1,
+            )
+
+        statuses = {}
+        try:
+            if len(batch) > 1 and execute_batch(executor, [item for item, _ in batch]):
+                statuses = {item_id: get_execution_status(executor) for _, item_id in batch}
+            else:
+                for item, item_id in batch:
+                    execute_prompt(executor, item)
+                    statuses[item_id] = get_execution_status(executor)
+                    if warm_state is not None and executor.success:
+                        warm_state.record(item[2], executor)
+        except Exception as e:
+            logging.exception("Error executing prompts")
+            # The worker keeps running, the callers still waiting get the error
+            for item, _ in batch:
+                future = _pending.pop(item[1], None)
+                if future is not None:
+                    future.set_exception(e)
+        finally:
+            need_gc = True
+            for item, item_id in batch:
+                prompt_queue.task_done(item_id, getattr(executor, "history_result", {}), status=statuses.get(item_id))
+                # Outputs are returned through the future, history would only hold on to them
+                prompt_queue.delete_history_item(item[1])
+
+
+def execute_prompt(executor, item) -> None:
+    """Executes a queued prompt and resolves its future with the output images or the error"""
+    prompt_id = item[1]
+    future = _pending.pop(prompt_id)
+    executor.server.last_prompt_id = prompt_id
+    try:
+        executor.execute(item[2], prompt_id, item[3], item[4])
+        if executor.success:
+            future.set_result(collect_output_arrays(executor, item[2]))
+        else:
+            future.set_exception(RuntimeError(get_execution_error(executor.status_messages)))
+    except Exception as e:
+        future.set_exception(e)
+
+
+def execute_batch(executor, items: list) -> bool:
+    """Executes queued prompts merged into one prompt and resolves their futures.
+
+    Returns False without resolving the futures if the prompts can't be merged or
+    the merged prompt fails, so they can be executed one by one instead.
+    """
+    from comfy_execution.batching import merge_prompts
+
+    merged = merge_prompts([item[2] for item in items])
+    if merged is None:
+        return False
+    prompt, node_ids = merged
+
+    outputs = []
+    for item, ids in zip(items, node_ids):
+        outputs += [ids[node_id] for node_id in item[4] if ids[node_id] not in outputs]
+
+    prompt_id = items[0][1]
+    executor.server.last_prompt_id = prompt_id
+    try:
+        executor.execute(prompt, prompt_id, {}, outputs)
+    except Exception as e:
+        logging.warning("Error executing batched prompts, executing them one by one: {}".format(e))
+        return False
+    if not executor.success:
+        return False
+
+    # Nothing is resolved until the outputs of every prompt are collected
+    output_arrays = [collect_output_arrays(executor, item[2], ids) for item, ids in zip(items, node_ids)]
+    for item, arrays in zip(items, output_arrays):
+        _pending.pop(item[1]).set_result(arrays)
+    return True
+
+
+def get_execution_status(executor):
+    """Returns the history status of the last prompt the executor ran"""
+    import execution
+
+    return execution.PromptQueue.ExecutionStatus(
+        status_str="success" if executor.success else "error",
+        completed=executor.success,
+        messages=executor.status_messages,
+    )
+
+
+def execute_workflow_in_process(workflow: dict, overrides: dict | None = None) -> dict:
+    """Validates and queues a workflow in this process, waits for it and returns the encoded output images.
+
+    With overrides the workflow is used as a template: it is validated the first
+    time it is seen and only the overridden nodes are validated on later calls.
+    """
+    import execution
+
+    prompt_queue = get_prompt_queue()
+    if overrides is None:
+        prompt = workflow
+        valid = execution.validate_prompt(prompt)
+    else:
+        prompt, valid = get_template(workflow).instantiate(overrides)
+    if not valid[0]:
+        raise RuntimeError(get_validation_error(valid[1], valid[3]))
+
+    memory_keys = register_input_images(prompt)
+    try:
+        prompt_id = str(uuid.uuid4())
+        future = Future()
+        _pending[prompt_id] = future
+        extra_data = {}
+        if PROMPT_BATCH_SIZE > 1:
+            from comfy_execution.batching import get_batch_signature
+
+            extra_data["batch_signature"] = get_batch_signature(prompt)
+        prompt_queue.put((next(_prompt_numbers), prompt_id, prompt, extra_data, valid[2]))
+        output_arrays = future.result()
+    finally:
+        release_input_images(memory_keys)
+
+    # Encoding happens on the calling thread so the worker can start the next prompt
+    import nodes
+
+    save_node = nodes.NODE_CLASS_MAPPINGS["SaveImageWebsocket"]
+    output_images = {}
+    for node_id, images in output_arrays.items():
+        inputs = prompt[node_id]["inputs"]
+        output_images[node_id] = [
+            save_node.encode_image(
+                image,
+                inputs.get("format", "PNG"),
+                inputs.get("quality", 95),
+                inputs.get("compress_level", 1),
+            )
+            for image in images
+        ]
+    return output_images
+
+
+def get_template(workflow: dict):
+    """Returns the PromptTemplate of a workflow, validating it the first time it is used"""
+    import execution
+
+    with _init_lock:
+        # The workflow is kept alongside its template so its id can't be reused while cached
+        entry = _templates.get(id(workflow))
+        if entry is None:
+            entry = (workflow, execution.PromptTemplate(copy.deepcopy(workflow)))
+            _templates[id(workflow)] = entry
+        return entry[1]
+
+
+def register_input_images(workflow: dict) -> list[str]:
+    """Decodes the base64 images of the workflow into the in-process image store.
+
+    LoadImageBase64/LoadImageMaskBase64 nodes are swapped for their FromMemory
+    variants so the prompt only carries the key of the decoded image.
+    """
+    import nodes
+    from comfy_execution.graph_utils import is_link
+
+    memory_nodes = {
+        "LoadImageBase64": "LoadImageFromMemory",
+        "LoadImageMaskBase64": "LoadImageMaskFromMemory",
+    }
+    image_store = nodes.NODE_CLASS_MAPPINGS["LoadImageFromMemory"]
+    memory_keys = []
+    for node in workflow.values():
+        if node["class_type"] not in memory_nodes or is_link(node["inputs"].get("image")):
+            continue
+        key = image_store.register(base64.b64decode(node["inputs"].pop("image")))
+        memory_keys.append(key)
+        node["class_type"] = memory_nodes[node["class_type"]]
+        node["inputs"]["key"] = key
+    return memory_keys
+
+
+def release_input_images(memory_keys: list[str]) -> None:
+    """Drops the images of a finished workflow from the in-process image store"""
+    import nodes
+
+    image_store = nodes.NODE_CLASS_MAPPINGS["LoadImageFromMemory"]
+    for key in memory_keys:
+        image_store.release(key)
+
+
+def get_worker_load() -> tuple[int, int]:
+    """Returns the number of queued and running prompts and the free memory of the torch device"""
+    import comfy.model_management
+
+    prompt_queue = get_prompt_queue()
+    return prompt_queue.get_tasks_remaining(), comfy.model_management.get_free_memory()
+
+
+def get_validation_error(error: dict, node_errors: dict) -> str:
+    """Returns a readable message for a workflow that failed validation"""
+    reasons = []
+    # validate_prompt returns an empty list instead of a dict for errors that aren't tied to a node
+    for node_id, node_error in (node_errors or {}).items():
+        for reason in node_error["errors"]:
+            reasons.append(f"{node_error['class_type']} {node_id}: {reason['message']}: {reason['details']}")
+    if len(reasons) == 0:
+        return f"{error['message']}: {error['details']}"
+    return "; ".join(reasons)
+
+
+def get_execution_error(status_messages: list) -> str:
+    """Returns the error message of a failed execution"""
+    for event, data in status_messages:
+        if event == "execution_error":
+            return f"{data['node_type']} {data['node_id']}: {data['exception_message']}"
+        if event == "execution_interrupted":
+            return "Execution interrupted"
+    return "Execution failed"
+
+
+def collect_output_arrays(executor, workflow: dict, node_ids: dict | None = None) -> dict:
+    """Copies the images feeding every SaveImageWebsocket node out of the output cache as uint8 arrays.
+
+    node_ids maps the ids of the workflow to the ids of the prompt the executor ran
+    when the workflow was merged into a batch.
+    """
+    import nodes
+
+    save_node = nodes.NODE_CLASS_MAPPINGS["SaveImageWebsocket"]
+    output_images = {}
+    for node_id, node in workflow.items():
+        if node["class_type"] != "SaveImageWebsocket":
+            continue
+
+        source_node, source_output = node["inputs"]["images"]
+        if node_ids is not None:
+            source_node = node_ids[source_node]
+        cached_output = executor.caches.outputs.get(source_node)
+        if cached_output is None:
+            continue
+
+        output_images[node_id] = []
+        for images in cached_output[source_output]:
+            output_images[node_id].extend(save_node.to_uint8(images))
+    return output_images
+
@@ -1,9 +1,10 @@
 import json
-from urllib import request
+import time
+import threading
+from concurrent.futures import Future
+from http.client import HTTPConnection, HTTPException
 import websocket
 import uuid
-import io
-from PIL import Image
 import base64
 import random
 from dotenv import load_dotenv
@@ -11,6 +12,15 @@ import os
 
 load_dotenv()
 
+# "server" talks to a sidecar ComfyUI over HTTP/websocket, "inprocess" runs the graph in this process
+EXECUTION_MODE = os.getenv("COMFY_EXECUTION_MODE", "server")
+
+# Job input (e.g. test_input.json) run once at startup so the first job finds the models loaded, unset to disable
+WARMUP_INPUT = os.getenv("COMFY_WARMUP_INPUT")
+
+# Seconds to wait for ComfyUI to import its nodes and restore its warm state
+READY_TIMEOUT = float(os.getenv("COMFY_READY_TIMEOUT", "600"))
+
 # Is loaded as string to improve efficiency and reduce I/O load.
 workflow_dump = """
 {
@@ -175,23 +185,21 @@ workflow_dump = """
   },
   "47": {
     "inputs": {
-      "image": "tmp.png",
-      "upload": "image"
+      "image": ""
     },
-    "class_type": "LoadImage",
+    "class_type": "LoadImageBase64",
     "_meta": {
-      "title": "Load Image"
+      "title": "Load Image (Base64)"
     }
   },
   "48": {
     "inputs": {
-      "image": "tmp-mask.png",
-      "channel": "alpha",
-      "upload": "image"
+      "image": "",
+      "channel": "alpha"
     },
-    "class_type": "LoadImageMask",
+    "class_type": "LoadImageMaskBase64",
     "_meta": {
-      "title": "Load Image (as Mask)"
+      "title": "Load Image as Mask (Base64)"
     }
   },
   "save_image_websocket_node": {
@@ -206,6 +214,9 @@ workflow_dump = """
 }
 """
 
+# Parsed once and validated once by ComfyUI, jobs only send the inputs they change
+workflow_template = json.loads(workflow_dump)
+
 
 def validate_api_key(api_key: str) -> tuple[bool, str]:
     """Validates the API key"""
@@ -228,6 +239,11 @@ def validate_input(event: dict) -> dict:
     if not is_valid:
         return {"error": message}
 
+    return get_job_input(input_data)
+
+
+def get_job_input(input_data: dict) -> dict:
+    """Returns the workflow inputs of a job, with defaults for the optional ones"""
     if not input_data or not input_data.get("image") or not input_data.get("mask"):
         return {"error": "Both 'image' and 'mask' are required"}
 
@@ -253,84 +269,281 @@ def execute_workflow(
     steps: int,
     cfg: int,
     denoise: int,
+    image: str | bytes,
+    mask: str | bytes,
 ) -> dict:
     """Executes the inpainting workflow"""
-    workflow = modify_workflow_dump(
-        workflow_dump, positive_prompt, negative_prompt, seed, steps, cfg, denoise
+    overrides = get_workflow_overrides(
+        positive_prompt,
+        negative_prompt,
+        seed,
+        steps,
+        cfg,
+        denoise,
+        image,
+        mask,
     )
-    server_address = "127.0.0.1:8188"
-    client_id = str(uuid.uuid4())
-    ws = websocket.WebSocket()
-    ws.connect(f"ws://{server_address}/ws?clientId={client_id}")
-    prompt_id = send_prompt_to_comfy(workflow, client_id)["prompt_id"]
-    images = receive_generated_images(ws, prompt_id)
-    ws.close()
-    return images
-
-
-def save_image_to_path(image_data: str | bytes, path: str) -> None:
-    """Saves an image to a filepath"""
+    if EXECUTION_MODE == "inprocess":
+        from comfy_inprocess import execute_workflow_in_process
+
+        return execute_workflow_in_process(workflow_template, overrides)
+
+    return comfy_client.execute(workflow_template, overrides)
+
+
+def wait_until_ready() -> None:
+    """Waits until ComfyUI can run workflows, then runs the warm-up input if there is one"""
+    if EXECUTION_MODE == "inprocess":
+        from comfy_inprocess import wait_until_ready as wait_until_in_process_ready
+
+        ready = wait_until_in_process_ready(READY_TIMEOUT)
+    else:
+        ready = comfy_client.wait_until_ready(READY_TIMEOUT)
+    if not ready:
+        raise TimeoutError(f"ComfyUI was not ready after {READY_TIMEOUT} seconds")
+
+    if WARMUP_INPUT:
+        warm_up(WARMUP_INPUT)
+
+
+def warm_up(input_path: str) -> None:
+    """Runs the workflow once with a job input file so models are loaded and kernels are initialized"""
+    with open(input_path) as f:
+        input_data = get_job_input(json.load(f)["input"])
+    if "error" in input_data:
+        print(f"Skipping the warm-up with {input_path}:", input_data["error"])
+        return
+
+    start_time = time.perf_counter()
+    try:
+        execute_workflow(**input_data)
+    except Exception as e:
+        print("Error executing the warm-up workflow:", e)
+        return
+    print(f"Warm-up workflow executed in {time.perf_counter() - start_time:.2f} seconds")
+
+
+def get_worker_load() -> tuple[int, int]:
+    """Returns the number of prompts queued on ComfyUI and its free device memory in bytes"""
+    if EXECUTION_MODE == "inprocess":
+        from comfy_inprocess import get_worker_load as get_in_process_worker_load
+
+        return get_in_process_worker_load()
+
+    return comfy_client.get_worker_load()
+
+
+def to_base64(image_data: str | bytes) -> str:
+    """Returns image data as a base64 string"""
     if isinstance(image_data, str):  # base64
-        image_bytes = base64.b64decode(image_data)
-    else:  # binary
-        image_bytes = image_data
+        return image_data
+    return base64.b64encode(image_data).decode()
+
+
+class PendingPrompt:
+    """Outputs collected for a prompt that is queued or running on the ComfyUI server"""
+
+    def __init__(self):
+        self.future = Future()
+        self.output_images = {}
+        self.current_node = None
+        self.error = None
+
+
+class ComfyClient:
+    """Long-lived connection to the ComfyUI server shared by every job of the worker.
+
+    A single websocket is opened per worker and the messages of all in flight
+    prompts are routed to them by `prompt_id`. Binary frames carry no prompt id,
+    they belong to the prompt that is currently executing on the server.
+    """
+
+    def __init__(self, server_address: str = "127.0.0.1:8188"):
+        self.server_address = server_address
+        self.client_id = str(uuid.uuid4())
+        self.ws = None
+        self.http = None
+        self.pending = {}
+        self.templates = {}
+        self.executing_prompt_id = None
+        # Held while a prompt is posted so its messages can't arrive before it is registered
+        self.lock = threading.Lock()
+
+    def execute(
+        self, workflow: dict, overrides: dict | None = None, timeout: float | None = None
+    ) -> dict:
+        """Queues a workflow and waits for the images it sends through the websocket.
 
-    image = Image.open(io.BytesIO(image_bytes))
-    image.save(path)
+        With overrides the workflow is registered once as a template on the server
+        and only the overridden inputs are sent for each job.
+        """
+        pending = PendingPrompt()
+        with self.lock:
+            self.connect()
+            if overrides is None:
+                prompt_id = self.send_prompt(workflow)["prompt_id"]
+            else:
+                prompt_id = self.send_template_prompt(workflow, overrides)["prompt_id"]
+            self.pending[prompt_id] = pending
+        try:
+            return pending.future.result(timeout=timeout)
+        finally:
+            with self.lock:
+                self.pending.pop(prompt_id, None)
 
+    def connect(self) -> None:
+        """Opens the websocket and starts its reader thread if it isn't running"""
+        if self.ws is not None and self.ws.connected:
+            return
+        self.ws = websocket.WebSocket()
+        # Only subscribe to what is needed to collect the outputs, not progress or status updates
+        self.ws.connect(
+            f"ws://{self.server_address}/ws?clientId={self.client_id}"
+            "&events=executing,execution_error,preview_image"
+        )
+        threading.Thread(target=self.receive_loop, args=(self.ws,), daemon=True).start()
 
-def send_prompt_to_comfy(prompt: str, client_id: str) -> dict:
-    """Sends a prompt to the ComfyUI server and returns the prompt ID"""
-    p = {"prompt": prompt, "client_id": client_id}
-    data = json.dumps(p).encode("utf-8")
-    req = request.Request("http://127.0.0.1:8188/prompt", data=data)
-    return json.loads(request.urlopen(req).read())
+    def send_prompt(self, workflow: dict) -> dict:
+        """Posts a prompt to the ComfyUI server and returns its prompt ID"""
+        data = json.dumps({"prompt": workflow, "client_id": self.client_id}).encode("utf-8")
+        status, body = self.request("POST", "/prompt", data)
+        if status != 200:
+            raise RuntimeError(f"ComfyUI rejected the prompt: {body.decode('utf-8')}")
+        return json.loads(body)
 
+    def send_template_prompt(self, workflow: dict, overrides: dict) -> dict:
+        """Posts the overrides of a template prompt, registering the template if the server doesn't know it"""
+        data = json.dumps({"overrides": overrides, "client_id": self.client_id}).encode("utf-8")
+        for attempt in range(2):
+            template_id = self.templates.get(id(workflow), (None, None))[1]
+            if template_id is None:
+                template_id = self.register_template(workflow)
+            status, body = self.request("POST", f"/prompt_template/{template_id}", data)
+            if status != 404:
+                break
+            # The server restarted or dropped the template
+            self.templates.pop(id(workflow), None)
 
-def receive_generated_images(ws: websocket.WebSocket, prompt_id: str) -> dict:
-    """Receives generated images from the ComfyUI server"""
-    output_images = {}
-    current_node = ""
-    while True:
-        out = ws.recv()
+        if status != 200:
+            raise RuntimeError(f"ComfyUI rejected the prompt: {body.decode('utf-8')}")
+        return json.loads(body)
+
+    def register_template(self, workflow: dict) -> str:
+        """Registers a workflow as a template on the server and returns its ID"""
+        data = json.dumps({"prompt": workflow}).encode("utf-8")
+        status, body = self.request("POST", "/prompt_template", data)
+        if status != 200:
+            raise RuntimeError(f"ComfyUI rejected the workflow template: {body.decode('utf-8')}")
+        template_id = json.loads(body)["template_id"]
+        # The workflow is kept alongside its template so its id can't be reused while cached
+        self.templates[id(workflow)] = (workflow, template_id)
+        return template_id
+
+    def get_worker_load(self) -> tuple[int, int]:
+        """Returns the number of queued and running prompts and the free memory of the first device"""
+        with self.lock:
+            _, queue_body = self.request("GET", "/prompt")
+            _, stats_body = self.request("GET", "/system_stats")
+        tasks_remaining = json.loads(queue_body)["exec_info"]["queue_remaining"]
+        device = json.loads(stats_body)["devices"][0]
+        return tasks_remaining, device["vram_free"]
+
+    def wait_until_ready(self, timeout: float) -> bool:
+        """Polls /ready until the server can run prompts, returns False on timeout"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                with self.lock:
+                    status, _ = self.request("GET", "/ready")
+                if status == 200:
+                    return True
+            except (HTTPException, OSError):
+                # The server isn't listening yet
+                pass
+            time.sleep(0.5)
+        return False
+
+    def request(self, method: str, path: str, data: bytes | None = None) -> tuple[int, bytes]:
+        """Sends a request over the keep-alive HTTP connection, reconnecting once if it was dropped"""
+        headers = {"Content-Type": "application/json"} if data is not None else {}
+        for attempt in range(2):
+            if self.http is None:
+                self.http = HTTPConnection(self.server_address)
+            try:
+                self.http.request(method, path, body=data, headers=headers)
+                response = self.http.getresponse()
+                return response.status, response.read()
+            except (HTTPException, OSError):
+                self.http.close()
+                self.http = None
+                if attempt == 1:
+                    raise
+
+    def receive_loop(self, ws: websocket.WebSocket) -> None:
+        """Routes websocket messages to the pending prompts until the socket closes"""
+        try:
+            while True:
+                out = ws.recv()
+                with self.lock:
+                    self.handle_message(out)
+        except Exception as e:
+            with self.lock:
+                if self.ws is ws:
+                    self.ws = None
+                for pending in self.pending.values():
+                    if not pending.future.done():
+                        pending.future.set_exception(ConnectionError(f"ComfyUI websocket closed: {e}"))
+
+    def handle_message(self, out: str | bytes) -> None:
+        """Handles a single websocket message"""
         if isinstance(out, str):
             message = json.loads(out)
+            data = message["data"]
+            pending = self.pending.get(data.get("prompt_id"))
             if message["type"] == "executing":
-                data = message["data"]
-                if data["prompt_id"] == prompt_id:
-                    if data["node"] is None:
-                        break  # Execution is done
+                self.executing_prompt_id = data.get("prompt_id")
+                if pending is None:
+                    return
+                if data.get("node") is None:
+                    # Execution is done
+                    if pending.error is not None:
+                        pending.future.set_exception(RuntimeError(pending.error))
                     else:
-                        current_node = data["node"]
-                        print(f"Processing node: {current_node}")
+                        pending.future.set_result(pending.output_images)
+                else:
+                    pending.current_node = data["node"]
+                    print(f"Processing node: {pending.current_node}")
+            elif message["type"] == "execution_error" and pending is not None:
+                pending.error = data["exception_message"]
         else:
-            if current_node == "save_image_websocket_node":
-                images_output = output_images.get(current_node, [])
+            pending = self.pending.get(self.executing_prompt_id)
+            if pending is not None and pending.current_node == "save_image_websocket_node":
+                images_output = pending.output_images.setdefault(pending.current_node, [])
                 # Important: The first 8 bytes need to be skipped as they contain binary header info
                 images_output.append(out[8:])
-                output_images[current_node] = images_output
 
-    return output_images
+
+comfy_client = ComfyClient()
 
 
-def modify_workflow_dump(
-    workflow_dump: str,
+def get_workflow_overrides(
     positive_prompt: str,
     negative_prompt: str,
     seed: int,
     steps: int,
     cfg: int,
     denoise: int,
+    image: str | bytes,
+    mask: str | bytes,
 ) -> dict:
-    """Sets up the inpainting workflow"""
-    workflow = json.loads(workflow_dump)
-    workflow["37"]["inputs"]["text"] = positive_prompt
-    workflow["38"]["inputs"]["text"] = negative_prompt
-    workflow["39"]["inputs"]["seed"] = seed
-    workflow["39"]["inputs"]["steps"] = steps
-    workflow["39"]["inputs"]["cfg"] = cfg
-    workflow["39"]["inputs"]["denoise"] = denoise
-    return workflow
+    """Returns the inputs of the inpainting workflow that change between jobs"""
+    return {
+        "37": {"text": positive_prompt},
+        "38": {"text": negative_prompt},
+        "39": {"seed": seed, "steps": steps, "cfg": cfg, "denoise": denoise},
+        "47": {"image": to_base64(image)},
+        "48": {"image": to_base64(mask)},
+    }
 
 
 def create_test_input(image_path: str, mask_path: str, save_path: str) -> None:
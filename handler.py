@@ -1,21 +1,29 @@
 import runpod
 import os
 import base64
-from comfy_serverless import execute_workflow, save_image_to_path, validate_input
+import asyncio
+from comfy_serverless import (
+    execute_workflow,
+    get_worker_load,
+    validate_input,
+    wait_until_ready,
+)
+
+# Maximum number of jobs the worker accepts at once
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "2"))
+# Prompts queued on ComfyUI at which no more jobs are admitted
+MAX_QUEUED_PROMPTS = int(os.getenv("MAX_QUEUED_PROMPTS", str(MAX_CONCURRENCY)))
+# Free device memory (GB) below which the worker falls back to a single job
+MIN_FREE_MEMORY_GB = float(os.getenv("MIN_FREE_MEMORY_GB", "2"))
 
 
 def handler(event: dict) -> dict:
     """Handler for the RunPod serverless API"""
     input_data = validate_input(event)
-
-    input_dir = "ComfyUI/input"
-    image_path = os.path.join(input_dir, "tmp.png")
-    mask_path = os.path.join(input_dir, "tmp-mask.png")
+    if "error" in input_data:
+        return input_data
 
     try:
-        save_image_to_path(input_data.get("image"), image_path)
-        save_image_to_path(input_data.get("mask"), mask_path)
-
         images = execute_workflow(
             input_data.get("positive_prompt"),
             input_data.get("negative_prompt"),
@@ -23,8 +31,10 @@ def handler(event: dict) -> dict:
             input_data.get("steps"),
             input_data.get("cfg"),
             input_data.get("denoise"),
+            input_data.get("image"),
+            input_data.get("mask"),
         )
-        
+
         output_images = {}
         for node_id, image_list in images.items():
             output_images[node_id] = [base64.b64encode(img).decode('utf-8') for img in image_list]
@@ -36,5 +46,30 @@ def handler(event: dict) -> dict:
         return {"error": str(e)}
 
 
+async def async_handler(event: dict) -> dict:
+    """Async handler for the RunPod serverless API, lets several jobs run at once"""
+    return await asyncio.to_thread(handler, event)
+
+
+def concurrency_modifier(current_concurrency: int) -> int:
+    """Admits one more job while ComfyUI's queue is short and there is free memory"""
+    try:
+        tasks_remaining, free_memory = get_worker_load()
+    except Exception as e:
+        print("Error reading the worker load:", e)
+        return 1
+
+    if free_memory < MIN_FREE_MEMORY_GB * 1024**3:
+        return 1
+    if tasks_remaining < MAX_QUEUED_PROMPTS:
+        return min(current_concurrency + 1, MAX_CONCURRENCY)
+    return current_concurrency
+
+
 if __name__ == "__main__":
-    runpod.serverless.start({"handler": handler})
+    # Import ComfyUI, restore its warm state and run the warm-up input before accepting jobs
+    wait_until_ready()
+
+    runpod.serverless.start(
+        {"handler": async_handler, "concurrency_modifier": concurrency_modifier}
+    )